@@ -0,0 +1,106 @@
+# Copyright 2025 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#      https://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark script comparing mask and index token dispatch for dropping MoE.
+
+This script compiles the capacity-limited dispatch and combine of `moe.MoeBlock`
+twice: once with the one-hot dispatch/combine masks and einsums, and once with
+the index-based `index_dispatch`/`index_combine` path. For each it reports the
+compiled temporary memory and the average step time.
+
+The shapes come from the config: `num_experts`, `num_experts_per_tok`,
+`micro_batch_size_to_train_on`, `max_target_length` and `emb_dim`. The config
+must set `capacity_factor` > 0, e.g.
+
+  python3 -m MaxText.benchmark_moe_dispatch MaxText/configs/base.yml \
+    model_name=mixtral-8x7b num_experts=128 capacity_factor=2 megablox=False sparse_matmul=False
+"""
+
+
+# pylint: disable=ungrouped-imports
+import datetime
+import os
+from typing import Sequence
+
+import jax
+import jax.numpy as jnp
+from absl import app
+from jax.sharding import Mesh
+
+from MaxText import max_utils
+from MaxText import maxtext_utils
+from MaxText import pyconfig
+from MaxText.layers import initializers
+from MaxText.layers import moe
+
+
+_WARMUP_ITERS = 2
+_BENCHMARK_ITERS = 10
+
+
+def main(argv: Sequence[str]) -> None:
+  jax.config.update("jax_default_prng_impl", "unsafe_rbg")
+  os.environ["TF_CPP_MIN_LOG_LEVEL"] = "0"
+  config = pyconfig.initialize(argv)
+  max_utils.print_system_information()
+
+  if config.capacity_factor <= 0:
+    raise ValueError("Index dispatch is only used for dropping MoE, set capacity_factor > 0.")
+
+  num_experts, num_experts_per_tok = config.num_experts, config.num_experts_per_tok
+  batch_size, seq_len, emb_dim = config.micro_batch_size_to_train_on, config.max_target_length, config.emb_dim
+  devices_array = maxtext_utils.create_device_mesh(config)
+  model = moe.MoeBlock(
+      config=config,
+      num_experts=num_experts,
+      num_experts_per_tok=num_experts_per_tok,
+      mesh=Mesh(devices_array, config.mesh_axes),
+      kernel_init=initializers.nd_dense_init(1.0, "fan_in", "truncated_normal"),
+      kernel_axes=("embed", "mlp"),
+      dtype=config.dtype,
+  )
+  rng_logits, rng_inputs = jax.random.split(jax.random.PRNGKey(0))
+  logits = jax.random.normal(rng_logits, (batch_size, seq_len, num_experts))
+  inputs = jax.random.normal(rng_inputs, (batch_size, seq_len, emb_dim), dtype=config.dtype)
+
+  def mask_dispatch_and_combine(inputs, logits):
+    top_k_weights, top_k_indices = jax.lax.top_k(logits, num_experts_per_tok)
+    weights = model.reshape_and_update_weights(top_k_weights, top_k_indices)
+    dispatch_mask, combine_mask = model.generate_masks(top_k_indices, weights)
+    dispatch = jnp.einsum("BSM,BSEC -> EBCM", inputs, dispatch_mask)
+    return jnp.einsum("EBCM,BSEC -> BSM", dispatch, combine_mask)
+
+  def index_dispatch_and_combine(inputs, logits):
+    top_k_weights, top_k_indices = jax.lax.top_k(logits, num_experts_per_tok)
+    expert_capacity = model.get_expert_capacity(seq_len)
+    slots = model.generate_dispatch_slots(top_k_indices, expert_capacity)
+    dispatch = model.index_dispatch(inputs, slots, expert_capacity)
+    return model.index_combine(dispatch, slots, top_k_weights.astype(model.dtype))
+
+  print(f"Benchmarking {num_experts=}, {num_experts_per_tok=}, {batch_size=}, {seq_len=}, {emb_dim=}")
+  for name, fn in (("mask", mask_dispatch_and_combine), ("index", index_dispatch_and_combine)):
+    compiled = jax.jit(fn).lower(inputs, logits).compile()
+    memory_stats = compiled.memory_analysis()
+    temp_bytes = memory_stats.temp_size_in_bytes if memory_stats is not None else None
+
+    for _ in range(_WARMUP_ITERS):
+      jax.block_until_ready(compiled(inputs, logits))
+
+    start = datetime.datetime.now()
+    for _ in range(_BENCHMARK_ITERS):
+      output = compiled(inputs, logits)
+    jax.block_until_ready(output)
+    average_time = (datetime.datetime.now() - start) / _BENCHMARK_ITERS
+    print(f"{name} dispatch: temp bytes {temp_bytes}, average step time over {_BENCHMARK_ITERS} iterations: {average_time}")
+
+
+if __name__ == "__main__":
+  app.run(main)
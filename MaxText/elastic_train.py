@@ -233,8 +233,6 @@ def train_loop(config, elastic_manager, state=None):
       static_argnums=static_argnums_train,
       donate_argnums=donate_argnums_train,
   )
-  running_gcs_metrics = [] if config.gcs_metrics else None
-
   start_step = get_first_step(state)  # this is the start_step for training
   prof = profiler.Profiler(config, offset_step=start_step)
   first_profiling_step = prof.start_initial_profile_step
@@ -305,9 +303,10 @@ def train_loop(config, elastic_manager, state=None):
           # Upon preemption, exit when and only when all ongoing saves are complete.
           if checkpoint_manager.reached_preemption(step):
             checkpoint_manager.wait_until_finished()
+            metric_logger.close()
             sys.exit()
 
-        metric_logger.write_metrics(running_gcs_metrics, metrics, step)
+        metric_logger.write_metrics(metrics, step)
 
         if step == last_profiling_step or prof.should_deactivate_periodic_profile(step):
           prof.deactivate(blocking_object=state)
@@ -335,6 +334,7 @@ def train_loop(config, elastic_manager, state=None):
           },
       )
       if ret is not None:
+        metric_logger.close()
         (
             config,
             step,
@@ -397,7 +397,7 @@ def train_loop(config, elastic_manager, state=None):
         max_logging.log(f"Checkpoint is already saved for step {int(state.step)-1}.")
 
     checkpoint_manager.wait_until_finished()
-  metric_logger.write_metrics(running_gcs_metrics, metrics, config.steps - 1)  # final step metrics
+  metric_logger.close()  # writes the final step metrics
   max_utils.close_summary_writer(writer)
   record_goodput(recorder, config, recorder.record_job_end_time if recorder else None)
   with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
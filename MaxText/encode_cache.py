@@ -0,0 +1,84 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded LRU cache of tokenizer outputs for repeated strings, e.g. chat templates and few-shot prefixes.
+
+Kept free of tensorflow so that both the input pipelines and the inference engine can use it.
+"""
+
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Sequence
+import threading
+
+
+class EncodeCache:
+  """Thread-safe LRU cache mapping keys to encoded values, holding at most max_size entries."""
+
+  def __init__(self, max_size: int):
+    if max_size <= 0:
+      raise ValueError(f"max_size should be positive, got {max_size}.")
+    self.max_size = max_size
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: Hashable) -> Any:
+    """Returns the value of key and marks it recently used, or None if key is not cached."""
+    with self._lock:
+      value = self._entries.get(key)
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self._entries.move_to_end(key)
+      return value
+
+  def put(self, key: Hashable, value: Any) -> None:
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def encode_batch(
+      self,
+      keys: Sequence[Hashable],
+      texts: Sequence[str],
+      encode_batch_fn: Callable[[Sequence[str]], Sequence[Any]],
+  ) -> list[Any]:
+    """Returns the encoded texts, encoding the ones missing from the cache with a single encode_batch_fn call."""
+    results = [self.get(key) for key in keys]
+    # Positions of each missing key, so that repeated texts in the batch are encoded once.
+    missing = {}
+    for i, result in enumerate(results):
+      if result is None:
+        missing.setdefault(keys[i], []).append(i)
+    if missing:
+      encoded = encode_batch_fn([texts[positions[0]] for positions in missing.values()])
+      for (key, positions), value in zip(missing.items(), encoded):
+        self.put(key, value)
+        for i in positions:
+          results[i] = value
+    return results
+
+  def __getstate__(self):
+    # Pickled into data loading workers, which start with an empty cache.
+    return {"max_size": self.max_size}
+
+  def __setstate__(self, state):
+    self.__init__(state["max_size"])
@@ -77,6 +77,9 @@ def preprocessing_pipeline(
   if global_batch_size % global_mesh.size != 0:
     raise ValueError("Batch size should be divisible number of global devices.")
 
+  if shuffle:
+    dataset = dataset.shuffle(seed=data_shuffle_seed)
+
   if tokenize:
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         tokenizer_path,
@@ -127,8 +130,9 @@ def preprocessing_pipeline(
       shard_options=grain.ShardOptions(
           shard_index=dataloading_host_index, shard_count=dataloading_host_count, drop_remainder=False
       ),
-      shuffle=shuffle,
-      seed=data_shuffle_seed,
+      # HFDataSource reads each record key at its position in a stream, so the keys are not shuffled.
+      shuffle=False,
+      seed=0,
   )
 
   dataloader = grain.DataLoader(
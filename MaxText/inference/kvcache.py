@@ -171,6 +171,8 @@ class KVCache(nn.Module):
   ar_cache_axis_order: AxisIdxes = (1, 2, 0, 3)
   key_axis_order: AxisIdxes = (2, 0, 1, 3)
   use_chunked_prefill: bool = False
+  # Set to the window of sliding window attention layers, which only keep the last window tokens.
+  ar_cache_window_size: int | None = None
 
   def _get_cached_kv_dtype(self):
     return self.kv_quant.dtype if self.kv_quant else self.dtype
@@ -183,6 +185,14 @@ class KVCache(nn.Module):
       return (batch, cache_length, 1, 1)
     raise f"Invalid config for kv_quant_axis:{self.kv_quant.axis_cfg}"
 
+  def _get_ar_cache_length(self):
+    cache_length = self.max_target_length - self.max_prefill_length
+    if self.ar_cache_window_size is not None:
+      # A ring buffer of the window: with one write per decode step, the oldest token written is the one leaving
+      # the window of the current token, so it can be overwritten.
+      cache_length = min(cache_length, self.ar_cache_window_size)
+    return cache_length
+
   def _get_prefill_cache_vars(self, batch, key_heads, value_heads, key_head_size, value_head_size, model_mode):
 
     cache_length = self.max_prefill_length
@@ -265,7 +275,7 @@ class KVCache(nn.Module):
           f"max_target_length: {self.max_target_length} should be greater than max_prefill_length:"
           f" {self.max_prefill_length}!"
       )
-    cache_length = self.max_target_length - self.max_prefill_length
+    cache_length = self._get_ar_cache_length()
 
     if model_mode == common_types.MODEL_MODE_PREFILL:
       cache_logical_axis_names = self.prefill_cache_logical_axis_names
@@ -552,29 +562,14 @@ class KVCache(nn.Module):
     ar_cache_batch_axis = ar_cache_axis_names.index(CACHE_BATCH)
 
     if use_ragged_attention:
-      cache_locations = [slice(None)] * 4
-      new_token_locations = [slice(None)] * 4
-      new_token_locations[ar_cache_sequence_axis] = 0
-
-      def key_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_key_shaped_for_cache[tuple(new_token_locations)])
-
-      def value_body(i, val):
-        cache_locations[ar_cache_batch_axis] = i
-        cache_locations[ar_cache_sequence_axis] = lengths[i]
-        new_token_locations[ar_cache_batch_axis] = i
-        return val.at[tuple(cache_locations)].set(one_token_value_shaped_for_cache[tuple(new_token_locations)])
-
-      cached_key_var.value = jax.lax.fori_loop(
-          0, one_token_key_shaped_for_cache.shape[0], key_body, cached_key_var.value, unroll=8
+      # Wraps around in the ring buffer of sliding window layers.
+      lengths = jnp.mod(lengths, cached_key_var.value.shape[ar_cache_sequence_axis])
+      cached_key_var.value = self.append_per_slot(
+          cached_key_var.value, one_token_key_shaped_for_cache, lengths, ar_cache_batch_axis, ar_cache_sequence_axis
       )
-      cached_value_var.value = jax.lax.fori_loop(
-          0, one_token_value_shaped_for_cache.shape[0], value_body, cached_value_var.value, unroll=8
+      cached_value_var.value = self.append_per_slot(
+          cached_value_var.value, one_token_value_shaped_for_cache, lengths, ar_cache_batch_axis, ar_cache_sequence_axis
       )
-
     else:
       one_hot_indices = one_hot_indices.astype(int)
       cached_key_var.value = jax.lax.dynamic_update_index_in_dim(
@@ -589,17 +584,57 @@ class KVCache(nn.Module):
     if self.kv_quant:
       ar_cache_scale_axis_names = transpose_tuple(self.cache_scale_logical_axis_names, self.ar_cache_axis_order)
       ar_cache_scale_update_axis = ar_cache_scale_axis_names.index(CACHE_SCALE_SEQUENCE)
+      ar_cache_scale_batch_axis = ar_cache_scale_axis_names.index(CACHE_SCALE_BATCH)
       assert cached_key_scale_var is not None, "cached_key_scale_var cannot be None"
       assert cached_value_scale_var is not None, "cached_value_scale_var cannot be None"
-      cached_key_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, ar_cache_update_idx, ar_cache_scale_update_axis
-      )
-      cached_value_scale_var.value = jax.lax.dynamic_update_index_in_dim(
-          cached_value_scale_var.value,
-          one_token_value_scale_shaped_for_cache,
-          ar_cache_update_idx,
-          ar_cache_scale_update_axis,
-      )
+      if use_ragged_attention:
+        cached_key_scale_var.value = self.append_per_slot(
+            cached_key_scale_var.value,
+            one_token_key_scale_shaped_for_cache,
+            lengths,
+            ar_cache_scale_batch_axis,
+            ar_cache_scale_update_axis,
+        )
+        cached_value_scale_var.value = self.append_per_slot(
+            cached_value_scale_var.value,
+            one_token_value_scale_shaped_for_cache,
+            lengths,
+            ar_cache_scale_batch_axis,
+            ar_cache_scale_update_axis,
+        )
+      else:
+        cached_key_scale_var.value = jax.lax.dynamic_update_index_in_dim(
+            cached_key_scale_var.value, one_token_key_scale_shaped_for_cache, ar_cache_update_idx, ar_cache_scale_update_axis
+        )
+        cached_value_scale_var.value = jax.lax.dynamic_update_index_in_dim(
+            cached_value_scale_var.value,
+            one_token_value_scale_shaped_for_cache,
+            ar_cache_update_idx,
+            ar_cache_scale_update_axis,
+        )
+
+  def append_per_slot(self, cache: Array, one_token: Array, lengths: Array, batch_axis: int, sequence_axis: int) -> Array:
+    """Writes the token of each slot at the slot's own length in the cache, with a single scatter.
+
+    Args:
+      cache: cache with one row per slot along batch_axis.
+      one_token: new tokens in the same layout as the cache, of size 1 along sequence_axis.
+      lengths: [b] position of the new token of each slot along sequence_axis.
+      batch_axis: batch axis of cache and one_token.
+      sequence_axis: sequence axis of cache and one_token.
+
+    Returns:
+      the updated cache.
+    """
+    slots = jnp.arange(lengths.shape[0])
+    # The same advanced indices on the same axes put the slot dimension at the same place in both.
+    cache_locations = [slice(None)] * cache.ndim
+    cache_locations[batch_axis] = slots
+    cache_locations[sequence_axis] = lengths
+    new_token_locations = [slice(None)] * one_token.ndim
+    new_token_locations[batch_axis] = slots
+    new_token_locations[sequence_axis] = jnp.zeros_like(lengths)
+    return cache.at[tuple(cache_locations)].set(one_token[tuple(new_token_locations)], unique_indices=True)
 
   def get_cached_values(self, cache_vars, target_dtype, cache_axis_order) -> jax.Array | KVTensor:
     cache_var, cache_scale_var = cache_vars
@@ -662,7 +697,7 @@ class KVCache(nn.Module):
     cached_ar_segment_id_var.value = jax.lax.dynamic_update_index_in_dim(
         cached_ar_segment_id_var.value, active_indicator, jnp.squeeze(cache_ar_index_var.value), 1
     )
-    cache_ar_index_var.value = jnp.mod(cache_ar_index_var.value + 1, self.max_target_length - self.max_prefill_length)
+    cache_ar_index_var.value = jnp.mod(cache_ar_index_var.value + 1, self._get_ar_cache_length())
     cache_ar_lengths_var.value = cache_ar_lengths_var.value.at[:].add(1)
 
     # The below retrieves the existing prefill cache variables, not creating new ones
@@ -670,20 +705,48 @@ class KVCache(nn.Module):
         batch, key_heads, value_heads, key_head_size, value_head_size, common_types.MODEL_MODE_AUTOREGRESSIVE
     )
 
+    prefill_segment_id = cached_prefill_segment_id_var.value
+    ar_lengths = cache_ar_lengths_var.value
+    if self.ar_cache_window_size is not None:
+      prefill_segment_id, ar_lengths = self.mask_outside_window(prefill_segment_id, ar_lengths, use_ragged_attention)
+
     cached_prefill = (
         self.get_cached_values(cached_prefill_key_vars, key.dtype, self.prefill_cache_axis_order),
         self.get_cached_values(cached_prefill_value_vars, value.dtype, self.prefill_cache_axis_order),
-        cached_prefill_segment_id_var.value,
+        prefill_segment_id,
     )
 
     cached_ar = (
         self.get_cached_values(cached_ar_key_vars, key.dtype, self.ar_cache_axis_order),
         self.get_cached_values(cached_ar_value_vars, value.dtype, self.ar_cache_axis_order),
         cached_ar_segment_id_var.value,
-        cache_ar_lengths_var.value,
+        ar_lengths,
     )
     return cached_prefill, cached_ar
 
+  def mask_outside_window(self, prefill_segment_id: Array, ar_lengths: Array, use_ragged_attention: bool):
+    """Hides the cached tokens outside the sliding window of the current token of each slot.
+
+    The ring buffer only holds tokens of the window, so only the prompt tokens need masking. The position of the
+    current token is the prompt length plus the number of tokens decoded so far, minus one.
+
+    Args:
+      prefill_segment_id: [b, max_prefill_length] segment ids of the prompts.
+      ar_lengths: [b] number of tokens decoded by each slot, including the current one.
+      use_ragged_attention: whether the decode attends to a prefix of the caches given by their lengths.
+
+    Returns:
+      prefill segment ids and ar lengths to attend with.
+    """
+    ring_lengths = jnp.minimum(ar_lengths, self._get_ar_cache_length())
+    if use_ragged_attention:
+      # Ragged attention reads a prefix of the prefill cache, so the prompt is attended in full.
+      return prefill_segment_id, ring_lengths
+    prompt_lengths = jnp.sum(prefill_segment_id == common_types.DECODING_ACTIVE_SEQUENCE_INDICATOR, axis=1)
+    window_start = prompt_lengths + ar_lengths - self.ar_cache_window_size
+    positions = jnp.arange(prefill_segment_id.shape[1])[None, :]
+    return jnp.where(positions >= window_start[:, None], prefill_segment_id, 0), ring_lengths
+
   @nn.compact
   def __call__(
       self,
@@ -20,10 +20,15 @@ This module provides the PageManager class and associated PageState dataclass fo
 managing the paged attention mechanism. The paging system allows efficient handling
 of variable-length sequences by dividing the attention context into fixed-size pages,
 similar to virtual memory systems.
+
+page_status holds the reference count of each page, so a page can be shared by several
+slots and the prefix cache, and is free only after all of its holders released it.
 """
 
 # TODO Need to update unit tests for this file under Maxtext/tests/page_manager.py.
 
+from typing import Sequence
+
 import jax
 import jax.numpy as jnp
 
@@ -42,7 +47,7 @@ class PageState:
   """Represents the current state of the paging system.
 
   Attributes:
-    page_status: Array indicating whether each page is in use (1) or free (0)
+    page_status: Array of reference counts of each page, 0 if the page is free
     page_map: Array mapping slots to their assigned pages
     sequence_lengths: Array containing the current length of each sequence
     num_pages_used: Array tracking how many pages each slot is using
@@ -109,42 +114,72 @@ class PageManager:
       slot: int,
       page_state: PageState,
   ) -> PageState:
-    page_status = page_state.page_status
-    page_map = page_state.page_map
-    sequence_lengths = page_state.sequence_lengths
-    current_page = page_state.current_page
-    current_page_position = page_state.current_page_position
-    num_pages_used = page_state.num_pages_used
-
-    def _release_page(i, state):
-      page_map, page_status = state
-      page_idx = page_map[slot][i]
-      page_status = page_status.at[page_idx].set(0)
-      page_map = page_map.at[slot, i].set(0)
-      return page_map, page_status
+    return self.release_slots_pages(jnp.asarray([slot], dtype=jnp.int32), page_state)
 
-    page_map, page_status = jax.lax.fori_loop(0, num_pages_used[slot], _release_page, (page_map, page_status))
-
-    sequence_lengths = sequence_lengths.at[slot].set(0)
-    num_pages_used = num_pages_used.at[slot].set(0)
-    current_page = current_page.at[slot].set(0)
-    current_page_position = current_page_position.at[slot].set(0)
+  def release_slots_pages(
+      self,
+      slots: Array,
+      page_state: PageState,
+  ) -> PageState:
+    """Releases the pages of all given slots with a single scatter over the page map rows."""
+    slots = jnp.asarray(slots, dtype=jnp.int32)
+    slot_pages = page_state.page_map[slots]
+    used = jnp.arange(self.max_pages_per_slot)[None, :] < page_state.num_pages_used[slots][:, None]
+    # Unused entries point past the end of page_status and are dropped by the scatter.
+    release_idx = jnp.where(used, slot_pages, self.num_pages)
+    page_status = page_state.page_status.at[release_idx].add(-1, mode="drop")
 
     return PageState(
-        page_status=page_status,
-        page_map=page_map,
-        sequence_lengths=sequence_lengths,
-        num_pages_used=num_pages_used,
-        current_page=current_page,
-        current_page_position=current_page_position,
+        page_status=jnp.maximum(page_status, 0),
+        page_map=page_state.page_map.at[slots].set(0),
+        sequence_lengths=page_state.sequence_lengths.at[slots].set(0),
+        num_pages_used=page_state.num_pages_used.at[slots].set(0),
+        current_page=page_state.current_page.at[slots].set(0),
+        current_page_position=page_state.current_page_position.at[slots].set(0),
     )
 
+  def _free_pages(self, page_status: Array) -> Array:
+    """Returns the free page indices in ascending order, padded with 0 past the number of free pages.
+
+    Page 0 is never handed out, so running out of pages maps the slot to page 0 instead of a page in use.
+    """
+    return jnp.where(page_status[1:] == 0, size=self.num_pages - 1, fill_value=-1)[0] + 1
+
+  def retain_pages(self, pages: Sequence[int], page_state: PageState) -> PageState:
+    """Increments the reference count of pages, e.g. when the prefix cache holds them."""
+    if len(pages) == 0:
+      return page_state
+    pages = jnp.asarray(pages, dtype=jnp.int32)
+    return page_state.replace(page_status=page_state.page_status.at[pages].add(1))
+
+  def release_pages(self, pages: Sequence[int], page_state: PageState) -> PageState:
+    """Decrements the reference count of pages. A page is free once its count reaches 0."""
+    if len(pages) == 0:
+      return page_state
+    pages = jnp.asarray(pages, dtype=jnp.int32)
+    page_status = page_state.page_status.at[pages].add(-1)
+    return page_state.replace(page_status=jnp.maximum(page_status, 0))
+
   def reserve_prefix_slot_pages(
       self,
       slot: int,
       true_length: int,
       page_state: PageState,
+      shared_pages: Sequence[int] = (),
   ) -> PageState:
+    """Reserves pages for the prefill of a slot.
+
+    The first len(shared_pages) pages of the slot are mapped to shared_pages with the reference
+    counts incremented instead of allocating new pages. shared_pages should be full pages of the prompt,
+    the trailing partial page is always allocated to the slot and copied on insert (copy-on-write),
+    since decode writes to it.
+    """
+    num_shared_pages = len(shared_pages)
+    # true_length may be traced, it is only checked when pages are shared, which the host decides
+    if num_shared_pages > 0 and num_shared_pages * self.tokens_per_page > true_length:
+      raise ValueError(
+          f"Shared pages {num_shared_pages=} with {self.tokens_per_page=} should be full pages of {true_length=}."
+      )
     page_state = self.release_slot_pages(slot, page_state)
     page_status = page_state.page_status
     page_map = page_state.page_map
@@ -156,16 +191,25 @@ class PageManager:
     prefill_slot_num_pages = jnp.ceil(true_length / self.tokens_per_page).astype(jnp.int32)
     prefill_slot_page_slice_idx = jnp.where(true_length == 0, 0, (true_length - 1) % self.tokens_per_page)
 
-    def _reserve_page(i, state):
-      slot, page_map, page_status, current_page = state
-      page_idx = jnp.where((page_status[1:] == 0), size=1)[0][0] + 1
-      page_status = page_status.at[page_idx].set(1)
-      page_map = page_map.at[slot, i].set(page_idx)
-      current_page = current_page.at[slot].set(page_idx)
-      return slot, page_map, page_status, current_page
-
-    _, page_map, page_status, current_page = jax.lax.fori_loop(
-        0, prefill_slot_num_pages, _reserve_page, (slot, page_map, page_status, current_page)
+    if num_shared_pages > 0:
+      shared_pages = jnp.asarray(shared_pages, dtype=jnp.int32)
+      page_status = page_status.at[shared_pages].add(1)
+      page_map = page_map.at[slot, :num_shared_pages].set(shared_pages)
+      current_page = current_page.at[slot].set(shared_pages[-1])
+
+    # All new pages of the slot are taken from the free list at once.
+    page_idx = jnp.arange(self.max_pages_per_slot)
+    new_page = jnp.logical_and(page_idx >= num_shared_pages, page_idx < prefill_slot_num_pages)
+    free_pages = self._free_pages(page_status)
+    new_pages = free_pages[jnp.clip(page_idx - num_shared_pages, 0, self.num_pages - 2)]
+    page_status = page_status.at[jnp.where(new_page, new_pages, self.num_pages)].set(1, mode="drop")
+    page_map = page_map.at[slot].set(jnp.where(new_page, new_pages, page_map[slot]))
+    current_page = current_page.at[slot].set(
+        jnp.where(
+            prefill_slot_num_pages > num_shared_pages,
+            page_map[slot, jnp.maximum(prefill_slot_num_pages - 1, 0)],
+            current_page[slot],
+        )
     )
     sequence_lengths = sequence_lengths.at[slot].set(true_length)
     num_pages_used = num_pages_used.at[slot].set(prefill_slot_num_pages)
@@ -203,20 +247,16 @@ class PageManager:
     current_page_position = jnp.where(sequence_lengths == 0, 0, (sequence_lengths - 1) % self.tokens_per_page)
     seq_new_page = num_pages_used - current_num_pages_used
 
-    updating_slots = jnp.where((seq_new_page > 0), size=self.slots)[0]
-
-    def _reserve_page(i, state):
-      page_map, page_status, current_page, updating_slots = state
-      slot = jax.lax.dynamic_index_in_dim(updating_slots, i, axis=0, keepdims=False)
-      page_idx = jnp.where((page_status[1:] == 0), size=1)[0][0] + 1
-      page_status = page_status.at[page_idx].set(1)
-      page_map = page_map.at[slot, num_pages_used[slot] - 1].set(page_idx)
-      current_page = current_page.at[slot].set(page_idx)
-      return page_map, page_status, current_page, updating_slots
-
-    page_map, page_status, current_page, _ = jax.lax.fori_loop(
-        0, jnp.count_nonzero(seq_new_page), _reserve_page, (page_map, page_status, current_page, updating_slots)
-    )
+    # Slots crossing a page boundary take consecutive entries of the free list, ranked by a prefix sum.
+    needs_page = seq_new_page > 0
+    rank = jnp.cumsum(needs_page) - needs_page
+    free_pages = self._free_pages(page_status)
+    new_pages = free_pages[jnp.clip(rank, 0, self.num_pages - 2)]
+    page_status = page_status.at[jnp.where(needs_page, new_pages, self.num_pages)].set(1, mode="drop")
+    slots = jnp.arange(self.slots)
+    page_map_idx = jnp.maximum(num_pages_used - 1, 0)
+    page_map = page_map.at[slots, page_map_idx].set(jnp.where(needs_page, new_pages, page_map[slots, page_map_idx]))
+    current_page = jnp.where(needs_page, new_pages, current_page)
 
     return PageState(
         page_status=page_status,
@@ -360,8 +360,8 @@ class PagedAttentionOp(nn.Module):
     slot_pages = page_state.page_map[slot]
     used_pages = slot_pages[slot_pages > 0]
 
-    # Update page status to mark pages as free
-    new_page_status = page_state.page_status.at[used_pages].set(0)
+    # Drop the reference of the slot, pages shared with other holders stay in use
+    new_page_status = jnp.maximum(page_state.page_status.at[used_pages].add(-1), 0)
 
     # Reset page map
     new_page_map = page_state.page_map.at[slot].set(0)
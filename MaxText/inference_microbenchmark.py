@@ -17,6 +17,7 @@ limitations under the License.
 """Inference microbenchmark for prefill and autoregressive steps."""
 import datetime
 import jax
+import jax.numpy as jnp
 import json
 
 from absl import app
@@ -24,12 +25,14 @@ from collections.abc import MutableMapping
 
 from jetstream.engine import token_utils
 
+from MaxText import inference_utils
 from MaxText import max_utils
 from MaxText import maxengine
 from MaxText import maxtext_utils
 from MaxText import prefix_cache
 from MaxText import profiler
 from MaxText import pyconfig
+from MaxText.inference import kvcache
 
 import warnings
 
@@ -41,7 +44,14 @@ _FLATTEN_MICROBENCHMARK_RESULTS = False
 
 
 def prefix_cache_benchmark(
-    prefix, prefill_length: int, true_length: int, common_prefix_proportion: float, prefix_cache_entries_num: int, iters: int
+    prefix,
+    prefill_length: int,
+    true_length: int,
+    common_prefix_proportion: float,
+    prefix_cache_entries_num: int,
+    iters: int,
+    eviction_policy: str = "lru",
+    ttl_seconds: float = 0.0,
 ):
   """Handles running prefix cache benchmark, and printing results.
 
@@ -59,6 +69,8 @@ def prefix_cache_benchmark(
     common_prefix_proportion: [0., 1.] common prefix proportion to the prefill_length
     prefix_cache_entries_num: number of prefix cache entries insert into PrefixCache
     iters: repeat time to test fetch_longest_common_prefix_key and load from cache
+    eviction_policy: eviction policy of PrefixCache
+    ttl_seconds: seconds an entry can stay without used for ttl eviction policy
   """
 
   print(f"Prefix Cache benchmark results for prefill length {prefill_length}:\n")
@@ -86,7 +98,9 @@ def prefix_cache_benchmark(
   prefix_size_bytes_gb = value.prefix_size_bytes / 1024 / 1024 / 1024
   max_bytes = prefix_cache_entries_num * value.prefix_size_bytes
   # TODO(yuyanpeng): test hierarchical cache
-  prefix_cache_inst = prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes)
+  prefix_cache_inst = prefix_cache.PrefixCache(
+      hbm_bytes=max_bytes, dram_bytes=max_bytes, eviction_policy=eviction_policy, ttl_seconds=ttl_seconds
+  )
   common_len = int(prefill_length * common_prefix_proportion)
   remain_len = prefill_length - common_len
   common_prefix_key = tuple(i for i in range(common_len))
@@ -143,12 +157,15 @@ def prefix_cache_benchmark(
   del value_load
   load_avg_ms = load_sec * 1000 / iters
 
+  hbm_stats = prefix_cache_inst.get_stats()["hbm"]
   print(
       f"PrefixCaching results:\n"
+      f"\tEviction policy: {eviction_policy}\n"
       f"\tPer prefix size bytes: {prefix_size_bytes_gb:.3f} GB\n"
       f"\tAverage save cache time: {save_avg_ms:.3f} ms\n"
       f"\tAverage fetch longest prefix time: {fetch_avg_ms:.3f} ms\n"
-      f"\tAverage load cache time: {load_avg_ms:.3f} ms\n\n\n"
+      f"\tAverage load cache time: {load_avg_ms:.3f} ms\n"
+      f"\tHBM hit ratio: {hbm_stats.hit_ratio:.3f}, byte hit ratio: {hbm_stats.byte_hit_ratio:.3f}\n\n\n"
   )
   del prefix_cache_inst
 
@@ -309,6 +326,91 @@ def ar_benchmark(config, engine_generate, params, decode_state, global_batch_siz
   return result_dict, decode_state
 
 
+def nucleus_sampling_benchmark(config, global_batch_size, iters):
+  """Benchmarks nucleus sampling sorting the whole vocabulary against searching the top candidates first."""
+  # Scaled so that the distribution is peaked like the logits of a trained model.
+  logits = 8.0 * jax.random.normal(jax.random.PRNGKey(1234), (global_batch_size, 1, config.vocab_size))
+  nucleus_topp = config.decode_sampling_nucleus_p if config.decode_sampling_nucleus_p > 0 else 0.9
+  nucleus_candidates = config.decode_sampling_nucleus_candidates or min(1024, config.vocab_size)
+
+  print(f"Nucleus sampling benchmark results for vocab size {config.vocab_size}, top-p {nucleus_topp}:\n")
+  result_dict = {}
+  for name, candidates in (("full_sort", 0), ("candidates", nucleus_candidates)):
+    sample = jax.jit(
+        lambda logits, rng, candidates=candidates: inference_utils.sample_nucleus_topp_logits(
+            logits, nucleus_topp, config.decode_sampling_temperature, rng, candidates
+        )
+    )
+    rng = jax.random.PRNGKey(1234)
+    for _ in range(_WARMUP_ITERS):
+      rng, rng_sample = jax.random.split(rng)
+      tokens = sample(logits, rng_sample)
+    jax.block_until_ready(tokens)
+
+    start = datetime.datetime.now()
+    for _ in range(iters):
+      rng, rng_sample = jax.random.split(rng)
+      tokens = sample(logits, rng_sample)
+    jax.block_until_ready(tokens)
+    end = datetime.datetime.now()
+    average_ms = (end - start).total_seconds() * 1000 / iters
+    print(f"\t{name} ({candidates=}) average time: {average_ms:.3f} ms")
+    result_dict[name] = {"time_in_ms": average_ms, "nucleus_candidates": candidates}
+  print("\n\n")
+  return result_dict
+
+
+def _append_per_slot_loop(cache, one_token, lengths, batch_axis, sequence_axis):
+  """Appends the token of each slot at its own length with one update per slot, the reference of append_per_slot."""
+  cache_locations = [slice(None)] * cache.ndim
+  new_token_locations = [slice(None)] * one_token.ndim
+  new_token_locations[sequence_axis] = 0
+
+  def body(i, val):
+    cache_locations[batch_axis] = i
+    cache_locations[sequence_axis] = lengths[i]
+    new_token_locations[batch_axis] = i
+    return val.at[tuple(cache_locations)].set(one_token[tuple(new_token_locations)])
+
+  return jax.lax.fori_loop(0, lengths.shape[0], body, cache, unroll=8)
+
+
+def ragged_append_benchmark(config, global_batch_size, iters):
+  """Benchmarks appending the decode token of every slot to the ragged AR KV cache, per slot against one scatter."""
+  ar_cache_length = config.max_target_length - config.max_prefill_predict_length
+  ar_cache_axis_order = tuple(int(i) for i in config.ar_cache_axis_order.split(","))
+  kv_cache = kvcache.KVCache(
+      config.max_prefill_predict_length, config.max_target_length, config.dtype, ar_cache_axis_order=ar_cache_axis_order
+  )
+  rng_cache, rng_token, rng_lengths = jax.random.split(jax.random.PRNGKey(1234), 3)
+  logical_shape = (global_batch_size, ar_cache_length, config.num_kv_heads, config.head_dim)
+  cache = jnp.transpose(jax.random.normal(rng_cache, logical_shape, dtype=config.dtype), ar_cache_axis_order)
+  one_token = jax.random.normal(rng_token, (global_batch_size, 1, config.num_kv_heads, config.head_dim), dtype=config.dtype)
+  one_token = jnp.transpose(one_token, ar_cache_axis_order)
+  lengths = jax.random.randint(rng_lengths, (global_batch_size,), 0, ar_cache_length)
+  batch_axis = ar_cache_axis_order.index(0)
+  sequence_axis = ar_cache_axis_order.index(1)
+
+  print(f"Ragged append benchmark results for {global_batch_size} slots:\n")
+  result_dict = {}
+  for name, append in (("loop", _append_per_slot_loop), ("scatter", kv_cache.append_per_slot)):
+    compiled = jax.jit(append, static_argnums=(3, 4)).lower(cache, one_token, lengths, batch_axis, sequence_axis).compile()
+    for _ in range(_WARMUP_ITERS):
+      output = compiled(cache, one_token, lengths)
+    jax.block_until_ready(output)
+
+    start = datetime.datetime.now()
+    for _ in range(iters):
+      output = compiled(cache, one_token, lengths)
+    jax.block_until_ready(output)
+    end = datetime.datetime.now()
+    average_ms = (end - start).total_seconds() * 1000 / iters
+    print(f"\t{name} append average time: {average_ms:.3f} ms")
+    result_dict[name] = {"time_in_ms": average_ms}
+  print("\n\n")
+  return result_dict
+
+
 def collate_results(config, results, model_size, cache_size, num_model_params, incl_config=False):
   """Adds model/cache size info and optionally config info to results."""
   results["sizes"] = {
@@ -467,6 +569,8 @@ def run_benchmarks(config):
             config.inference_microbenchmark_prefix_cache_common_prefix_proportion,
             config.inference_microbenchmark_prefix_cache_entries_num,
             benchmark_loop_iters,
+            config.prefix_caching_eviction_policy,
+            config.prefix_caching_ttl_seconds,
         )
         del prefill_result
 
@@ -536,6 +640,14 @@ def run_benchmarks(config):
         benchmark_loop_iters,
     )
 
+  if "nucleus_sampling" in stages_to_benchmark:
+    benchmark_results["nucleus_sampling"] = nucleus_sampling_benchmark(
+        config, engine.max_concurrent_decodes, benchmark_loop_iters
+    )
+
+  if "ragged_append" in stages_to_benchmark:
+    benchmark_results["ragged_append"] = ragged_append_benchmark(config, engine.max_concurrent_decodes, benchmark_loop_iters)
+
   results = collate_results(config, benchmark_results, model_size, cache_size, num_model_params)
   print_results_for_analyze(results)
   if config.inference_microbenchmark_log_file_path:
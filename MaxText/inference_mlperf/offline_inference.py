@@ -12,9 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Callable, List
+from typing import Callable, List, Sequence
 import dataclasses
-from collections import defaultdict
+from collections import defaultdict, deque
 import jax
 from jax import numpy as jnp
 import numpy as np
@@ -25,6 +25,7 @@ import threading
 import traceback
 import signal
 import random
+import time
 
 from jetstream.engine import engine_api
 
@@ -42,6 +43,135 @@ class InputData:
   true_length: int
 
 
+@dataclasses.dataclass
+class PrefillBatch:
+  """Prompts packed into a single prefill of at most max_prefill_length tokens."""
+
+  rows: List[InputData]
+
+  @property
+  def num_tokens(self) -> int:
+    return sum(row.true_length for row in self.rows)
+
+  @property
+  def padded_length(self) -> int:
+    return max(row.tokens.shape[0] for row in self.rows)
+
+
+@dataclasses.dataclass
+class SchedulerIteration:
+  """Work of one scheduler iteration: prefill batches to insert, then generate steps to run."""
+
+  prefill_batches: List[PrefillBatch]
+  decode_steps: int
+
+
+@dataclasses.dataclass
+class PhaseStats:
+  """Utilization of a phase, as used over available prefill tokens or decode slot steps."""
+
+  iterations: int = 0
+  time_sec: float = 0.0
+  used: int = 0
+  capacity: int = 0
+
+  @property
+  def utilization(self) -> float:
+    return self.used / self.capacity if self.capacity else 0.0
+
+
+class ContinuousBatchingScheduler:
+  """Decides each iteration how many queued prompts to prefill and how many generate steps to run.
+
+  Prompts are prefilled in arrival order while there are free slots and the prompt tokens of the
+  iteration stay within prefill_token_budget, and are packed first-fit into prefills of
+  max_prefill_length tokens. Generate steps run until the earliest slot reaches max_decode_length,
+  at most max_decode_steps, or a single step while prompts wait for the token budget.
+  """
+
+  def __init__(
+      self,
+      batch_size: int,
+      max_prefill_length: int,
+      max_decode_length: int,
+      *,
+      prefill_token_budget: int = 0,
+      max_decode_steps: int = 10,
+      max_prompts_per_prefill: int = 16,
+      enable_batch_prefill: bool = True,
+  ):
+    self.batch_size = batch_size
+    self.max_prefill_length = max_prefill_length
+    self.max_decode_length = max_decode_length
+    self.prefill_token_budget = prefill_token_budget or max_prefill_length
+    self.max_decode_steps = max_decode_steps
+    self.max_prompts_per_prefill = max_prompts_per_prefill if enable_batch_prefill else 1
+    self.pending = deque()
+    self.stats = {"prefill": PhaseStats(), "decode": PhaseStats()}
+
+  @property
+  def num_pending(self) -> int:
+    return len(self.pending)
+
+  def add_requests(self, rows: Sequence[InputData]):
+    self.pending.extend(rows)
+
+  def schedule(self, num_free_slots: int, decode_steps_left: Sequence[int]) -> SchedulerIteration:
+    """Returns the work of the next iteration.
+
+    Args:
+      num_free_slots: number of slots which can take a prompt.
+      decode_steps_left: remaining generate steps of each active slot.
+    """
+    rows = []
+    num_tokens = 0
+    while self.pending and len(rows) < num_free_slots:
+      row = self.pending[0]
+      if rows and num_tokens + row.true_length > self.prefill_token_budget:
+        break
+      rows.append(self.pending.popleft())
+      num_tokens += row.true_length
+    prefill_batches = self.pack(rows)
+
+    decode_steps_left = [steps for steps in decode_steps_left if steps > 0] + [self.max_decode_length] * len(rows)
+    if not decode_steps_left:
+      decode_steps = 0
+    elif self.pending and len(rows) < num_free_slots:
+      # Prompts are waiting on the token budget, prefill them after a single step.
+      decode_steps = 1
+    else:
+      decode_steps = max(1, min([self.max_decode_steps] + decode_steps_left))
+    return SchedulerIteration(prefill_batches=prefill_batches, decode_steps=decode_steps)
+
+  def pack(self, rows: Sequence[InputData]) -> List[PrefillBatch]:
+    """Packs prompts first-fit into prefill batches of max_prefill_length tokens.
+
+    insert_partial copies padded_length tokens from the start of each prompt, so every prompt but
+    the last one of a batch should start at least padded_length tokens before max_prefill_length.
+    """
+    batches = []
+    for row in rows:
+      for batch in batches:
+        padded_length = max(batch.padded_length, row.tokens.shape[0])
+        if (
+            len(batch.rows) < self.max_prompts_per_prefill
+            and batch.num_tokens + row.true_length <= self.max_prefill_length
+            and batch.num_tokens - batch.rows[-1].true_length + padded_length <= self.max_prefill_length
+        ):
+          batch.rows.append(row)
+          break
+      else:
+        batches.append(PrefillBatch(rows=[row]))
+    return batches
+
+  def record(self, phase: str, used: int, capacity: int, time_sec: float):
+    stats = self.stats[phase]
+    stats.iterations += 1
+    stats.used += used
+    stats.capacity += capacity
+    stats.time_sec += time_sec
+
+
 class JetThread(threading.Thread):
 
   def run(self):
@@ -55,7 +185,18 @@ class JetThread(threading.Thread):
 
 class OfflineInference:
 
-  def __init__(self, engine: engine_api.Engine, params, base_engine: engine_api.Engine, enable_batch_prefill: bool):
+  def __init__(
+      self,
+      engine: engine_api.Engine,
+      params,
+      base_engine: engine_api.Engine,
+      enable_batch_prefill: bool,
+      *,
+      enable_dynamic_scheduler: bool = False,
+      prefill_token_budget: int = 0,
+      max_decode_steps: int = 10,
+      max_prompts_per_prefill: int = 16,
+  ):
     self.live = False
     self.engine = engine
     self.decode_state = None
@@ -70,6 +211,12 @@ class OfflineInference:
     self.params = params
 
     self.enable_batch_prefill = enable_batch_prefill
+    self.enable_dynamic_scheduler = enable_dynamic_scheduler
+    self.prefill_token_budget = prefill_token_budget
+    self.max_decode_steps = max_decode_steps
+    # Packed prefills take the slots, start positions and true lengths of this many prompts.
+    self.max_prompts_per_prefill = max_prompts_per_prefill
+    self.scheduler_stats = None
     self.batch_size = engine.max_concurrent_decodes
     self.max_prefill_length = engine.config.max_prefill_predict_length
     self.max_decode_length = engine.config.max_target_length - engine.config.max_prefill_predict_length
@@ -107,77 +254,86 @@ class OfflineInference:
         2048,
         4096,
     ]
-    i32_scalar = jax.ShapeDtypeStruct((), int)
-
     for length in interesting_buckets:
       if length > max_length:
         break
-      log.info("Compiling prefill: %d", length)
-      input_data = jax.ShapeDtypeStruct((length,), jnp.dtype("int32"))
-
-      insert_with_layout = jax.jit(
-          self._prefill_insert,
-          in_shardings=(self.engine.param_layouts, None, None, None, self.engine.decode_state_layouts),
-          out_shardings=(
-              None,
-              self.engine.decode_state_layouts,
-          ),
-          donate_argnames=("decode_state"),
-      )
-      lowered_insert = insert_with_layout.lower(
-          self.params, input_data, i32_scalar, i32_scalar, self.engine.decode_state_shapes
-      )
-      self._cached_pref[length] = lowered_insert.compile(compiler_options=None)
+      self._compile_prefill_insert(length)
 
       if length in (64, 1024):
         continue
 
-      input_data_batch = jax.ShapeDtypeStruct((max_length,), jnp.dtype("int32"))
       min_num_prompts = max_length // length
       max_num_prompts = max_length // (length // 2)
-      possible_prompts = range(min_num_prompts, max_num_prompts)
+      possible_prompts = range(
+          min(min_num_prompts, self.max_prompts_per_prefill), min(max_num_prompts, self.max_prompts_per_prefill + 1)
+      )
       for num_prompts in possible_prompts:
-        log.info("Compiling batched prefill: %d num_prompts: %d", length, num_prompts)
-        self._cached_pref_batch[(length, num_prompts)] = (
-            jax.jit(
-                self._prefill_insert_batch,
-                in_shardings=(
-                    self.engine.param_layouts,
-                    None,
-                    None,
-                    None,
-                    None,
-                    None,
-                    None,
-                    self.engine.decode_state_layouts,
-                ),
-                out_shardings=(
-                    None,
-                    self.engine.decode_state_layouts,
-                ),
-                static_argnames=(
-                    "num_prompts",
-                    "padded_length",
-                ),
-                donate_argnames=("decode_state",),
-            )
-            .lower(
-                self.params,
-                input_data_batch,
-                jnp.arange(0, 16, dtype=int),
-                num_prompts,
-                jnp.arange(0, max_length, dtype=int),
-                jnp.ones(max_length, dtype=int),
-                jnp.arange(0, max_length, 64, dtype=int),
-                length,
-                jnp.full(16, length, dtype=int),
-                self.engine.decode_state_shapes,
-            )
-            .compile(compiler_options=None)
-        )
+        self._compile_prefill_insert_batch(length, num_prompts, max_length)
 
     self.batch_inference(warmup_samples, desc="warmup")
 
+  def _compile_prefill_insert(self, length):
+    log.info("Compiling prefill: %d", length)
+    i32_scalar = jax.ShapeDtypeStruct((), int)
+    input_data = jax.ShapeDtypeStruct((length,), jnp.dtype("int32"))
+
+    insert_with_layout = jax.jit(
+        self._prefill_insert,
+        in_shardings=(self.engine.param_layouts, None, None, None, self.engine.decode_state_layouts),
+        out_shardings=(
+            None,
+            self.engine.decode_state_layouts,
+        ),
+        donate_argnames=("decode_state"),
+    )
+    lowered_insert = insert_with_layout.lower(
+        self.params, input_data, i32_scalar, i32_scalar, self.engine.decode_state_shapes
+    )
+    self._cached_pref[length] = lowered_insert.compile(compiler_options=None)
+    return self._cached_pref[length]
+
+  def _compile_prefill_insert_batch(self, length, num_prompts, max_length):
+    log.info("Compiling batched prefill: %d num_prompts: %d", length, num_prompts)
+    input_data_batch = jax.ShapeDtypeStruct((max_length,), jnp.dtype("int32"))
+    self._cached_pref_batch[(length, num_prompts)] = (
+        jax.jit(
+            self._prefill_insert_batch,
+            in_shardings=(
+                self.engine.param_layouts,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
+                self.engine.decode_state_layouts,
+            ),
+            out_shardings=(
+                None,
+                self.engine.decode_state_layouts,
+            ),
+            static_argnames=(
+                "num_prompts",
+                "padded_length",
+            ),
+            donate_argnames=("decode_state",),
+        )
+        .lower(
+            self.params,
+            input_data_batch,
+            jnp.arange(0, self.max_prompts_per_prefill, dtype=int),
+            num_prompts,
+            jnp.arange(0, max_length, dtype=int),
+            jnp.ones(max_length, dtype=int),
+            jnp.arange(0, max_length, 64, dtype=int),
+            length,
+            jnp.full(self.max_prompts_per_prefill, length, dtype=int),
+            self.engine.decode_state_shapes,
+        )
+        .compile(compiler_options=None)
+    )
+    return self._cached_pref_batch[(length, num_prompts)]
+
   def _prefill_insert(self, params, tokens, slot, true_length, decode_state):
     """return decodestate."""
     padded_len = tokens.shape[0]
@@ -231,20 +387,40 @@ class OfflineInference:
     token.
     """
 
-    def prefill(prefill_bucket, prefill_len):
+    # Tokens generated by each slot in dummy mode, reset by prefill and reported by generate before its step
+    # like generated_tokens of the engine.
+    dummy_lengths = np.zeros(self.batch_size, dtype=np.int32)
+
+    def prefill(prefill_bucket, prefill_len, packed=None):
       nonlocal self
       if self.dummy:
         log.info("dummy prefill")
-        return 123
-      if (
-          not self.enable_batch_prefill
-          or prefill_len == self.max_prefill_length
-          or prefill_len * len(prefill_bucket) < self.max_prefill_length
-      ):
+        prefill_result = []
+        for slot, row in prefill_bucket:
+          dummy_lengths[slot] = 0
+          first_token = engine_api.ResultTokens(
+              data=np.array([[123, 1, 0]]),
+              tokens_idx=(0, 0),
+              valid_idx=(0, 0),
+              length_idx=(0, 0),
+              samples_per_slot=(0, 0),
+          )
+          prefill_result.append((first_token, slot, row))
+        return prefill_result
+      if packed is None:
+        packed = (
+            self.enable_batch_prefill
+            and prefill_len != self.max_prefill_length
+            and prefill_len * len(prefill_bucket) >= self.max_prefill_length
+        )
+      if not packed:
         prefill_result = []
         prefill_fn = self._prefill_insert
         if (cached := self._cached_pref.get(prefill_len)) is not None:
           prefill_fn = cached
+        elif self.enable_dynamic_scheduler:
+          # The scheduler packs lengths and numbers of prompts not seen in warmup, compile them on first use.
+          prefill_fn = self._compile_prefill_insert(prefill_len)
         else:
           assert False, "prefill fn not found"
 
@@ -280,14 +456,16 @@ class OfflineInference:
             array_to_pad.extend([0] * (pad_len - len(array_to_pad)))
           return jnp.array(array_to_pad)
 
-        slots = pad_num_prompts_len_array(slots, 16)
-        true_lengths = pad_num_prompts_len_array(true_lengths, 16)
-        start_pos = pad_num_prompts_len_array(start_pos, 16)
+        slots = pad_num_prompts_len_array(slots, self.max_prompts_per_prefill)
+        true_lengths = pad_num_prompts_len_array(true_lengths, self.max_prompts_per_prefill)
+        start_pos = pad_num_prompts_len_array(start_pos, self.max_prompts_per_prefill)
 
         prefill_fn = self._prefill_insert_batch
         log.info("invoking compiled function with length %d num_prompts %d", prefill_len, num_prompts)
         if (cached := self._cached_pref_batch.get((prefill_len, num_prompts))) is not None:
           prefill_fn = cached
+        elif self.enable_dynamic_scheduler:
+          prefill_fn = self._compile_prefill_insert_batch(prefill_len, num_prompts, self.max_prefill_length)
         else:
           assert False, "prefill batch not found"
 
@@ -305,9 +483,9 @@ class OfflineInference:
 
         return prefill_result
 
-    def prefill_batch(prefill_bucket, padded_len):
+    def prefill_batch(prefill_bucket, padded_len, packed=None):
       nonlocal self
-      prefill_results = prefill(prefill_bucket, padded_len)
+      prefill_results = prefill(prefill_bucket, padded_len, packed)
       for _first_token, _slot, _row in prefill_results:
         log.info(
             "Put row of len %d true length %d slot %s to detokenize backlog", _row.tokens.shape[0], _row.true_length, _slot
@@ -315,26 +493,28 @@ class OfflineInference:
         self.detokenize_backlog.put((_first_token, True, _row.id, _slot), block=True)
 
     empty_slots = list(range(self.batch_size))
+    # Notified by detokenize whenever it frees slots.
+    slots_freed = threading.Condition()
     slot_to_id = {}
     num_prefills = {}
     num_decodes = 0
 
-    dummy_length = 1
-
-    def decode():
+    def decode(num_steps=self.max_decode_steps):
       nonlocal self
-      nonlocal dummy_length
       if self.dummy:
         log.info("Dummy generate")
-        res = engine_api.ResultTokens(
-            data=np.array([[123, 1, dummy_length]] * self.batch_size),
-            tokens_idx=(0, 0),
-            valid_idx=(0, 0),
-            length_idx=(0, 0),
-            samples_per_slot=(0, 0),
-        )
-        dummy_length += 1
-        self.decode_state, result_tokens = self.decode_state, res
+        result_tokens_l = []
+        for _ in range(num_steps):
+          result_tokens_l.append(
+              engine_api.ResultTokens(
+                  data=np.stack([np.full(self.batch_size, 123), np.ones(self.batch_size, dtype=int), dummy_lengths], axis=1),
+                  tokens_idx=(0, 0),
+                  valid_idx=(0, 0),
+                  length_idx=(0, 0),
+                  samples_per_slot=(0, 0),
+              )
+          )
+          dummy_lengths[:] += 1
       else:
         gen_fn = self.engine.generate
         if self._cached_generate is not None:
@@ -342,10 +522,10 @@ class OfflineInference:
         else:
           assert False, "no generate fn"
         result_tokens_l = []
-        for i in range(10):
+        for i in range(num_steps):
           self.decode_state, result_tokens = gen_fn(self.params, self.decode_state, None)
           result_tokens_l.append(result_tokens)
-      for i in range(10):
+      for i in range(num_steps):
         # result_tokens.copy_to_host_async()
         result_tokens = result_tokens_l[i].convert_to_numpy()
         self.detokenize_backlog.put((result_tokens, False, 0, 0), block=True)
@@ -359,6 +539,8 @@ class OfflineInference:
         # log.info("Detokenize start")
         newly_empty = []
         result_tokens, is_first_token, row_id, _slot = self.detokenize_backlog.get(block=True)
+        if result_tokens is None:
+          break
         # result_tokens = result_tokens.convert_to_numpy()
         # log.info("Detokenize get from queue")
         if is_first_token:
@@ -367,7 +549,9 @@ class OfflineInference:
           if not should_terminate:
             slot_to_id[_slot] = row_id
           else:
-            empty_slots.append(_slot)
+            with slots_freed:
+              empty_slots.append(_slot)
+              slots_freed.notify()
           continue
         for slot, id_ in slot_to_id.items():
           token, is_valid, length = result_tokens.data[slot]
@@ -375,14 +559,26 @@ class OfflineInference:
           should_finish = False
           if is_valid:
             should_finish = emit_token(id_, token.item())
+          # generate reports the tokens generated before its step, so the last of the max_decode_length steps
+          # the dynamic scheduler runs per slot reports max_decode_length - 1
+          if self.enable_dynamic_scheduler:
+            length += 1
           if should_finish or length >= self.max_decode_length:
             newly_empty.append(slot)
             log.debug("Detokenize free up %s, length %d", slot, length)
         # Add slots of those that are empty to empty
-        for slot in newly_empty:
-          del slot_to_id[slot]
-          empty_slots.append(slot)
-        if newly_empty and self.detokenize_backlog.qsize() == 0 and len(slot_to_id.items()) == 0:
+        with slots_freed:
+          for slot in newly_empty:
+            del slot_to_id[slot]
+            empty_slots.append(slot)
+          slots_freed.notify()
+        # With the dynamic scheduler more prompts may still be inserted, it stops detokenize explicitly.
+        if (
+            not self.enable_dynamic_scheduler
+            and newly_empty
+            and self.detokenize_backlog.qsize() == 0
+            and len(slot_to_id.items()) == 0
+        ):
           break
 
     detokenize_thread = JetThread(
@@ -393,6 +589,13 @@ class OfflineInference:
     )
     self.live = True
     detokenize_thread.start()
+    if self.enable_dynamic_scheduler:
+      self._run_scheduler(data, prefill_batch, decode, empty_slots, slots_freed=slots_freed, desc=desc)
+      self.detokenize_backlog.put((None, False, 0, 0), block=True)
+      self.live = False
+      detokenize_thread.join()
+      return
+
     total_num_prefills = 0
     for row in data:
       while not empty_slots:
@@ -437,7 +640,11 @@ class OfflineInference:
       self.prefill_buckets[padded_len].append((slot, row))
       prefill_buckets_len = {k: len(self.prefill_buckets[k]) for k in self.prefill_buckets}
       log.debug("prefill buckets %d", prefill_buckets_len)
-      if len(self.prefill_buckets[padded_len]) * padded_len >= self.max_prefill_length:
+      if len(self.prefill_buckets[padded_len]) == self.max_prompts_per_prefill:
+        # The packed prefill can't take another prompt
+        prefill_batch(self.prefill_buckets[padded_len], padded_len)
+        self.prefill_buckets[padded_len] = []
+      elif len(self.prefill_buckets[padded_len]) * padded_len >= self.max_prefill_length:
         total_true_len = sum((row.true_length for (slot, row) in self.prefill_buckets[padded_len]))
         # Can't hold another buffer, prefill right away
         if self.max_prefill_length - padded_len // 2 < total_true_len <= self.max_prefill_length:
@@ -473,6 +680,67 @@ class OfflineInference:
     detokenize_thread.join()
     log.info("summary-%s-prefills-%d-decodes-%d completed.", desc, num_prefills, num_decodes)
 
+  def _run_scheduler(self, data, prefill_batch, decode, empty_slots, *, slots_freed, desc):
+    """Alternates prefills and generate steps as decided by ContinuousBatchingScheduler until all prompts finish."""
+    scheduler = ContinuousBatchingScheduler(
+        batch_size=self.batch_size,
+        max_prefill_length=self.max_prefill_length,
+        max_decode_length=self.max_decode_length,
+        prefill_token_budget=self.prefill_token_budget,
+        max_decode_steps=self.max_decode_steps,
+        max_prompts_per_prefill=self.max_prompts_per_prefill,
+        enable_batch_prefill=self.enable_batch_prefill,
+    )
+    scheduler.add_requests(data)
+    # Generate steps left of the slots holding a prompt, slots are freed by detokenize.
+    decode_steps_left = {}
+    while True:
+      free_slots = set(empty_slots)
+      decode_steps_left = {slot: steps for slot, steps in decode_steps_left.items() if slot not in free_slots}
+      if not scheduler.num_pending and not decode_steps_left:
+        break
+      iteration = scheduler.schedule(len(free_slots), list(decode_steps_left.values()))
+
+      if iteration.prefill_batches:
+        start = time.perf_counter()
+        used, capacity = 0, 0
+        for batch in iteration.prefill_batches:
+          prefill_bucket = [(empty_slots.pop(), row) for row in batch.rows]
+          packed = len(batch.rows) > 1
+          prefill_batch(prefill_bucket, batch.padded_length, packed)
+          for slot, _ in prefill_bucket:
+            decode_steps_left[slot] = self.max_decode_length
+          used += batch.num_tokens
+          capacity += self.max_prefill_length if packed else batch.padded_length
+        scheduler.record("prefill", used, capacity, time.perf_counter() - start)
+
+      if iteration.decode_steps:
+        start = time.perf_counter()
+        decode(iteration.decode_steps)
+        scheduler.record(
+            "decode",
+            len(decode_steps_left) * iteration.decode_steps,
+            self.batch_size * iteration.decode_steps,
+            time.perf_counter() - start,
+        )
+        for slot in decode_steps_left:
+          decode_steps_left[slot] -= iteration.decode_steps
+      elif not iteration.prefill_batches:
+        # All slots finished generating, wait for detokenize to free them.
+        with slots_freed:
+          slots_freed.wait_for(lambda: len(empty_slots) > len(free_slots))
+
+    self.scheduler_stats = scheduler.stats
+    for phase, stats in scheduler.stats.items():
+      log.info(
+          "summary-%s-%s iterations %d time %.3fs utilization %.3f",
+          desc,
+          phase,
+          stats.iterations,
+          stats.time_sec,
+          stats.utilization,
+      )
+
   def batch_inference(self, data: List[InputData], desc=""):
     """data is list of obj with id, tokens, and true length"""
     data_dict = defaultdict(list)
@@ -142,6 +142,35 @@ flags.DEFINE_bool(
     required=False,
 )
 
+flags.DEFINE_bool(
+    "enable_dynamic_scheduler",
+    False,
+    "If set, schedule prefills and generate steps from free slots and a prefill token budget "
+    "instead of fixed prefill buckets.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "prefill_token_budget",
+    0,
+    "Max prompt tokens prefilled per iteration of the dynamic scheduler, 0 for the max prefill length.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "max_decode_steps",
+    10,
+    "Max generate steps run between prefills.",
+    required=False,
+)
+
+flags.DEFINE_integer(
+    "max_prompts_per_prefill",
+    16,
+    "Max prompts packed in one prefill with enable_batch_prefill.",
+    required=False,
+)
+
 flags.DEFINE_bool(
     "skip_warmup",
     False,
@@ -469,7 +498,16 @@ def main(argv):
         max_target_length=target_length,
         args_str=FLAGS.maxengine_args,
     )
-    offline_inf = offline_inference.OfflineInference(engine, params, base_engine, FLAGS.enable_batch_prefill)
+    offline_inf = offline_inference.OfflineInference(
+        engine,
+        params,
+        base_engine,
+        FLAGS.enable_batch_prefill,
+        enable_dynamic_scheduler=FLAGS.enable_dynamic_scheduler,
+        prefill_token_budget=FLAGS.prefill_token_budget,
+        max_decode_steps=FLAGS.max_decode_steps,
+        max_prompts_per_prefill=FLAGS.max_prompts_per_prefill,
+    )
     if params is None and offline_inf.params is not None:
       base_engine = engine
     params = offline_inf.params
@@ -52,7 +52,7 @@ def str2bool(v: str) -> bool:
     raise ValueError(f"Invalid value '{v}'!")
 
 
-def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0):
+def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0, nucleus_candidates=0):
   """
   logits: unnormalized logits to sample, shaped [YOUR_LEADING_DIMS, Vocab], before logit
   rng: rng key to use
@@ -60,34 +60,65 @@ def sampling(logits, rng, algorithm, topk=0, nucleus_topp=0, temperature=1.0):
   topk: restricting to topk logits before sampling
   nucleus_topp: restricting to p probability mass before sampling
   temperature: temperature parameter for scaling probability
+  nucleus_candidates: number of top logits searching the nucleus before sorting the whole vocabulary, 0 to always sort
   """
   if algorithm == "greedy":
     return jnp.argmax(logits, axis=-1)
   elif algorithm == "weighted":
     return jax.random.categorical(rng, logits / temperature)
   elif algorithm == "nucleus":
-    return sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng)
+    return sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng, nucleus_candidates)
   elif algorithm == "topk":
     return sample_topk_logits(logits, topk, temperature, rng)
   else:
     raise ValueError(f"Sampling {algorithm=} not supported!")
 
 
-def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng):
+def sample_nucleus_topp_logits(logits, nucleus_topp, temperature, rng, nucleus_candidates=0):
   """Restrict sampling to the top logits with cumulative probability >= nucleus_topp.
 
   The nucleus sampling method is proposed in the paper `The Curious Case of
   Neural Text Degeneration (https://arxiv.org/pdf/1904.09751.pdf)`
 
+  With nucleus_candidates > 0, the nucleus is searched in the top nucleus_candidates
+  logits, normalized over the whole vocabulary, and the vocabulary is only sorted when
+  they don't cover nucleus_topp. The candidates are the exact top logits, so the nucleus
+  is the same as with a full sort. The fallback is taken for the whole batch as soon as
+  one row's nucleus is not covered, so a batch mixing peaked and flat distributions
+  pays for both the top-k and the full sort.
   """
   if nucleus_topp < 0:
     raise ValueError("Can't apply nucleus with parameter {nucleus_topp=} less zero")
+  if 0 < nucleus_candidates < logits.shape[-1]:
+    cutoff_logit = _nucleus_cutoff_logit_from_candidates(logits, nucleus_topp, nucleus_candidates)
+  else:
+    cutoff_logit = _nucleus_cutoff_logit(logits, nucleus_topp)
+  logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
+  return jax.random.categorical(rng, logits / temperature)
+
+
+def _nucleus_cutoff_logit(logits, nucleus_topp):
+  """Smallest logit of the nucleus, by sorting the whole vocabulary."""
   logits_sorted = jnp.sort(logits, axis=-1)[..., ::-1]  # sort descending
   sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)  # get cumsum probs
   cutoff_index = jnp.sum(sorted_cum_probs < nucleus_topp, axis=-1, keepdims=True)  # find cutoff index
-  cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
-  logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
-  return jax.random.categorical(rng, logits / temperature)
+  return jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
+
+
+def _nucleus_cutoff_logit_from_candidates(logits, nucleus_topp, nucleus_candidates):
+  """Smallest logit of the nucleus, searched in the top candidates with a fallback to a full sort."""
+  # exact top-k, jax.lax.approx_max_k may miss some of the top logits on TPU and shift the cutoff
+  candidates, _ = jax.lax.top_k(logits, nucleus_candidates)
+  log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+  candidates_cum_probs = jnp.cumsum(jnp.exp(candidates - log_normalizer), axis=-1)
+  cutoff_index = jnp.sum(candidates_cum_probs < nucleus_topp, axis=-1, keepdims=True)
+  # a single predicate for the batch, if any row needs more than the candidates every row is sorted
+  covered = jnp.all(cutoff_index < nucleus_candidates)
+  return jax.lax.cond(
+      covered,
+      lambda: jnp.take_along_axis(candidates, jnp.minimum(cutoff_index, nucleus_candidates - 1), axis=-1),
+      lambda: _nucleus_cutoff_logit(logits, nucleus_topp),
+  )
 
 
 def sample_topk_logits(logits, topk, temperature, rng):
@@ -98,3 +129,85 @@ def sample_topk_logits(logits, topk, temperature, rng):
   topk_token = jnp.expand_dims(jax.random.categorical(rng, topk_logits / temperature).astype(jnp.int32), axis=-1)
   sampled_tokens = jnp.squeeze(jnp.take_along_axis(topk_idxs, topk_token, axis=-1), axis=-1).astype(jnp.int32)
   return sampled_tokens
+
+
+def make_sampling_params(algorithm, topk=0, nucleus_topp=0, temperature=1.0, seed=-1, batch_size=1):
+  """Per-slot sampling parameters for sampling_per_slot, equivalent to sampling with the same arguments.
+
+  algorithm: string representing supported algorithms
+  topk: restricting to topk logits before sampling
+  nucleus_topp: restricting to p probability mass before sampling
+  temperature: temperature parameter for scaling probability
+  seed: seed of the request for reproducible sampling, negative to use the engine rng
+  batch_size: number of slots
+
+  Returns a dict of arrays shaped [batch_size] with keys temperature, top_k, top_p and seed.
+  Temperature 0 is greedy, top_k 0 and top_p 1 disable the restriction.
+  """
+  if algorithm == "greedy":
+    temperature, topk, nucleus_topp = 0.0, 0, 1.0
+  elif algorithm == "weighted":
+    topk, nucleus_topp = 0, 1.0
+  elif algorithm == "nucleus":
+    if nucleus_topp < 0:
+      raise ValueError(f"Can't apply nucleus with parameter {nucleus_topp=} less zero")
+    topk = 0
+  elif algorithm == "topk":
+    if topk <= 0:
+      raise ValueError(f"Can't apply algorithm topk with parameter {topk=} less than or equal to zero")
+    nucleus_topp = 1.0
+  else:
+    raise ValueError(f"Sampling {algorithm=} not supported!")
+  return {
+      "temperature": jnp.full((batch_size,), temperature, dtype=jnp.float32),
+      "top_k": jnp.full((batch_size,), topk, dtype=jnp.int32),
+      "top_p": jnp.full((batch_size,), nucleus_topp, dtype=jnp.float32),
+      "seed": jnp.full((batch_size,), seed, dtype=jnp.int32),
+  }
+
+
+def sampling_per_slot(logits, rng, sampling_params, steps):
+  """Samples every slot with its own parameters, so one batch can mix sampling algorithms.
+
+  logits: unnormalized logits to sample, shaped [batch, YOUR_LEADING_DIMS, Vocab]
+  rng: rng key used by slots without a seed
+  sampling_params: dict of per-slot arrays shaped [batch], see make_sampling_params
+  steps: number of tokens generated by each slot, shaped [batch], folded into seeded rngs
+  """
+  batch_size = logits.shape[0]
+  seeds = sampling_params["seed"]
+  seeded_rngs = jax.vmap(lambda seed, step: jax.random.fold_in(jax.random.PRNGKey(seed), step))(
+      jnp.maximum(seeds, 0), jnp.reshape(steps, (batch_size,))
+  )
+  rngs = jnp.where((seeds >= 0)[:, None], seeded_rngs, jax.random.split(rng, batch_size))
+  return jax.vmap(_sample_slot)(
+      logits,
+      rngs,
+      sampling_params["temperature"],
+      sampling_params["top_k"],
+      sampling_params["top_p"],
+  )
+
+
+def _sample_slot(logits, rng, temperature, topk, nucleus_topp):
+  """Applies top-k, top-p and temperature of one slot with a single sort of the vocabulary.
+
+  As in sample_topk_logits and sample_nucleus_topp_logits, top-k and top-p restrict the unscaled
+  logits and the temperature only scales the logits kept.
+  """
+  logits = logits.astype(jnp.float32)
+  vocab_size = logits.shape[-1]
+  logits_sorted = jnp.sort(logits, axis=-1)[..., ::-1]  # sort descending
+  # top-k: keep the best topk logits, the nucleus is computed over the remaining ones.
+  logits_sorted = jnp.where(
+      jnp.logical_or(topk <= 0, jnp.arange(vocab_size) < topk), logits_sorted, jnp.full_like(logits_sorted, NEG_INF)
+  )
+  topk_index = jnp.full(logits.shape[:-1] + (1,), jnp.clip(topk - 1, 0, vocab_size - 1))
+  topk_logit = jnp.where(topk > 0, jnp.take_along_axis(logits_sorted, topk_index, axis=-1), NEG_INF)
+  sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)
+  cutoff_index = jnp.minimum(jnp.sum(sorted_cum_probs < nucleus_topp, axis=-1, keepdims=True), vocab_size - 1)
+  cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
+  cutoff_logit = jnp.where(nucleus_topp < 1.0, jnp.maximum(cutoff_logit, topk_logit), topk_logit)
+  logits_kept = jnp.where(logits < cutoff_logit, jnp.full_like(logits, NEG_INF), logits)
+  sampled_tokens = jax.random.categorical(rng, logits_kept / jnp.where(temperature > 0, temperature, 1.0)).astype(jnp.int32)
+  return jnp.where(temperature > 0, sampled_tokens, jnp.argmax(logits, axis=-1).astype(jnp.int32))
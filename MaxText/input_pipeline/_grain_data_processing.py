@@ -28,6 +28,7 @@ from MaxText.input_pipeline import _grain_tokenizer
 
 from MaxText import multihost_dataloading
 from MaxText import max_logging
+from MaxText import sequence_packing
 from MaxText import tokenizer
 
 
@@ -88,6 +89,7 @@ def pretrain_preprocessing_pipeline(dataset, config, data_columns, tokenize, gra
       config.add_eos,
       config.hf_access_token,
       config.dataset_type,
+      encode_cache_size=config.tokenizer_encode_cache_size,
   )
   if tokenizer_model.pad_id is not None:
     pad_id = tokenizer_model.pad_id
@@ -96,7 +98,19 @@ def pretrain_preprocessing_pipeline(dataset, config, data_columns, tokenize, gra
   else:
     pad_id = -1
 
-  if tokenize:
+  if tokenize and config.document_chunking:
+    dataset = grain.experimental.FlatMapIterDataset(
+        dataset,
+        _grain_tokenizer.TokenizeAndChunk(
+            data_columns,
+            config.max_target_length,
+            config.add_bos,
+            config.add_eos,
+            tokenizer_model,
+            chunk_overlap=config.document_chunk_overlap,
+        ),
+    )
+  elif tokenize:
     dataset = dataset.map(
         _grain_tokenizer.TokenizeAndTrim(
             data_columns, config.max_target_length, config.add_bos, config.add_eos, tokenizer_model
@@ -104,7 +118,12 @@ def pretrain_preprocessing_pipeline(dataset, config, data_columns, tokenize, gra
     )
 
   # Pack and Batch examples.
-  if config.packing:
+  if config.packing and config.packing_strategy == "best_fit":
+    packer = sequence_packing.BestFitPacker(
+        {col: config.max_target_length for col in data_columns}, config.packing_window_size, pad_id
+    )
+    dataset = _input_pipeline_utils.BestFitPackIterDataset(dataset, packer)
+  elif config.packing:
     length_struct = {col: config.max_target_length for col in data_columns}
     dataset = grain.experimental.FirstFitPackIterDataset(dataset, length_struct=length_struct, num_packing_bins=30)
     rekey_dict = {
@@ -141,6 +160,7 @@ def dpo_preprocessing_pipeline(dataset, config, data_columns, tokenize, grain_wo
       config.add_eos,
       config.hf_access_token,
       config.dataset_type,
+      encode_cache_size=config.tokenizer_encode_cache_size,
   )
   if tokenizer_model.pad_id is not None:
     pad_id = tokenizer_model.pad_id
@@ -196,7 +216,9 @@ def make_grain_train_iterator(
           tokenize=config.tokenize_train_data,
           grain_worker_count=config.grain_worker_count,
       )
-    return multihost_dataloading.MultiHostDataLoadIterator(train_dataloader, global_mesh)
+    return multihost_dataloading.MultiHostDataLoadIterator(
+        train_dataloader, global_mesh, prefetch_depth=config.data_prefetch_depth
+    )
   else:
     get_ds_fn = functools.partial(
         get_datasets,
@@ -262,7 +284,9 @@ def make_grain_eval_iterator(
           tokenize=config.tokenize_eval_data,
           grain_worker_count=config.grain_worker_count_eval,
       )
-    return multihost_dataloading.MultiHostDataLoadIterator(eval_dataloader, global_mesh)
+    return multihost_dataloading.MultiHostDataLoadIterator(
+        eval_dataloader, global_mesh, prefetch_depth=config.eval_data_prefetch_depth
+    )
   else:
     get_ds_fn = functools.partial(
         get_datasets,
@@ -27,7 +27,11 @@ from MaxText import tokenizer
 
 @dataclasses.dataclass
 class TokenizeAndTrim(grain.MapTransform):
-  """Tokenize and trim features to sequence length."""
+  """Tokenize and trim features to sequence length.
+
+  Features aliasing the same text, e.g. inputs and targets rekeyed from text, are encoded once
+  and share the token array.
+  """
 
   # pylint: disable=attribute-defined-outside-init
   feature_names: str | Sequence[str]
@@ -44,16 +48,42 @@ class TokenizeAndTrim(grain.MapTransform):
     if isinstance(self.sequence_length, int):
       self.sequence_length = [self.sequence_length] * len(self.feature_names)
 
-  def map(self, features: dict[str, Any]) -> dict[str, Any]:
-    """Maps to each element."""
+  def _get_processor(self):
     if self._processor is None:
       with self._initialize_processor_lock:
         if self._processor is None:  # Ensures only one thread initializes SPP.
           self._processor = self.tokenizer
+    return self._processor
+
+  def _encode_features(self, features: dict[str, Any], num_tokens: dict[int, int] | None = None) -> dict[int, np.ndarray]:
+    """Encodes each distinct text of the features once, keyed by the id of the text.
+
+    Texts much longer than their num_tokens are encoded with encode_prefix, the others with a single encode_batch call.
+    """
+    processor = self._get_processor()
+    texts = {}
+    for feature_name in self.feature_names:
+      texts.setdefault(id(features[feature_name]), features[feature_name])
+    prefix_ids, batch_ids = [], []
+    for text_id, text in texts.items():
+      if num_tokens is not None and len(text) > num_tokens[text_id] * tokenizer.ENCODE_PREFIX_CHARS_PER_TOKEN:
+        prefix_ids.append(text_id)
+      else:
+        batch_ids.append(text_id)
+    encoded = {text_id: tokenizer.encode_prefix(processor, texts[text_id], num_tokens[text_id]) for text_id in prefix_ids}
+    if batch_ids:
+      encoded.update(zip(batch_ids, processor.encode_batch([texts[text_id] for text_id in batch_ids])))
+    return {text_id: np.asarray(token_ids, dtype=np.int32) for text_id, token_ids in encoded.items()}
+
+  def map(self, features: dict[str, Any]) -> dict[str, Any]:
+    """Maps to each element."""
+    num_tokens = {}
+    for feature_name, sequence_length in zip(self.feature_names, self.sequence_length, strict=True):
+      text_id = id(features[feature_name])
+      num_tokens[text_id] = max(num_tokens.get(text_id, 0), sequence_length)
+    encoded = self._encode_features(features, num_tokens)
     for feature_name, sequence_length in zip(self.feature_names, self.sequence_length, strict=True):
-      text = features[feature_name]
-      token_ids = self._processor.encode(text)[:sequence_length]
-      features[feature_name] = np.asarray(token_ids, dtype=np.int32)
+      features[feature_name] = encoded[id(features[feature_name])][:sequence_length]
     return features
 
   def __getstate__(self):
@@ -66,3 +96,33 @@ class TokenizeAndTrim(grain.MapTransform):
     self.__dict__.update(state)
     self._processor = None
     self._initialize_processor_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class TokenizeAndChunk(TokenizeAndTrim, grain.experimental.FlatMapTransform):
+  """Tokenize features and split them into consecutive sequence_length windows instead of trimming.
+
+  Consecutive windows share chunk_overlap tokens. All features are split at the same offsets, and
+  features aliasing the same text share the tokens as in TokenizeAndTrim.
+  """
+
+  chunk_overlap: int = 0
+
+  def __post_init__(self):
+    super().__post_init__()
+    if not isinstance(self.sequence_length, int):
+      self.sequence_length = max(self.sequence_length)
+    if not 0 <= self.chunk_overlap < self.sequence_length:
+      raise ValueError(f"chunk_overlap should be in [0, {self.sequence_length}), but got {self.chunk_overlap}.")
+
+  def flat_map(self, features: dict[str, Any]) -> list[dict[str, Any]]:
+    """Splits each element into chunks."""
+    encoded = self._encode_features(features)
+    num_tokens = max(len(token_ids) for token_ids in encoded.values())
+    stride = self.sequence_length - self.chunk_overlap
+    # Every window after the first one starts with at least one token not in the previous window.
+    starts = range(0, max(num_tokens - self.chunk_overlap, 1), stride)
+    return [
+        features | {name: encoded[id(features[name])][start : start + self.sequence_length] for name in self.feature_names}
+        for start in starts
+    ]
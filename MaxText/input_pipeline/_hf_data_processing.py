@@ -25,6 +25,7 @@ import numpy as np
 
 from MaxText.input_pipeline import _input_pipeline_utils
 from MaxText import multihost_dataloading
+from MaxText import sequence_packing
 
 
 def preprocessing_pipeline(
@@ -43,6 +44,8 @@ def preprocessing_pipeline(
     add_bos=True,
     add_eos=True,
     packing=True,
+    packing_strategy="greedy",
+    packing_window_size=512,
     shift=True,
     num_threads=1,
     drop_remainder=False,
@@ -50,7 +53,8 @@ def preprocessing_pipeline(
     use_dpo=None,
     use_sft=None,
     sft_train_on_completion_only=True,
-    grain_worker_count=1,  # only support 0 or 1
+    grain_worker_count=1,
+    prefetch_depth=0,
 ):
   """pipeline for preprocessing HF dataset"""
 
@@ -123,6 +127,7 @@ def preprocessing_pipeline(
       generate_padding_example,
       max_target_length,
       data_column_names,
+      grain_worker_count,
   )
   operations = []
   if use_sft:
@@ -147,7 +152,16 @@ def preprocessing_pipeline(
     operations.append(_input_pipeline_utils.HFNormalizeFeatures(data_column_names[0]))
     data_column_names = ("inputs", "targets")
 
-  if packing and not use_dpo:
+  if packing and not use_dpo and packing_strategy == "best_fit":
+    operations.append(
+        _input_pipeline_utils.BestFitPackAndBatchOperation(
+            packer=sequence_packing.BestFitPacker(
+                {col: max_target_length for col in data_column_names}, packing_window_size, pad_id
+            ),
+            batch_size=global_batch_size // jax.process_count(),
+        )
+    )
+  elif packing and not use_dpo:
     length_struct = {col: max_target_length for col in data_column_names}
     operations.append(
         grain.experimental.PackAndBatchOperation(
@@ -180,12 +194,12 @@ def preprocessing_pipeline(
       data_source=dataset,
       operations=operations,
       sampler=dummy_index_sampler,
-      worker_count=grain_worker_count,  # only supports <=1 for now, more workers results in duplicated data
+      worker_count=grain_worker_count,
       worker_buffer_size=1,
       read_options=grain.ReadOptions(num_threads=num_threads, prefetch_buffer_size=128),
   )
 
-  multihost_gen = multihost_dataloading.MultiHostDataLoadIterator(dataloader, global_mesh)
+  multihost_gen = multihost_dataloading.MultiHostDataLoadIterator(dataloader, global_mesh, prefetch_depth=prefetch_depth)
 
   # Return multi-host jax.Array prep iterator
   return multihost_gen
@@ -221,10 +235,14 @@ def make_hf_train_iterator(
       add_bos=config.add_bos,
       add_eos=config.add_eos,
       packing=config.packing,
+      packing_strategy=config.packing_strategy,
+      packing_window_size=config.packing_window_size,
       generate_padding_example=False,
       use_dpo=config.use_dpo,
       use_sft=config.use_sft,
       sft_train_on_completion_only=config.sft_train_on_completion_only,
+      grain_worker_count=config.grain_worker_count,
+      prefetch_depth=config.data_prefetch_depth,
   )
   return train_iter
 
@@ -263,9 +281,13 @@ def make_hf_eval_iterator(
       add_bos=config.add_bos,
       add_eos=config.add_eos,
       packing=config.packing,
+      packing_strategy=config.packing_strategy,
+      packing_window_size=config.packing_window_size,
       generate_padding_example=eval_generate_padding_example,
       use_dpo=config.use_dpo,
       use_sft=config.use_sft,
       sft_train_on_completion_only=config.sft_train_on_completion_only,
+      grain_worker_count=config.grain_worker_count_eval,
+      prefetch_depth=config.eval_data_prefetch_depth,
   )
   return eval_iter
@@ -17,15 +17,17 @@ limitations under the License.
 """Operations used by Grain"""
 
 import dataclasses
+import itertools
+import threading
 import warnings
 from typing import Dict
-from threading import current_thread
 import datasets
 from datasets.distributed import split_dataset_by_node
 import grain.python as grain
 import numpy as np
 import tensorflow as tf
 from MaxText import max_logging
+from MaxText import sequence_packing
 from MaxText import tokenizer
 
 Features = Dict[str, tf.Tensor]
@@ -120,7 +122,11 @@ def extract_messages_and_mask(example, data_column_name):
 def tokenization(example, hf_tokenizer, truncation, max_length, column_names):
   """Tokenize a HuggingFace dataset"""
   for column_name in column_names:
-    if isinstance(example[column_name], list):
+    if isinstance(example[column_name], list) and all(isinstance(x, str) for x in example[column_name]):
+      # A batch of strings is encoded with a single call to the native batch encoding.
+      if example[column_name]:
+        example[column_name] = hf_tokenizer(example[column_name], truncation=truncation, max_length=max_length)["input_ids"]
+    elif isinstance(example[column_name], list):
       example[column_name] = [
           hf_tokenizer(x, truncation=truncation, max_length=max_length)["input_ids"] for x in example[column_name]
       ]
@@ -181,7 +187,15 @@ class HFNormalizeFeatures(grain.MapTransform):
 
 
 class HFDataSource(grain.RandomAccessDataSource):
-  """A class that makes HuggingFace IterableDataset a grain datasource without random access support"""
+  """A class that makes HuggingFace IterableDataset a grain datasource without random access support
+
+  Each (host, grain worker, thread) triple reads its own stream of dataset shards. The grain record key
+  of an example determines its stream and its position in the stream, so no example is read twice, and
+  a restored grain iterator resumes every stream at the position of its next record key.
+  """
+
+  # Record keys of each host, bigger than the dataset since HuggingFace IterableDataset has no length.
+  RECORDS_PER_HOST = 10_000_000_000
 
   def __init__(
       self,
@@ -192,11 +206,14 @@ class HFDataSource(grain.RandomAccessDataSource):
       generate_padding_example: bool,
       max_target_length: int,
       data_column_names: list[str],
+      grain_worker_count: int = 1,
   ):
     self.dataset = dataset
     self.num_threads = num_threads
+    self.num_workers = max(grain_worker_count, 1)
     self.dataloading_host_count = dataloading_host_count
     self.dataloading_host_index = dataloading_host_index
+    self.num_streams = dataloading_host_count * self.num_workers * num_threads
     self.generate_padding_example = generate_padding_example
     self.max_target_lenth = max_target_length
     self.data_column_names = data_column_names
@@ -205,62 +222,126 @@ class HFDataSource(grain.RandomAccessDataSource):
     else:
       self.n_shards = 1
     self._check_shard_count()
-    self.dataset_shards = [dataloading_host_index * self.num_threads + i for i in range(self.num_threads)]
-    self.datasets = [split_dataset_by_node(dataset, world_size=self.n_shards, rank=x) for x in self.dataset_shards]
-    self.data_iters = []
-    self.out_of_data = False
+    self._streams = {}
+    self._streams_lock = threading.Lock()
 
   def _check_shard_count(self):
-    if self.n_shards < (self.dataloading_host_count * self.num_threads):
+    if self.n_shards < self.num_streams:
       warnings.warn(
           f"WARNING: Inefficient dataloading. Your train or eval dataset contains {self.n_shards} shards, "
-          "smaller than number of host loading data. This is known to lead to inefficient dataloading. "
+          f"smaller than the {self.num_streams} (host, worker, thread) streams loading data. "
+          "This is known to lead to inefficient dataloading. "
           "see https://github.com/google/maxtext/blob/main/getting_started/Data_Input_Pipeline.md#multihost-dataloading-best-practice"
       )
-      self.n_shards = self.dataloading_host_count * self.num_threads
-
-  def _update_shard(self, idx):
-    new_shard = self.dataset_shards[idx] + self.dataloading_host_count * self.num_threads
-    if new_shard < self.n_shards:
-      max_logging.log(f"Updating host {self.dataloading_host_index} dataset {idx}, was on shard {self.dataset_shards[idx]}")
-      max_logging.log(f"New shard is {new_shard}")
-      self.dataset_shards[idx] = new_shard
-      self.datasets[idx] = split_dataset_by_node(self.dataset, world_size=self.n_shards, rank=self.dataset_shards[idx])
-      self.data_iters[idx] = iter(self.datasets[idx])
-    else:
-      max_logging.log(f"Run out of shards on host {self.dataloading_host_index}, shard {new_shard} is not available")
-      self.out_of_data = True
-      if self.generate_padding_example:
-        max_logging.log(
-            f"Host {self.dataloading_host_index} will start generating all-0 padding examples until step number is met."
-        )
+      self.n_shards = self.num_streams
+
+  def _stream_and_position(self, index: int) -> tuple[int, int]:
+    """Maps a record key to a stream and a position in the stream.
+
+    Grain gives each host a contiguous range of RECORDS_PER_HOST record keys, and worker w
+    the local indices i with i % num_workers == w, which its threads read in order.
+    """
+    local_index = index % self.RECORDS_PER_HOST
+    worker_index, worker_position = local_index % self.num_workers, local_index // self.num_workers
+    thread_index, position = worker_position % self.num_threads, worker_position // self.num_threads
+    stream_index = (self.dataloading_host_index * self.num_workers + worker_index) * self.num_threads + thread_index
+    return stream_index, position
+
+  def get_stream_positions(self) -> dict[int, int]:
+    """Returns the number of examples read from each stream of this process."""
+    with self._streams_lock:
+      return {stream_index: stream.position for stream_index, stream in self._streams.items()}
 
   def __len__(self):
     """Return length of the HF dataset. Since HuggingFace IterableDataset does not have length,
     a fake length bigger than the dataset is returned"""
-    return 10_000_000_000
+    return self.dataloading_host_count * self.RECORDS_PER_HOST
 
   def __getitem__(self, index):
     """Since HuggingFace IterableDataset does not support random access by index.
-    The next item in the iterator is returned."""
-    if not self.data_iters:
-      self.data_iters = [iter(x) for x in self.datasets]
-    idx = int(current_thread().name.split("_")[1])
+    The example at the position of index in its stream is returned."""
+    stream_index, position = self._stream_and_position(index)
+    with self._streams_lock:
+      if stream_index not in self._streams:
+        self._streams[stream_index] = _HFStream(self, stream_index)
+      stream = self._streams[stream_index]
+    return stream.get(position)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state["_streams"]
+    del state["_streams_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._streams = {}
+    self._streams_lock = threading.Lock()
+
+
+class _HFStream:
+  """Reads the dataset shards stream_index, stream_index + num_streams, ... of an HFDataSource in order.
+
+  Threads may ask for positions out of order, examples read ahead of the requested position are buffered.
+  """
+
+  def __init__(self, source: HFDataSource, stream_index: int):
+    self.source = source
+    self.stream_index = stream_index
+    self.position = 0
+    self.out_of_data = False
+    self._buffer = {}
+    self._iterator = None
+    self._lock = threading.Lock()
+
+  def _iterate(self):
+    for shard in range(self.stream_index, self.source.n_shards, self.source.num_streams):
+      max_logging.log(f"Host {self.source.dataloading_host_index} stream {self.stream_index} reading shard {shard}")
+      yield from split_dataset_by_node(self.source.dataset, world_size=self.source.n_shards, rank=shard)
+
+  def _seek(self, position: int):
+    if position > 0:
+      max_logging.log(f"Host {self.source.dataloading_host_index} stream {self.stream_index} resuming at {position}")
+    self._iterator = itertools.islice(self._iterate(), position, None)
+    self._buffer = {}
+    self.position = position
+    self.out_of_data = False
 
-    while True:
+  def _next(self):
+    if not self.out_of_data:
       try:
-        if self.out_of_data:
-          if self.generate_padding_example:
-            return {column_name: np.zeros(self.max_target_lenth, dtype=np.int32) for column_name in self.data_column_names}
-          else:
-            raise StopIteration("Running out of data")
-        data = next(self.data_iters[idx])
-        return data
-      except StopIteration as e:
-        if not self.out_of_data:
-          self._update_shard(idx)
-        else:
-          raise e
+        example = next(self._iterator)
+        self.position += 1
+        return example
+      except StopIteration:
+        max_logging.log(
+            f"Run out of shards on host {self.source.dataloading_host_index}, stream {self.stream_index} "
+            f"after {self.position} examples"
+        )
+        self.out_of_data = True
+        if self.source.generate_padding_example:
+          max_logging.log(
+              f"Host {self.source.dataloading_host_index} will start generating all-0 padding examples until step number is met."
+          )
+    if self.source.generate_padding_example:
+      self.position += 1
+      return {
+          column_name: np.zeros(self.source.max_target_lenth, dtype=np.int32)
+          for column_name in self.source.data_column_names
+      }
+    raise StopIteration("Running out of data")
+
+  def get(self, position: int):
+    """Returns the example at position of the stream."""
+    with self._lock:
+      if position in self._buffer:
+        return self._buffer.pop(position)
+      if self._iterator is None or position < self.position:
+        # First read of a restored iterator, or a position skipped by an earlier seek.
+        self._seek(position)
+      while self.position < position:
+        self._buffer[self.position] = self._next()
+      return self._next()
 
 
 ########## Functions used by Grain pipeline
@@ -338,6 +419,86 @@ class ReformatPacking(grain.MapTransform):
     return ret
 
 
+class BestFitPackIterDataset(grain.IterDataset):
+  """Packs examples with sequence_packing.BestFitPacker, one window of examples at a time."""
+
+  def __init__(self, parent: grain.IterDataset, packer: sequence_packing.BestFitPacker):
+    super().__init__(parent)
+    self._packer = packer
+
+  def __iter__(self):
+    return _BestFitPackDatasetIterator(self._parent.__iter__(), self._packer)
+
+
+class _BestFitPackDatasetIterator(grain.DatasetIterator):
+  """Iterator of BestFitPackIterDataset.
+
+  The state is the parent state at the start of the current window and the number of rows
+  already returned from it, restoring repacks the window and skips those rows.
+  """
+
+  def __init__(self, parent: grain.DatasetIterator, packer: sequence_packing.BestFitPacker):
+    super().__init__(parent)
+    self._packer = packer
+    self._window_state = self._parent.get_state()
+    self._rows = []
+    self._rows_returned = 0
+
+  def _pack_next_window(self):
+    self._window_state = self._parent.get_state()
+    self._rows = self._packer.pack(list(itertools.islice(self._parent, self._packer.window_size)))
+    self._rows_returned = 0
+
+  def __next__(self):
+    if self._rows_returned == len(self._rows):
+      self._pack_next_window()
+      if not self._rows:
+        raise StopIteration
+    row = self._rows[self._rows_returned]
+    self._rows_returned += 1
+    return row
+
+  def get_state(self):
+    return {"window_state": self._window_state, "rows_returned": self._rows_returned}
+
+  def set_state(self, state):
+    self._parent.set_state(state["window_state"])
+    self._pack_next_window()
+    self._rows_returned = state["rows_returned"]
+
+
+@dataclasses.dataclass
+class BestFitPackAndBatchOperation:
+  """Packs records with sequence_packing.BestFitPacker and batches the rows, a grain.DataLoader operation.
+
+  Outputs batches in the format of PackAndBatchOperation followed by ReformatPacking.
+  """
+
+  packer: sequence_packing.BestFitPacker
+  batch_size: int
+
+  def __call__(self, input_iterator):
+    window, rows, last_record = [], [], None
+    for record in input_iterator:
+      last_record = record
+      window.append(record.data)
+      if len(window) == self.packer.window_size:
+        rows.extend(self.packer.pack(window))
+        window = []
+      while len(rows) >= self.batch_size:
+        yield self._make_batch(last_record, rows[: self.batch_size])
+        rows = rows[self.batch_size :]
+    if window:
+      rows.extend(self.packer.pack(window))
+    while rows:
+      yield self._make_batch(last_record, rows[: self.batch_size])
+      rows = rows[self.batch_size :]
+
+  def _make_batch(self, last_record, rows):
+    batch = {k: np.stack([row[k] for row in rows]) for k in rows[0]}
+    return grain.Record(last_record.metadata.remove_record_key(), batch)
+
+
 @dataclasses.dataclass
 class PadOrTrimToMaxLength(grain.MapTransform):
   """Pads/Trims each input to the specified length
@@ -87,6 +87,8 @@ def preprocessing_pipeline(
     add_eos: bool = True,
     num_epochs: Optional[int] = 1,
     pack_examples: bool = True,
+    packing_strategy: str = "greedy",
+    packing_window_size: int = 512,
     shuffle_buffer_size: int = 1024,
     shift: bool = True,
     drop_remainder: bool = True,
@@ -113,16 +115,21 @@ def preprocessing_pipeline(
   else:
     pad_id = -1
 
+  # in pre-training we can take upto max_length+1 because there would be truncation by
+  # 1 token for both inputs and targets
+  extra_tokens = 1 if not use_dpo else 0
   if tokenize:
     dataset = dataset.map(
-        lambda x: tokenizer.TokenizeOp(tokenizer=tokenizer_model, features=x, data_keys=data_column_names),
+        lambda x: tokenizer.TokenizeOp(
+            tokenizer=tokenizer_model,
+            features=x,
+            data_keys=data_column_names,
+            max_length=max_target_length + extra_tokens if max_target_length > 0 else 0,
+        ),
         num_parallel_calls=AUTOTUNE,
     )
 
   if max_target_length > 0:
-    # in pre-training we can take upto max_length+1 because there would be truncation by
-    # 1 token for both inputs and targets
-    extra_tokens = 1 if not use_dpo else 0
     dataset = dataset.map(
         lambda x: _input_pipeline_utils.truncate_to_max_allowable_length(x, max_target_length + extra_tokens),
         num_parallel_calls=AUTOTUNE,
@@ -140,9 +147,12 @@ def preprocessing_pipeline(
         _input_pipeline_utils.shift_data_by_truncation, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True
     )
 
-  # Perform greedy sequence packing and batching
+  # Perform greedy or best-fit sequence packing and batching
   if pack_examples and not use_dpo:
-    dataset = sequence_packing.pack_dataset(dataset, max_target_length, pad_id)
+    if packing_strategy == "best_fit":
+      dataset = sequence_packing.pack_dataset_best_fit(dataset, max_target_length, pad_id, packing_window_size)
+    else:
+      dataset = sequence_packing.pack_dataset(dataset, max_target_length, pad_id)
     dataset = dataset.batch(global_batch_size // jax.process_count(), drop_remainder=drop_remainder)
   else:
     # simple (static-shape) padded batching
@@ -194,10 +204,14 @@ def make_tfds_train_iterator(
         add_eos=config.add_eos,
         num_epochs=config.num_epoch,
         pack_examples=config.packing,
+        packing_strategy=config.packing_strategy,
+        packing_window_size=config.packing_window_size,
         use_dpo=config.use_dpo,
         hf_access_token=config.hf_access_token,
     )
-    return multihost_dataloading.MultiHostDataLoadIterator(train_dataloader, global_mesh)
+    return multihost_dataloading.MultiHostDataLoadIterator(
+        train_dataloader, global_mesh, prefetch_depth=config.data_prefetch_depth
+    )
   else:
     get_ds_fn = functools.partial(
         get_datasets,
@@ -221,6 +235,8 @@ def make_tfds_train_iterator(
         add_eos=config.add_eos,
         num_epochs=config.num_epoch,
         pack_examples=config.packing,
+        packing_strategy=config.packing_strategy,
+        packing_window_size=config.packing_window_size,
         use_dpo=config.use_dpo,
         hf_access_token=config.hf_access_token,
     )
@@ -258,10 +274,14 @@ def make_tfds_eval_iterator(
         add_bos=config.add_bos,
         add_eos=config.add_eos,
         pack_examples=config.packing,
+        packing_strategy=config.packing_strategy,
+        packing_window_size=config.packing_window_size,
         use_dpo=config.use_dpo,
         hf_access_token=config.hf_access_token,
     )
-    return multihost_dataloading.MultiHostDataLoadIterator(eval_dataloader, global_mesh)
+    return multihost_dataloading.MultiHostDataLoadIterator(
+        eval_dataloader, global_mesh, prefetch_depth=config.eval_data_prefetch_depth
+    )
   else:
     get_ds_fn = functools.partial(
         get_datasets,
@@ -283,6 +303,8 @@ def make_tfds_eval_iterator(
         add_bos=config.add_bos,
         add_eos=config.add_eos,
         pack_examples=config.packing,
+        packing_strategy=config.packing_strategy,
+        packing_window_size=config.packing_window_size,
         use_dpo=config.use_dpo,
         hf_access_token=config.hf_access_token,
     )
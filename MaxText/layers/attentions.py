@@ -323,7 +323,12 @@ class AttentionOp(nn.Module):
     elif causal_mask is not None:
       output_mask = causal_mask
 
-    if self.attention_type == AttentionType.LOCAL_SLIDING and output_mask is not None:
+    # In decode, the KV cache of sliding window layers only returns the tokens of the window, see KVCache.
+    if (
+        self.attention_type == AttentionType.LOCAL_SLIDING
+        and model_mode != common_types.MODEL_MODE_AUTOREGRESSIVE
+        and output_mask is not None
+    ):
       if self.sliding_window_size is None:
         raise ValueError("Sliding_window_size must be set if Local Sliding attention type")
 
@@ -1225,6 +1230,7 @@ class Attention(nn.Module):
         prefill_cache_axis_order=self.prefill_cache_axis_order,
         ar_cache_axis_order=self.ar_cache_axis_order,
         use_chunked_prefill=self.config.use_chunked_prefill,
+        ar_cache_window_size=self.sliding_window_size if self.attention_type == AttentionType.LOCAL_SLIDING else None,
     )(
         key,
         value,
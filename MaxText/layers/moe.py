@@ -560,16 +560,9 @@ class MoeBlock(nn.Module):
     sub_seq = seq_len // cp
     return cp, sub_seq
 
-  # sub group mask generation for inference only
-  def generate_masks_subgroup(self, top_k_indices, softmax_probs):
+  def get_expert_capacity(self, seq_len):
     # calculate expert_capacity = (tokens_per_batch / num_experts) * capacity_factor
-    batch_size, seq_len, _ = top_k_indices.shape
-    cp, sub_seq = self.get_context_partition_and_sub_seq(seq_len)
-
-    #  breaking the sequence into sub sequences. It is effectively grouping the tokens in a sequence into groups, and route only within each group.
-    top_k_indices = jnp.reshape(top_k_indices, (batch_size, cp, sub_seq, top_k_indices.shape[2]))
-
-    tokens_per_batch = sub_seq * self.num_experts_per_tok
+    tokens_per_batch = seq_len * self.num_experts_per_tok
     # this is to avoid expert_capacity_per_batch = 0
     expert_capacity_per_batch = int(
         max(
@@ -578,6 +571,17 @@ class MoeBlock(nn.Module):
         )
     )
     max_logging.log(f"Applying potential token dropping with a batch expert_capacity of {expert_capacity_per_batch}")
+    return expert_capacity_per_batch
+
+  # sub group mask generation for inference only
+  def generate_masks_subgroup(self, top_k_indices, softmax_probs):
+    batch_size, seq_len, _ = top_k_indices.shape
+    cp, sub_seq = self.get_context_partition_and_sub_seq(seq_len)
+
+    #  breaking the sequence into sub sequences. It is effectively grouping the tokens in a sequence into groups, and route only within each group.
+    top_k_indices = jnp.reshape(top_k_indices, (batch_size, cp, sub_seq, top_k_indices.shape[2]))
+
+    expert_capacity_per_batch = self.get_expert_capacity(sub_seq)
 
     # calculate expert mask and drop tokens if needed
     # shape of output expert mask: (batch, sequence, num_experts_per_tok)
@@ -636,18 +640,9 @@ class MoeBlock(nn.Module):
     return dispatch_mask, combine_mask
 
   def generate_masks(self, top_k_indices, softmax_probs):
-    # calculate expert_capacity = (tokens_per_batch / num_experts) * capacity_factor
     batch_size, seq_len, _ = top_k_indices.shape
 
-    tokens_per_batch = seq_len * self.num_experts_per_tok
-    # this is to avoid expert_capacity_per_batch = 0
-    expert_capacity_per_batch = int(
-        max(
-            math.ceil(tokens_per_batch / self.num_experts) * self.config.capacity_factor,
-            self.config.capacity_factor,
-        )
-    )
-    max_logging.log(f"Applying potential token dropping with a batch expert_capacity of {expert_capacity_per_batch}")
+    expert_capacity_per_batch = self.get_expert_capacity(seq_len)
 
     # calculate expert mask and drop tokens if needed
     # shape of output expert mask: (batch, sequence, num_experts_per_tok)
@@ -696,6 +691,101 @@ class MoeBlock(nn.Module):
 
     return dispatch_mask, combine_mask
 
+  def generate_dispatch_slots(self, top_k_indices, expert_capacity):
+    """Index-based alternative to generate_masks, with the same token dropping.
+
+    Each routed token gets a slot expert * expert_capacity + position in the flattened expert buffers
+    of its group, where position is its rank among the tokens of the group routed to the same expert.
+    Tokens past expert_capacity get num_experts * expert_capacity, which is out of range and dropped.
+
+    Args:
+      top_k_indices: (groups, group_len, num_experts_per_tok) selected experts.
+      expert_capacity: number of tokens each expert takes per group.
+
+    Returns:
+      slots of shape (groups, group_len, num_experts_per_tok), without any num_experts sized tensor
+      except the per group expert counts.
+    """
+    groups = top_k_indices.shape[0]
+    expert_ids = jnp.reshape(top_k_indices, (groups, -1))
+    routed_len = expert_ids.shape[1]
+    # A stable sort by expert keeps the token order within each expert, so the rank in the sorted
+    # order minus the start of the expert is the cumsum over the one-hot expert mask in generate_masks.
+    order = jnp.argsort(expert_ids, axis=1, stable=True)
+    sorted_ids = jnp.take_along_axis(expert_ids, order, axis=1)
+    group_sizes = jax.vmap(lambda ids: jnp.bincount(ids, length=self.num_experts))(expert_ids)
+    expert_starts = jnp.cumsum(group_sizes, axis=1) - group_sizes
+    sorted_positions = jnp.arange(routed_len)[None, :] - jnp.take_along_axis(expert_starts, sorted_ids, axis=1)
+    positions = jnp.zeros_like(sorted_positions).at[jnp.arange(groups)[:, None], order].set(sorted_positions)
+    slots = jnp.where(
+        positions < expert_capacity,
+        expert_ids * expert_capacity + positions,
+        self.num_experts * expert_capacity,
+    )
+    return jnp.reshape(slots, top_k_indices.shape)
+
+  def index_dispatch(self, inputs, slots, expert_capacity):
+    """Gathers tokens into expert buffers of shape (num_experts, groups, expert_capacity, emb).
+
+    Args:
+      inputs: (groups, group_len, emb) tokens.
+      slots: (groups, group_len, num_experts_per_tok) from generate_dispatch_slots.
+      expert_capacity: number of tokens each expert takes per group.
+    """
+    groups, group_len, _ = slots.shape
+    num_slots = self.num_experts * expert_capacity
+    token_ids = jnp.broadcast_to(jnp.arange(group_len)[:, None], slots.shape[1:])
+    # Token of each slot, group_len (out of range) for empty slots. Dropped tokens point past the end and are not written.
+    slot_tokens = jnp.full((groups, num_slots), group_len, dtype=jnp.int32)
+    slot_tokens = slot_tokens.at[jnp.arange(groups)[:, None], jnp.reshape(slots, (groups, -1))].set(
+        jnp.reshape(token_ids, (1, -1)), mode="drop"
+    )
+    dispatch = jnp.take_along_axis(inputs, slot_tokens[..., None], axis=1, mode="fill", fill_value=0)
+    dispatch = jnp.reshape(dispatch, (groups, self.num_experts, expert_capacity, inputs.shape[-1]))
+    return jnp.transpose(dispatch, (1, 0, 2, 3))
+
+  def index_combine(self, intermediate, slots, weights):
+    """Gathers the expert outputs of each token and sums them weighted by weights, dropped tokens get 0.
+
+    Args:
+      intermediate: (num_experts, groups, expert_capacity, emb) expert outputs.
+      slots: (groups, group_len, num_experts_per_tok) from generate_dispatch_slots.
+      weights: (groups, group_len, num_experts_per_tok) router weights of the selected experts.
+    """
+    groups = slots.shape[0]
+    intermediate = jnp.transpose(intermediate, (1, 0, 2, 3))
+    intermediate = jnp.reshape(intermediate, (groups, -1, intermediate.shape[-1]))
+    token_outputs = jnp.take_along_axis(
+        intermediate, jnp.reshape(slots, (groups, -1, 1)), axis=1, mode="fill", fill_value=0
+    )
+    token_outputs = jnp.reshape(token_outputs, slots.shape + (intermediate.shape[-1],))
+    return jnp.einsum("GSKM,GSK -> GSM", token_outputs, weights.astype(token_outputs.dtype))
+
+  def sow_routing_metrics(self, gate_logits, top_k_indices, expert_capacity=None):
+    """Sows the expert load, token drop rate and routing entropy of this layer when record_moe_metrics is set.
+
+    Args:
+      gate_logits: (batch, seq, num_experts) router logits.
+      top_k_indices: (groups, group_len, num_experts_per_tok) selected experts, grouped as for token dropping.
+      expert_capacity: number of tokens each expert takes per group, or None if no token is dropped.
+    """
+    if not self.config.record_moe_metrics:
+      return
+    # Only per group expert counts are built, like generate_dispatch_slots, so this stays cheap next to the experts.
+    expert_ids = jnp.reshape(top_k_indices, (top_k_indices.shape[0], -1))
+    group_sizes = jax.vmap(lambda ids: jnp.bincount(ids, length=self.num_experts))(expert_ids)
+    num_routed = expert_ids.size
+    expert_load = jnp.sum(group_sizes, axis=0) / num_routed
+    if expert_capacity is None:
+      drop_rate = jnp.zeros((), jnp.float32)
+    else:
+      drop_rate = jnp.sum(jnp.maximum(group_sizes - expert_capacity, 0)) / num_routed
+    probs = jax.nn.softmax(gate_logits.astype(jnp.float32), axis=-1)
+    routing_entropy = jnp.mean(jnp.sum(jax.scipy.special.entr(probs), axis=-1))
+    self.sow("intermediates", "moe_expert_load", expert_load.astype(jnp.float32))
+    self.sow("intermediates", "moe_drop_rate", drop_rate.astype(jnp.float32))
+    self.sow("intermediates", "moe_routing_entropy", routing_entropy)
+
   # See Switch Transformer (https://arxiv.org/abs/2101.03961) for more details.
   def load_balance_loss(self, top_k_indices, logits):
     expert_mask = jax.nn.one_hot(top_k_indices, num_classes=self.num_experts, dtype=jnp.int32)
@@ -768,9 +858,16 @@ class MoeBlock(nn.Module):
         raise ValueError(
             "Llama4 decoder has not been tested with capacity_factor > 0 -- please set that value to -1 for now!"
         )
+      use_index_dispatch = self.config.moe_token_dispatch == "index"
       # token dropping if needed
       if self.config.model_call_mode != "inference":
-        dispatch_mask, combine_mask = self.generate_masks(top_k_indices, weights)
+        expert_capacity = self.get_expert_capacity(seq_len)
+        self.sow_routing_metrics(gate_logits, top_k_indices, expert_capacity)
+        if use_index_dispatch:
+          dispatch_slots = self.generate_dispatch_slots(top_k_indices, expert_capacity)
+          dispatch_weights = top_k_weights.astype(self.dtype)
+        else:
+          dispatch_mask, combine_mask = self.generate_masks(top_k_indices, weights)
         mask_axes = ("activation_batch", "activation_length", None, None)
         input_axis = ("activation_batch", "activation_length", "activation_embed")
         dispatch_axis = ("activation_exp", "activation_batch_no_exp", None, "activation_embed")
@@ -781,7 +878,16 @@ class MoeBlock(nn.Module):
       else:
         # todo: try replace softmax_probs with padded weights and verify with decode acc tests
         softmax_probs = jax.nn.softmax(gate_logits.astype(jnp.float32), axis=-1).astype(self.dtype)
-        dispatch_mask, combine_mask = self.generate_masks_subgroup(top_k_indices, softmax_probs)
+        expert_capacity = self.get_expert_capacity(sub_seq)
+        group_top_k_indices = jnp.reshape(top_k_indices, (batch_size * cp, sub_seq, self.num_experts_per_tok))
+        self.sow_routing_metrics(gate_logits, group_top_k_indices, expert_capacity)
+        if use_index_dispatch:
+          dispatch_slots = self.generate_dispatch_slots(group_top_k_indices, expert_capacity)
+          dispatch_weights = jnp.take_along_axis(
+              jnp.reshape(softmax_probs, (batch_size * cp, sub_seq, self.num_experts)), group_top_k_indices, axis=-1
+          )
+        else:
+          dispatch_mask, combine_mask = self.generate_masks_subgroup(top_k_indices, softmax_probs)
         if self.get_context_autoregressive_parallelism_size() > 0 and cp == 1:
           mask_axes = ("activation_length", "activation_batch", None, None, None)
           input_axis = ("activation_length", "activation_batch", None, "activation_embed")
@@ -799,14 +905,20 @@ class MoeBlock(nn.Module):
         inputs = jnp.reshape(inputs, (batch_size, cp, sub_seq, inputs.shape[2]))
         inputs = nn.with_logical_constraint(inputs, input_axis)
 
-      dispatch_mask = nn.with_logical_constraint(dispatch_mask, mask_axes)
-      combine_mask = nn.with_logical_constraint(combine_mask, mask_axes)
+      if not use_index_dispatch:
+        dispatch_mask = nn.with_logical_constraint(dispatch_mask, mask_axes)
+        combine_mask = nn.with_logical_constraint(combine_mask, mask_axes)
 
       with jax.named_scope("dispatch"):
-        # only cp during prefill
-        dispatch = self.get_einsum(rhs_mesh_axes=mask_axes, einsum_name=DISPATCH)(
-            dispatch_eimsum, inputs, dispatch_mask, precision=matmul_precision
-        )
+        if use_index_dispatch:
+          group_inputs = jnp.reshape(inputs, (-1,) + inputs.shape[-2:])
+          dispatch = self.index_dispatch(group_inputs, dispatch_slots, expert_capacity)
+          dispatch = jnp.reshape(dispatch, (self.num_experts,) + inputs.shape[:-2] + (expert_capacity, inputs.shape[-1]))
+        else:
+          # only cp during prefill
+          dispatch = self.get_einsum(rhs_mesh_axes=mask_axes, einsum_name=DISPATCH)(
+              dispatch_eimsum, inputs, dispatch_mask, precision=matmul_precision
+          )
         if cp > 1:
           dispatch = nn.with_logical_constraint(
               dispatch,
@@ -856,17 +968,23 @@ class MoeBlock(nn.Module):
           )
         intermediate_layer = checkpoint_name(intermediate_layer, "mlpwo")
       with jax.named_scope("combine"):
-        # Matmul & element wise operation
-        output = self.get_einsum(rhs_mesh_axes=mask_axes, einsum_name=COMBINE)(
-            output_einsum,
-            intermediate_layer,
-            combine_mask,
-            precision=matmul_precision,
-        )
+        if use_index_dispatch:
+          group_intermediate = jnp.reshape(intermediate_layer, (self.num_experts, -1) + intermediate_layer.shape[-2:])
+          output = self.index_combine(group_intermediate, dispatch_slots, dispatch_weights)
+          output = jnp.reshape(output, (batch_size, seq_len, output.shape[-1]))
+        else:
+          # Matmul & element wise operation
+          output = self.get_einsum(rhs_mesh_axes=mask_axes, einsum_name=COMBINE)(
+              output_einsum,
+              intermediate_layer,
+              combine_mask,
+              precision=matmul_precision,
+          )
         if output.ndim == 4:
           output = jnp.reshape(output, (output.shape[0], output.shape[1] * output.shape[2], output.shape[3]))
       return output, loss
     else:
+      self.sow_routing_metrics(gate_logits, top_k_indices)
       inputs = nn.with_logical_constraint(inputs, ("activation_batch", "activation_length", "activation_embed"))
       with jax.named_scope("wi_0"):
         layer_w0 = self.get_einsum(rhs_mesh_axes=self.wi_kernel_axes)(
@@ -941,6 +1059,10 @@ class MoeBlock(nn.Module):
         w0_kernel, w1_kernel, wo_kernel = self.retrieve_quantized_weight(
             inputs, gate_logits, pre_bias_logits, w0_kernel, w1_kernel, wo_kernel
         )
+      if cfg.record_moe_metrics:
+        # The routing of sparse_matmul happens inside shard_map, where nothing can be sown, so it is redone here.
+        _, top_k_indices = self.get_topk(gate_logits, pre_bias_logits)
+        self.sow_routing_metrics(gate_logits, top_k_indices)
       return self.sparse_matmul(inputs, gate_logits, pre_bias_logits, w0_kernel, w1_kernel, wo_kernel)
     else:
       return self.dense_matmul(inputs, gate_logits, pre_bias_logits, w0_kernel, w1_kernel, wo_kernel)
@@ -29,15 +29,22 @@ For large size model (e.g. 70B model), this script requires large memory VM.
 The script load and save weights in a single pass.
 To fit less memory, modify convert() to load/save weights in multiple passes.
 Each pass, load and save partial weights (subset of all weight variables).
+
+HuggingFace checkpoints can be converted with bounded memory by adding
+    --huggingface-checkpoint true --streaming true [--conversion-workers 8] [--streaming-scratch-dir /local/disk]
+which converts one layer per worker at a time into memory-mapped files in the scratch directory, and needs
+local disk for the whole converted checkpoint instead of RAM.
 """
 # pylint: disable=g-line-too-long
 import argparse
+import concurrent.futures
 import pathlib
 import os
 import gc
 import re
 import logging
 import json
+import tempfile
 from dataclasses import dataclass
 from safetensors import safe_open
 
@@ -808,6 +815,160 @@ def _convert_huggingface_to_jax_weights(base_model_path: str, model_size: str, m
   return jax_weights
 
 
+class _SafetensorsIndex:
+  """Reads single tensors of a HuggingFace safetensors checkpoint on demand, by their MaxText names.
+
+  safe_open memory-maps the files, so only the tensors being converted are read into memory.
+  """
+
+  def __init__(self, base_model_path: str):
+    self.key_to_path = {}
+    for ckpt_path in sorted(pathlib.Path(base_model_path).glob("[!.]*.safetensors")):
+      with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+        for key in f.keys():
+          # layer index, then expert index
+          indices = [int(field) for field in key.split(".") if field.isdigit()]
+          mapping = _hf_to_maxtext_mapping(*indices)
+          if key in mapping:
+            self.key_to_path[mapping[key]] = (ckpt_path, key)
+
+  def __contains__(self, key):
+    return key in self.key_to_path
+
+  def get(self, key: str) -> np.ndarray:
+    ckpt_path, hf_key = self.key_to_path[key]
+    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+      return f.get_tensor(hf_key).to(torch.float32).numpy().astype(CAST_DTYPE)
+
+
+def _convert_huggingface_to_jax_weights_streaming(
+    base_model_path: str, model_size: str, model_params: dict, mem_info: psutil.Process, scratch_dir: str, num_workers: int
+):
+  """Convert a Huggingface Checkpoint layer by layer into memory-mapped Numpy arrays.
+
+  Produces the same weights as _convert_huggingface_to_jax_weights. The stacked weights are
+  np.memmap files in scratch_dir laid out as MaxText expects, and num_workers threads each
+  convert one layer (or one expert of a layer) at a time into them, so the resident memory is
+  bounded by a few layers instead of the whole checkpoint.
+
+  Args:
+    base_model_path (str): Path to the base model checkpoint.
+    model_size (str): Size of the base model.
+    model_params (dict): Dictionary containing model parameters.
+    mem_info (psutil.Process): Process object to track memory usage.
+    scratch_dir (str): Local directory holding the memory-mapped weights until they are saved.
+    num_workers (int): Number of layers converted in parallel.
+
+  Returns:
+    jax_weights (dict): Dictionary containing the converted weights.
+  """
+  num_layers = model_params["num_layers"]
+  num_query_heads = model_params["num_heads"]
+  head_dim = model_params["dims_per_head"]
+  num_kv_heads = model_params["num_kv_heads"]
+  vocab_size = model_params["vocab"]
+  num_experts = model_params["num_experts"] if "num_experts" in model_params else None
+
+  max_logging.log(f"Indexing the base model at {base_model_path}")
+  index = _SafetensorsIndex(base_model_path)
+
+  def new_weight(name, shape):
+    return np.memmap(os.path.join(scratch_dir, f"{name}.bin"), dtype=CAST_DTYPE, mode="w+", shape=shape)
+
+  # embedding, decoder norm and logits dense are small enough to convert in memory
+  max_logging.log("Processing decoder norm scale, logits dense and token embeddings")
+  embedding = index.get("tok_embeddings.weight")
+  if model_size[:6] != "llama3":
+    embedding = embedding[:vocab_size, :]
+  emb_dim = embedding.shape[1]
+  jax_weights = {
+      "decoder": {
+          "layers": {
+              "pre_self_attention_layer_norm": {"scale": new_weight("pre_self_attention_layer_norm", (emb_dim, num_layers))},
+              "post_self_attention_layer_norm": {
+                  "scale": new_weight("post_self_attention_layer_norm", (emb_dim, num_layers))
+              },
+              "self_attention": {
+                  "query": {"kernel": new_weight("query", (emb_dim, num_layers, num_query_heads, head_dim))},
+                  "key": {"kernel": new_weight("key", (emb_dim, num_layers, num_kv_heads, head_dim))},
+                  "value": {"kernel": new_weight("value", (emb_dim, num_layers, num_kv_heads, head_dim))},
+                  "out": {"kernel": new_weight("out", (num_query_heads, num_layers, head_dim, emb_dim))},
+              },
+          },
+          "decoder_norm": {"scale": index.get("norm.weight")},
+          "logits_dense": {"kernel": index.get("output.weight").transpose()[:, :vocab_size]},
+      },
+      "token_embedder": {"embedding": embedding},
+  }
+  layers = jax_weights["decoder"]["layers"]
+  self_attention = layers["self_attention"]
+
+  if num_experts is None:
+    mlp_dim = index.get("layers.0.feed_forward.w1.weight").shape[0]
+    layers["mlp"] = {
+        "wi_0": {"kernel": new_weight("wi_0", (emb_dim, num_layers, mlp_dim))},
+        "wi_1": {"kernel": new_weight("wi_1", (emb_dim, num_layers, mlp_dim))},
+        "wo": {"kernel": new_weight("wo", (mlp_dim, num_layers, emb_dim))},
+    }
+  else:
+    mlp_dim = index.get("layers.0.feed_forward.experts.0.w1.weight").shape[0]
+    layers["MoeBlock_0"] = {
+        "gate": {"kernel": new_weight("gate", (emb_dim, num_layers, num_experts))},
+        "wi_0": new_weight("wi_0", (num_experts, num_layers, emb_dim, mlp_dim)),
+        "wi_1": new_weight("wi_1", (num_experts, num_layers, emb_dim, mlp_dim)),
+        "wo": new_weight("wo", (num_experts, num_layers, mlp_dim, emb_dim)),
+    }
+
+  def convert_layer(layer_idx):
+    wq = np.reshape(index.get(f"layers.{layer_idx}.attention.wq.weight").transpose(), [-1, num_query_heads, head_dim])
+    wk = np.reshape(index.get(f"layers.{layer_idx}.attention.wk.weight").transpose(), [-1, num_kv_heads, head_dim])
+    wv = np.reshape(index.get(f"layers.{layer_idx}.attention.wv.weight").transpose(), [-1, num_kv_heads, head_dim])
+    if model_size[:8] == "llama3.1":
+      wq = max_utils.permute_to_match_maxtext_rope(wq)
+      wk = max_utils.permute_to_match_maxtext_rope(wk)
+    # scale the query weights
+    self_attention["query"]["kernel"][:, layer_idx] = wq / np.sqrt(head_dim)
+    self_attention["key"]["kernel"][:, layer_idx] = wk
+    self_attention["value"]["kernel"][:, layer_idx] = wv
+    w_post = np.reshape(index.get(f"layers.{layer_idx}.attention.wo.weight"), [-1, num_query_heads, head_dim])
+    self_attention["out"]["kernel"][:, layer_idx] = np.transpose(w_post, axes=(1, 2, 0))  # [q, head_dim, embed]
+
+    layers["pre_self_attention_layer_norm"]["scale"][:, layer_idx] = index.get(f"layers.{layer_idx}.attention_norm.weight")
+    layers["post_self_attention_layer_norm"]["scale"][:, layer_idx] = index.get(f"layers.{layer_idx}.ffn_norm.weight")
+
+    if num_experts is None:
+      layers["mlp"]["wi_0"]["kernel"][:, layer_idx] = index.get(f"layers.{layer_idx}.feed_forward.w1.weight").transpose()
+      layers["mlp"]["wi_1"]["kernel"][:, layer_idx] = index.get(f"layers.{layer_idx}.feed_forward.w3.weight").transpose()
+      layers["mlp"]["wo"]["kernel"][:, layer_idx] = index.get(f"layers.{layer_idx}.feed_forward.w2.weight").transpose()
+    else:
+      layers["MoeBlock_0"]["gate"]["kernel"][:, layer_idx] = index.get(
+          f"layers.{layer_idx}.feed_forward.gate.weight"
+      ).transpose()
+
+  def convert_expert(layer_idx, expert_idx):
+    prefix = f"layers.{layer_idx}.feed_forward.experts.{expert_idx}"
+    layers["MoeBlock_0"]["wi_0"][expert_idx, layer_idx] = index.get(f"{prefix}.w1.weight").transpose()
+    layers["MoeBlock_0"]["wi_1"][expert_idx, layer_idx] = index.get(f"{prefix}.w3.weight").transpose()
+    layers["MoeBlock_0"]["wo"][expert_idx, layer_idx] = index.get(f"{prefix}.w2.weight").transpose()
+
+  max_logging.log(f"Processing layers with {num_workers} workers")
+  tasks = [(convert_layer, layer_idx) for layer_idx in range(num_layers)]
+  if num_experts is not None:
+    tasks += [
+        (convert_expert, layer_idx, expert_idx) for layer_idx in range(num_layers) for expert_idx in range(num_experts)
+    ]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    futures = [executor.submit(*task) for task in tasks]
+    for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="layers", leave=False):
+      future.result()
+
+  for weight in tree.leaves(jax_weights):
+    if isinstance(weight, np.memmap):
+      weight.flush()
+  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
+  return jax_weights
+
+
 def _convert_pytorch_to_jax_weights(base_model_path: str, model_size: str, model_params: dict, mem_info: psutil.Process):
   """Convert a PyTorch checkpoint to a dictionary of Numpy arrays representing the weights.
 
@@ -835,7 +996,9 @@ def _convert_pytorch_to_jax_weights(base_model_path: str, model_size: str, model
     max_logging.log(f"Loading checkpoint {i+1} of {len(ckpt_paths)} ...")
     # NOTE: starting in PT2.6, `weights_only` was switched from the default of `False` to `True`
     # thus we need to specify this or else loading will fail
-    chkpt_vars[int(ckpt_path.name.split(".", maxsplit=2)[1])] = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+    chkpt_vars[int(ckpt_path.name.split(".", maxsplit=2)[1])] = torch.load(
+        ckpt_path, map_location="cpu", weights_only=False, mmap=True
+    )
   chkpt_vars = [chkpt_vars[i] for i in sorted(list(chkpt_vars.keys()))]
   # map weight names if they use HuggingFace instead of PyTorch convention
   chkpt_vars = [_NamespaceMapper(var, model_size=model_size) for var in chkpt_vars]
@@ -1291,7 +1454,13 @@ def _convert_pytorch_to_jax_weights(base_model_path: str, model_size: str, model
   return jax_weights
 
 
-def convert_to_jax_weights(base_model_path: str, model_size: str, huggingface_ckpt: bool):
+def convert_to_jax_weights(
+    base_model_path: str,
+    model_size: str,
+    huggingface_ckpt: bool,
+    scratch_dir: str | None = None,
+    num_workers: int = 1,
+):
   """
   Function to convert the checkpoint at base_model_path into Orbax checkpoint
   for MaxText and output jax_weights ready for MaxText
@@ -1299,6 +1468,10 @@ def convert_to_jax_weights(base_model_path: str, model_size: str, huggingface_ck
   Attributes:
     base_model_path: checkpoint path
     model_size: llama2-7b to 70b, mistral-7b, or mixtral-8x7b, mixtral-8x22b
+    huggingface_ckpt: whether the checkpoint is in HuggingFace safetensors format
+    scratch_dir: if set, a HuggingFace checkpoint is converted layer by layer into memory-mapped
+      weights in this local directory
+    num_workers: number of layers converted in parallel when scratch_dir is set
   """
   model_params = MODEL_PARAMS_DICT[model_size]
   mem_info = psutil.Process()
@@ -1306,6 +1479,10 @@ def convert_to_jax_weights(base_model_path: str, model_size: str, huggingface_ck
 
   max_logging.log(f"Loading the base model from {base_model_path}")
 
+  if huggingface_ckpt and scratch_dir is not None:
+    return _convert_huggingface_to_jax_weights_streaming(
+        base_model_path, model_size, model_params, mem_info, scratch_dir, num_workers
+    )
   if huggingface_ckpt:
     return _convert_huggingface_to_jax_weights(base_model_path, model_size, model_params, mem_info)
 
@@ -1344,17 +1521,17 @@ def save_weights_to_checkpoint(
       max_logging.log("no sharding was possible, replicating")
       return jax.device_put(arr, device=s3)
 
-  # convert all weights to jax.numpy with sharding if applicable
+  # convert all weights to jax.numpy with sharding if applicable. Memory-mapped weights are saved
+  # as they are, orbax writes them from the page cache instead of copying them into device buffers.
   jax_weights_flat, jax_weights_struct = tree.flatten(jax_weights)
-  jax_weights_new = []
-  while len(jax_weights_flat) > 0:
-    jax_weight = jax_weights_flat.pop(0)
-    jax_weights_new.append(checkpoint_device_put(jax_weight))
-    del jax_weight
-    gc.collect()
-    logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
+  del jax_weights
+  for i, jax_weight in enumerate(jax_weights_flat):
+    if not isinstance(jax_weight, np.memmap):
+      # replace in place, so that the numpy weight is freed once it is on device
+      jax_weights_flat[i] = checkpoint_device_put(jax_weight)
+  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
-  jax_weights = tree.unflatten(jax_weights_struct, jax_weights_new)
+  jax_weights = tree.unflatten(jax_weights_struct, jax_weights_flat)
 
   # dummy configs for the checkpoint_manager
   step_number_to_save_new_ckpt = 0
@@ -1415,6 +1592,10 @@ if __name__ == "__main__":
   parser.add_argument("--huggingface-checkpoint", type=str2bool, required=False, default=False)
   parser.add_argument("--use-ocdbt", type=str2bool, required=False, default=True)
   parser.add_argument("--use-zarr3", type=str2bool, required=False, default=True)
+  # Convert a HuggingFace checkpoint layer by layer with bounded memory, through memory-mapped files in a local directory.
+  parser.add_argument("--streaming", type=str2bool, required=False, default=False)
+  parser.add_argument("--streaming-scratch-dir", type=str, required=False, default=None)
+  parser.add_argument("--conversion-workers", type=int, required=False, default=8)
   args = parser.parse_args()
 
   if args.model_size not in MODEL_PARAMS_DICT:
@@ -1426,13 +1607,23 @@ if __name__ == "__main__":
   if args.lora_input_adapters_path:
     base_weights_path += "/base"
 
-  save_weights_to_checkpoint(
-      args.maxtext_model_path,
-      convert_to_jax_weights(args.base_model_path, args.model_size, args.huggingface_checkpoint),
-      SIMULATED_CPU_DEVICES_COUNT,
-      args.use_ocdbt,
-      args.use_zarr3,
-  )
+  if args.streaming and not args.huggingface_checkpoint:
+    parser.error("--streaming is only supported with --huggingface-checkpoint=true")
+
+  with tempfile.TemporaryDirectory(dir=args.streaming_scratch_dir) as scratch_dir:
+    save_weights_to_checkpoint(
+        args.maxtext_model_path,
+        convert_to_jax_weights(
+            args.base_model_path,
+            args.model_size,
+            args.huggingface_checkpoint,
+            scratch_dir=scratch_dir if args.streaming else None,
+            num_workers=args.conversion_workers,
+        ),
+        SIMULATED_CPU_DEVICES_COUNT,
+        args.use_ocdbt,
+        args.use_zarr3,
+    )
   max_logging.log(f"Successfully saved base_weights to {base_weights_path}.")
 
   if args.lora_input_adapters_path:
@@ -14,8 +14,9 @@
 
 """Implementation of Engine API for MaxText"""
 import functools
-from typing import Any, List, Optional, Tuple, Callable
+from typing import Any, List, Optional, Sequence, Tuple, Callable
 from collections import defaultdict
+from concurrent import futures
 import uuid
 import os.path
 
@@ -30,10 +31,12 @@ from MaxText.layers import models, quantizations
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 from jax.sharding import PartitionSpec as P
 from jax.experimental import layout as jax_layout
 
 from MaxText import common_types
+from MaxText import encode_cache
 from jetstream.core import config_lib
 from jetstream.engine import engine_api
 from jetstream.engine.tokenizer_pb2 import TokenizerParameters
@@ -45,6 +48,7 @@ from MaxText.utils import lora_utils
 from MaxText import max_utils
 from MaxText import maxtext_utils
 from MaxText import inference_utils
+from MaxText import prefix_cache
 from MaxText import pyconfig
 
 import warnings
@@ -95,6 +99,40 @@ class MaxEngineConfig:
     return self.keys
 
 
+class BatchTokenizer:
+  """Adds a threaded encode_batch and an optional LRU cache of encode results to a JetStream tokenizer.
+
+  Other attributes are forwarded to the wrapped tokenizer.
+  """
+
+  def __init__(self, tokenizer: tokenizer_api.Tokenizer, encode_cache_size: int = 0, num_threads: int = 8):
+    self._tokenizer = tokenizer
+    self._encode_cache = encode_cache.EncodeCache(encode_cache_size) if encode_cache_size > 0 else None
+    self._num_threads = num_threads
+
+  def __getattr__(self, attr):
+    if attr == "_tokenizer":  # Not set yet, e.g. while unpickling.
+      raise AttributeError(attr)
+    return getattr(self._tokenizer, attr)
+
+  def encode(self, s: str, **kwargs) -> Tuple[Any, int]:
+    if self._encode_cache is None:
+      return self._tokenizer.encode(s, **kwargs)
+    key = (s,) + tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()))
+    encoded = self._encode_cache.get(key)
+    if encoded is None:
+      encoded = self._tokenizer.encode(s, **kwargs)
+      self._encode_cache.put(key, encoded)
+    tokens, true_length = encoded
+    # Cached numpy tokens are copied, since callers may modify them.
+    return (tokens.copy() if isinstance(tokens, np.ndarray) else tokens), true_length
+
+  def encode_batch(self, texts: Sequence[str], **kwargs) -> List[Tuple[Any, int]]:
+    """Encodes a batch of strings on a thread pool, the tokenizers release the GIL while encoding."""
+    with futures.ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+      return list(executor.map(lambda s: self.encode(s, **kwargs), texts))
+
+
 class MaxEngine(engine_api.Engine):
   """The computational core of the generative model server.
 
@@ -145,6 +183,16 @@ class MaxEngine(engine_api.Engine):
       )
     self.page_state = self.page_manager.get_initial_page_state()
 
+    # Prefix cache sharing full prompt pages between slots in the paged KV pool.
+    self.paged_prefix_cache = None
+    if self.config.attention == "paged" and self.config.pagedattn_prefix_caching_num_pages > 0:
+      self.paged_prefix_cache = prefix_cache.PagedPrefixCache(
+          tokens_per_page=self.config.pagedattn_tokens_per_page,
+          max_pages=self.config.pagedattn_prefix_caching_num_pages,
+      )
+    # Prompt tokens of prefilled slots whose pages are saved to the prefix cache once insert wrote them.
+    self._pending_prefix_pages: dict[int, tuple[int, ...]] = {}
+
   def print_stats(self, label: str):
     max_utils.print_mem_stats(label)
     max_utils.print_cpu_ram_stats(label)
@@ -415,6 +463,7 @@ class MaxEngine(engine_api.Engine):
       request_id: Optional[uuid.UUID] = None,  # pylint: disable=unused-argument
       slot: Optional[int] = None,
       page_state: Optional[PageState] = None,
+      sampling_params: Optional[dict[str, jax.Array]] = None,
   ) -> Tuple[Prefix, engine_api.ResultTokens]:
     """Computes a kv-cache for a new generate request.
 
@@ -428,6 +477,10 @@ class MaxEngine(engine_api.Engine):
 
       true_length: The real length of the tokens, pre-pad.
 
+      sampling_params: Sampling parameters of the request shaped [1], see
+        inference_utils.make_sampling_params. Only used with
+        decode_sampling_per_request, defaults to the engine config.
+
     Returns:
       kv_cache: For the resulting text.
     """
@@ -486,14 +539,22 @@ class MaxEngine(engine_api.Engine):
     selected_logits = jax.lax.with_sharding_constraint(selected_logits, self.replicated_sharding)
 
     # sampling first token
-    first_generated_token = inference_utils.sampling(
-        selected_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
-    )
+    if self.config.decode_sampling_per_request:
+      if sampling_params is None:
+        sampling_params = self._default_sampling_params(batch_size=1)
+      first_generated_token = inference_utils.sampling_per_slot(
+          selected_logits, rng, sampling_params, generated_tokens[:, 0]
+      )
+    else:
+      first_generated_token = inference_utils.sampling(
+          selected_logits,
+          rng,
+          self.config.decode_sampling_strategy,
+          topk=self.config.decode_sampling_top_k,
+          nucleus_topp=self.config.decode_sampling_nucleus_p,
+          temperature=self.config.decode_sampling_temperature,
+          nucleus_candidates=self.config.decode_sampling_nucleus_candidates,
+      )
 
     all_valid = jnp.ones(first_generated_token.shape, dtype=jnp.int8)
     result = engine_api.ResultTokens(
@@ -512,13 +573,16 @@ class MaxEngine(engine_api.Engine):
     cache = new_vars["cache"]
     cache = self._maybe_stack_prefill_result_cache(cache)
     next_pos = jnp.full((1, 1), full_true_length, dtype=jnp.int32)
-    return {
+    prefix = {
         "logits": selected_logits,
         "cache": cache,
         "next_pos": next_pos,
         "generated_tokens": generated_tokens,
         "tokens": first_generated_token,
-    }, result
+    }
+    if self.config.decode_sampling_per_request:
+      prefix["sampling_params"] = sampling_params
+    return prefix, result
 
   # Public non-JIT prefill method that updates page state
   def prefill(
@@ -533,18 +597,27 @@ class MaxEngine(engine_api.Engine):
       rng: Optional[PRNGKeyType] = None,
       request_id: Optional[uuid.UUID] = None,  # pylint: disable=unused-argument
       slot: Optional[int] = None,
+      sampling_params: Optional[dict[str, jax.Array]] = None,
   ) -> Tuple[Prefix, engine_api.ResultTokens]:
     """Public API for prefill that updates page state outside JIT."""
     # Update page state before JIT call
+    shared_pages = []
     if self.config.attention == "paged":
+      if self.paged_prefix_cache is not None:
+        prompt_tokens = tuple(jax.device_get(padded_tokens[:true_length]).tolist())
+        shared_pages = self.paged_prefix_cache.lookup(prompt_tokens).block_refs
       self.page_state = self.page_manager.reserve_prefix_slot_pages(
           slot=slot,
           true_length=true_length,
           page_state=self.page_state,
+          shared_pages=shared_pages,
       )
+      if self.paged_prefix_cache is not None:
+        # The pages hold no KV until insert copies the prefix into them, so they are saved by insert.
+        self._pending_prefix_pages[slot] = prompt_tokens
 
     # Call JIT-compiled version with current state
-    return self._prefill_jit(
+    prefix, result = self._prefill_jit(
         params=params,
         existing_prefix=existing_prefix,
         padded_tokens=padded_tokens,
@@ -555,7 +628,29 @@ class MaxEngine(engine_api.Engine):
         slot=slot,
         rng=rng,
         request_id=request_id,
+        sampling_params=sampling_params,
+    )
+    if self.config.attention == "paged":
+      # Shared pages already hold the prefix KV in the pool, insert does not copy them.
+      prefix["num_shared_pages"] = jnp.array(len(shared_pages), dtype=jnp.int32)
+      # bulk_insert shares the pages reserved for this slot with the slots it inserts into.
+      prefix["prefill_slot"] = jnp.array(slot, dtype=jnp.int32)
+    return prefix, result
+
+  def _save_prefix_pages(self, prefill_slot: int, slot: int):
+    """Saves the pages of a prompt prefilled in prefill_slot to the prefix cache, once inserted in slot.
+
+    Called after insert wrote the pages, so that a concurrent prefill sharing them never reads pages
+    without KV. Saving is skipped if prefill_slot has no pending prompt, e.g. it was already saved.
+    """
+    prompt_tokens = self._pending_prefix_pages.pop(prefill_slot, None)
+    if prompt_tokens is None:
+      return
+    retained_pages, released_pages = self.paged_prefix_cache.save(
+        prompt_tokens, jax.device_get(self.page_state.page_map[slot]).tolist()
     )
+    self.page_state = self.page_manager.retain_pages(retained_pages, self.page_state)
+    self.page_state = self.page_manager.release_pages(released_pages, self.page_state)
 
   def prefill_multisampling_aot(  # pylint: disable=too-many-positional-arguments
       self,
@@ -636,6 +731,7 @@ class MaxEngine(engine_api.Engine):
           topk=self.config.decode_sampling_top_k,
           nucleus_topp=self.config.decode_sampling_nucleus_p,
           temperature=self.config.decode_sampling_temperature,
+          nucleus_candidates=self.config.decode_sampling_nucleus_candidates,
       )
       first_generated_tokens.append(first_generated_token)
     first_generated_tokens = jnp.concatenate(first_generated_tokens, axis=0)
@@ -741,6 +837,7 @@ class MaxEngine(engine_api.Engine):
           topk=self.config.decode_sampling_top_k,
           nucleus_topp=self.config.decode_sampling_nucleus_p,
           temperature=self.config.decode_sampling_temperature,
+          nucleus_candidates=self.config.decode_sampling_nucleus_candidates,
       )
       all_valid = jnp.ones(first_generated_token.shape, dtype=jnp.int8)
       result = engine_api.ResultTokens(
@@ -772,6 +869,51 @@ class MaxEngine(engine_api.Engine):
     prefill_results = {k: jnp.stack(v) for k, v in prefill_results.items()}
     return cache, prefill_results, first_tokens
 
+  @functools.partial(jax.jit, static_argnums=(0,))
+  def prefill_concat_logprobs(
+      self,
+      *,
+      params: Params,
+      padded_tokens: jax.Array,
+      decoder_positions: jax.Array,
+      decoder_segment_ids: jax.Array,
+      last_positions: jax.Array,
+      target_tokens: jax.Array,
+      rng: Optional[PRNGKeyType] = None,
+  ) -> jax.Array:
+    """Scores target tokens as the next token of several prompts packed in one prefill sequence.
+
+    The prompts are packed as in prefill_concat. Only the log probabilities of target_tokens are
+    returned and the kv-cache is dropped, so nothing but a [prompts, targets] array leaves the device.
+
+    Args:
+      params: Model parameters.
+      padded_tokens: Packed tokens of the prompts, padded to the prefill length.
+      decoder_positions: int values indicating the position of token in its
+        original sequence.
+      decoder_segment_ids: int values indicating which sequence the the token
+        originally belong to, 0 for padding.
+      last_positions: Position of the last token of each prompt in padded_tokens.
+      target_tokens: Token ids to score after each prompt.
+    Returns:
+      Log probabilities of target_tokens after each prompt, shaped [len(last_positions), len(target_tokens)].
+    """
+    if rng is None:
+      rng = jax.random.PRNGKey(0)
+    with self._mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
+      flat_logits, _ = self.model.apply(
+          params,
+          jnp.expand_dims(padded_tokens, 0),
+          jnp.expand_dims(decoder_positions, 0),
+          decoder_segment_ids=jnp.expand_dims(decoder_segment_ids, 0),
+          enable_dropout=False,
+          model_mode=common_types.MODEL_MODE_PREFILL,
+          rngs={"params": rng},
+          mutable=["cache"],
+      )
+    logprobs = jax.nn.log_softmax(flat_logits[0, last_positions].astype(jnp.float32), axis=-1)
+    return logprobs[:, target_tokens]
+
   def prefill_insert(  # pylint: disable=too-many-positional-arguments
       self,
       padded_tokens: jax.Array,
@@ -782,6 +924,13 @@ class MaxEngine(engine_api.Engine):
       params: Params,
   ) -> DecodeState:
     """Prefill and insert a single computed prefill cache into KV cache."""
+    if self.paged_prefix_cache is not None:
+      # prefill_insert is jitted as a whole, e.g. by inference_microbenchmark, but the paged prefix cache
+      # looks up and saves the prompt pages on the host between prefill and insert.
+      raise ValueError(
+          "prefill_insert does not support the paged prefix cache, call prefill and insert instead or set"
+          " pagedattn_prefix_caching_num_pages=0."
+      )
 
     prefix, _ = self.prefill(params=params, padded_tokens=padded_tokens, true_length=true_length, rng=rng)
     return self.insert(prefix, decode_state, slot)
@@ -795,8 +944,17 @@ class MaxEngine(engine_api.Engine):
       rng: Optional[PRNGKeyType] = None,
   ) -> Tuple[DecodeState, engine_api.ResultTokens]:
     """Public API for generate that updates page state outside JIT."""
-    # Update page state before JIT call
+    if self.config.attention == "paged" and self.config.pagedattn_fuse_page_allocation:
+      new_state, result, self.page_state = self._generate_paged_jit(
+          params=params,
+          decode_state=decode_state,
+          sampler=sampler,
+          page_state=self.page_state,
+          rng=rng,
+      )
+      return new_state, result
 
+    # Update page state before JIT call
     if self.config.attention == "paged":
       self.page_state = self.page_manager.reserve_decode_step_pages(self.page_state)
 
@@ -811,6 +969,27 @@ class MaxEngine(engine_api.Engine):
 
     return new_state, result
 
+  @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
+  def _generate_paged_jit(
+      self,
+      params: Params,
+      decode_state: DecodeState,
+      *,
+      sampler: Optional[Callable[[Any], Any]] = None,  # pylint: disable=unused-argument
+      rng: Optional[PRNGKeyType] = None,
+      page_state: PageState,
+  ) -> Tuple[DecodeState, engine_api.ResultTokens, PageState]:
+    """Reserve the decode step pages and run one generate step in a single computation."""
+    page_state = self.page_manager.reserve_decode_step_pages(page_state)
+    new_state, result = self._generate_jit(
+        params=params,
+        decode_state=decode_state,
+        sampler=sampler,
+        rng=rng,
+        page_state=page_state,
+    )
+    return new_state, result, page_state
+
   @functools.partial(jax.jit, static_argnums=(0,), donate_argnums=(2,))
   def _generate_jit(
       self,
@@ -842,14 +1021,20 @@ class MaxEngine(engine_api.Engine):
     out_logits = jax.lax.with_sharding_constraint(out_logits, self.replicated_sharding)
     new_cache = jax.lax.with_sharding_constraint(new_vars["cache"], self.kv_cache_shardings)
     # sampling tokens
-    new_token = inference_utils.sampling(
-        out_logits,
-        rng,
-        self.config.decode_sampling_strategy,
-        topk=self.config.decode_sampling_top_k,
-        nucleus_topp=self.config.decode_sampling_nucleus_p,
-        temperature=self.config.decode_sampling_temperature,
-    )
+    if self.config.decode_sampling_per_request:
+      new_token = inference_utils.sampling_per_slot(
+          out_logits, rng, decode_state["sampling_params"], decode_state["generated_tokens"][:, 0] + 1
+      )
+    else:
+      new_token = inference_utils.sampling(
+          out_logits,
+          rng,
+          self.config.decode_sampling_strategy,
+          topk=self.config.decode_sampling_top_k,
+          nucleus_topp=self.config.decode_sampling_nucleus_p,
+          temperature=self.config.decode_sampling_temperature,
+          nucleus_candidates=self.config.decode_sampling_nucleus_candidates,
+      )
     all_valid = jnp.ones(new_token.shape, dtype=jnp.int8)
     result = engine_api.ResultTokens(
         data=jnp.concatenate((new_token, all_valid, decode_state["generated_tokens"]), axis=1),
@@ -864,13 +1049,49 @@ class MaxEngine(engine_api.Engine):
         samples_per_slot=1,
     )
 
-    return {
+    new_decode_state = {
         "logits": out_logits,
         "cache": new_cache,
         "next_pos": decode_state["next_pos"] + 1,
         "generated_tokens": decode_state["generated_tokens"] + 1,
         "tokens": new_token,
-    }, result
+    }
+    if self.config.decode_sampling_per_request:
+      new_decode_state["sampling_params"] = decode_state["sampling_params"]
+    return new_decode_state, result
+
+  def bulk_insert(
+      self,
+      prefix: Prefix,
+      decode_state: DecodeState,
+      slots: list[int],
+  ) -> DecodeState:
+    """Insert a single computed prefill cache into multiple slots in KV cache.
+
+    With paged attention, the slots share the full pages of the prompt reserved by prefill, and only
+    the trailing partial page, which decode writes to, is allocated to each slot. The pages of the
+    prefill slot are released if it is not one of the slots.
+    """
+    page_state = None
+    prefill_slot = None
+    if self.config.attention == "paged" and self.page_state is not None:
+      true_length = int(jax.device_get(prefix["next_pos"]).reshape(-1)[0])
+      prefill_slot = int(jax.device_get(prefix["prefill_slot"]))
+      num_full_pages = true_length // self.page_manager.tokens_per_page
+      full_pages = jax.device_get(self.page_state.page_map[prefill_slot, :num_full_pages]).tolist()
+      for slot in slots:
+        if slot != prefill_slot:
+          self.page_state = self.page_manager.reserve_prefix_slot_pages(
+              slot=slot, true_length=true_length, page_state=self.page_state, shared_pages=full_pages
+          )
+      if prefill_slot not in slots:
+        # The slots hold the full pages now, so this only frees the partial page of the prefill slot.
+        self.page_state = self.page_manager.release_slot_pages(prefill_slot, self.page_state)
+      page_state = self.page_state
+    decode_state = self._bulk_insert_jit(prefix, decode_state, jnp.asarray(slots, dtype=jnp.int32), page_state=page_state)
+    if prefill_slot is not None and self._pending_prefix_pages:
+      self._save_prefix_pages(prefill_slot, slots[0])
+    return decode_state
 
   @functools.partial(
       jax.jit,
@@ -880,16 +1101,18 @@ class MaxEngine(engine_api.Engine):
           2,
       ),
   )
-  def bulk_insert(
+  def _bulk_insert_jit(
       self,
       prefix: Prefix,
       decode_state: DecodeState,
-      slots: list[int],
+      slots: jax.Array,
+      page_state: Optional[PageState] = None,
   ) -> DecodeState:
-    """Insert a single computed prefill cache into multiple slots in KV cache."""
+    """Inserts the prefix into all slots with one scatter per cache leaf and decode state field."""
     unboxed_prefix = max_utils.unbox_logicallypartioned(prefix)
 
     unboxed_prefix["cache"] = self._maybe_unstack_prefill_result_cache(unboxed_prefix["cache"])
+    num_slots = slots.shape[0]
 
     def copy(path, partial_cache, full_cache, annotations):
       path_key = path[-1].key
@@ -911,73 +1134,94 @@ class MaxEngine(engine_api.Engine):
       if batch_idx < 0:
         raise ValueError(f"Batch index {batch_idx=} shouldn't be less than zero for {path_key}, got {annotations=}")
 
-      for slot in slots:
-        if path_key == "cache_ar_segment_id":
-          ### goal: zero this out in case there is existing data
-          s = list(full_cache.shape)
-          s[batch_idx] = 1
-          zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
-          full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
-        elif path_key == "cache_prefill_segment_id":
-          s = list(full_cache.shape)
-          s[batch_idx] = 1
-          zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
-          ## zero out in case prefill cache is too small to cover
-          full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
-          ## copy prefill cachce
-          full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
-        elif path_key == "cached_ar_lengths":
-          full_cache = full_cache.at[slot].set(0)
-        elif path_key in [
-            "cached_prefill_key",
-            "cached_prefill_value",
-            "cached_prefill_key_scale",
-            "cached_prefill_value_scale",
-        ]:
-          full_cache = jax.lax.dynamic_update_index_in_dim(full_cache, partial_cache, slot, batch_idx)
-        else:
-          raise ValueError(f"We don't have a strategy for inserting {path_key}")
-
-      return full_cache
+      # The prefix has a batch of 1, which broadcasts to all the slots.
+      slot_locations = [slice(None)] * full_cache.ndim
+      slot_locations[batch_idx] = slots
+      slot_locations = tuple(slot_locations)
+      if path_key in ["cache_ar_segment_id", "cached_ar_lengths"]:
+        return full_cache.at[slot_locations].set(0, unique_indices=True)
+      elif path_key in [
+          "cache_prefill_segment_id",
+          "cached_prefill_key",
+          "cached_prefill_value",
+          "cached_prefill_key_scale",
+          "cached_prefill_value_scale",
+      ]:
+        return full_cache.at[slot_locations].set(partial_cache, unique_indices=True)
+      else:
+        raise ValueError(f"We don't have a strategy for inserting {path_key}")
 
-    inserted_cache = jax.tree_util.tree_map_with_path(
-        copy,
-        unboxed_prefix["cache"],
-        decode_state["cache"],
-        self.kv_cache_annotations_named,
-    )
+    def copy_paged(path, prefix_cache, decode_state_cache):
+      path_key = path[-1].key
+      if path_key in ["key_pages", "value_pages"]:
+        # [num_kv_heads, num_pages, tokens_per_page, head_dim], the prefix holding the pages of the prompt in order.
+        num_prefix_pages = prefix_cache.shape[1]
+        page_idx = jnp.arange(num_prefix_pages)[None, :]
+        # As in insert, pages shared through the prefix cache already hold the KV. The other full pages
+        # are shared by all slots and written once, the partial page is written to each slot.
+        used = jnp.logical_and(page_idx >= num_shared_pages, page_idx < page_state.num_pages_used[slots][:, None])
+        used = jnp.logical_and(used, jnp.logical_or(page_idx >= num_full_pages, jnp.arange(num_slots)[:, None] == 0))
+        # Pages not written point past the end of the pool and are dropped by the scatter.
+        dest_pages = jnp.where(used, page_state.page_map[slots, :num_prefix_pages], decode_state_cache.shape[1])
+        return decode_state_cache.at[:, dest_pages].set(prefix_cache[:, None], mode="drop")
+      else:
+        raise ValueError(f"We don't have a strategy for inserting {path_key} for paged attention.")
 
-    for i, slot in enumerate(slots):
-      decode_state["logits"] = jax.lax.dynamic_update_index_in_dim(decode_state["logits"], unboxed_prefix["logits"], slot, 0)
-      decode_state["next_pos"] = jax.lax.dynamic_update_index_in_dim(
-          decode_state["next_pos"], unboxed_prefix["next_pos"], slot, 0
-      )
-      decode_state["generated_tokens"] = jax.lax.dynamic_update_index_in_dim(
-          decode_state["generated_tokens"],
-          jnp.expand_dims(unboxed_prefix["generated_tokens"][i], axis=0),
-          slot,
-          0,
+    if page_state is not None:
+      num_shared_pages = unboxed_prefix.get("num_shared_pages", 0)
+      num_full_pages = unboxed_prefix["next_pos"].reshape(-1)[0] // self.page_manager.tokens_per_page
+      inserted_cache = jax.tree_util.tree_map_with_path(
+          copy_paged,
+          unboxed_prefix["cache"],
+          decode_state["cache"],
       )
-      decode_state["tokens"] = jax.lax.dynamic_update_index_in_dim(
-          decode_state["tokens"],
-          jnp.expand_dims(unboxed_prefix["tokens"][i], axis=0),
-          slot,
-          0,
+    else:
+      inserted_cache = jax.tree_util.tree_map_with_path(
+          copy,
+          unboxed_prefix["cache"],
+          decode_state["cache"],
+          self.kv_cache_annotations_named,
       )
 
-    inserted_logits = jax.lax.with_sharding_constraint(decode_state["logits"], self.replicated_sharding)
-    inserted_generated_tokens = jax.lax.with_sharding_constraint(decode_state["generated_tokens"], self.replicated_sharding)
-    inserted_next_pos = jax.lax.with_sharding_constraint(decode_state["next_pos"], self.replicated_sharding)
-    inserted_tokens = jax.lax.with_sharding_constraint(decode_state["tokens"], self.replicated_sharding)
+    inserted_logits = decode_state["logits"].at[slots].set(unboxed_prefix["logits"], unique_indices=True)
+    inserted_next_pos = decode_state["next_pos"].at[slots].set(unboxed_prefix["next_pos"], unique_indices=True)
+    # Multisampling prefixes hold one generated token per slot.
+    generated_tokens = unboxed_prefix["generated_tokens"][:num_slots]
+    inserted_generated_tokens = decode_state["generated_tokens"].at[slots].set(generated_tokens, unique_indices=True)
+    inserted_tokens = decode_state["tokens"].at[slots].set(unboxed_prefix["tokens"][:num_slots], unique_indices=True)
+
+    inserted_logits = jax.lax.with_sharding_constraint(inserted_logits, self.replicated_sharding)
+    inserted_generated_tokens = jax.lax.with_sharding_constraint(inserted_generated_tokens, self.replicated_sharding)
+    inserted_next_pos = jax.lax.with_sharding_constraint(inserted_next_pos, self.replicated_sharding)
+    inserted_tokens = jax.lax.with_sharding_constraint(inserted_tokens, self.replicated_sharding)
     inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
 
-    return {
+    new_decode_state = {
         "logits": inserted_logits,
         "cache": inserted_cache,
         "next_pos": inserted_next_pos,
         "generated_tokens": inserted_generated_tokens,
         "tokens": inserted_tokens,
     }
+    if self.config.decode_sampling_per_request:
+      new_decode_state["sampling_params"] = self._insert_sampling_params(
+          decode_state["sampling_params"], unboxed_prefix.get("sampling_params"), slots
+      )
+    return new_decode_state
+
+  # Public non-JIT insert method that saves the inserted pages to the prefix cache
+  def insert(
+      self,
+      prefix: Prefix,
+      decode_state: DecodeState,
+      slot: int,
+      request_id: Optional[uuid.UUID] = None,
+  ) -> DecodeState:
+    """Insert a single computed prefill cache into KV cache."""
+    decode_state = self._insert_jit(prefix, decode_state, slot, request_id=request_id)
+    if self._pending_prefix_pages:
+      self._save_prefix_pages(slot, slot)
+    return decode_state
 
   @functools.partial(
       jax.jit,
@@ -988,7 +1232,7 @@ class MaxEngine(engine_api.Engine):
       ),
       static_argnames=("request_id",),
   )
-  def insert(
+  def _insert_jit(
       self,
       prefix: Prefix,
       decode_state: DecodeState,
@@ -1048,6 +1292,7 @@ class MaxEngine(engine_api.Engine):
         raise ValueError(f"We don't have a strategy for inserting {path_key}")
 
     if self.config.attention == "paged" and self.page_state is not None:
+      num_shared_pages = unboxed_prefix.get("num_shared_pages", 0)
 
       def _copy_paged(path, prefix_cache, decode_state_cache):
         path_key = path[-1].key
@@ -1062,7 +1307,7 @@ class MaxEngine(engine_api.Engine):
             return decode_state_pages, prefix_pages, page_map
 
           decode_state_cache, _, _ = jax.lax.fori_loop(
-              0,
+              num_shared_pages,
               self.page_state.num_pages_used[slot],
               _update_pages,
               (decode_state_cache, prefix_cache, self.page_state.page_map[slot]),
@@ -1100,13 +1345,18 @@ class MaxEngine(engine_api.Engine):
     inserted_tokens = jax.lax.with_sharding_constraint(inserted_tokens, self.replicated_sharding)
     inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
 
-    return {
+    new_decode_state = {
         "logits": inserted_logits,
         "cache": inserted_cache,
         "next_pos": inserted_next_pos,
         "generated_tokens": inserted_generated_tokens,
         "tokens": inserted_tokens,
     }
+    if self.config.decode_sampling_per_request:
+      new_decode_state["sampling_params"] = self._insert_sampling_params(
+          decode_state["sampling_params"], unboxed_prefix.get("sampling_params"), [slot]
+      )
+    return new_decode_state
 
   @functools.partial(
       jax.jit,
@@ -1160,7 +1410,10 @@ class MaxEngine(engine_api.Engine):
 
       if path_key == "cache_ar_segment_id":
         ### goal: zero this out in case there is existing data
-        zeros = jnp.zeros((1, self.config.max_target_length - self.config.max_prefill_predict_length), dtype=jnp.int32)
+        # Sized from the cache, as sliding window layers keep a ring buffer of the window instead.
+        s = list(full_cache.shape)
+        s[batch_idx] = 1
+        zeros = jnp.zeros(tuple(s), dtype=jnp.int32)
         return jax.lax.dynamic_update_index_in_dim(full_cache, zeros, slot, batch_idx)
       elif path_key == "cache_prefill_segment_id":
         zeros = jnp.zeros((1, self.config.max_prefill_predict_length), dtype=jnp.int32)
@@ -1226,22 +1479,60 @@ class MaxEngine(engine_api.Engine):
     inserted_tokens = jax.lax.with_sharding_constraint(inserted_tokens, self.replicated_sharding)
     inserted_cache = jax.lax.with_sharding_constraint(inserted_cache, self.kv_cache_shardings)
 
-    return {
+    new_decode_state = {
         "logits": inserted_logits,
         "cache": inserted_cache,
         "next_pos": inserted_next_pos,
         "generated_tokens": inserted_generated_tokens,
         "tokens": inserted_tokens,
     }
+    if self.config.decode_sampling_per_request:
+      new_decode_state["sampling_params"] = self._insert_sampling_params(
+          decode_state["sampling_params"], unboxed_prefix.get("sampling_params"), [slots[i] for i in range(num_prompts)]
+      )
+    return new_decode_state
+
+  def _default_sampling_params(self, batch_size: int) -> dict[str, jax.Array]:
+    """Sampling parameters of the engine config, used by requests without their own."""
+    return inference_utils.make_sampling_params(
+        self.config.decode_sampling_strategy,
+        topk=self.config.decode_sampling_top_k,
+        nucleus_topp=self.config.decode_sampling_nucleus_p,
+        temperature=self.config.decode_sampling_temperature,
+        batch_size=batch_size,
+    )
+
+  def _insert_sampling_params(
+      self,
+      sampling_params: dict[str, jax.Array],
+      prefix_sampling_params: Optional[dict[str, jax.Array]],
+      slots: List[int] | jax.Array,
+  ) -> dict[str, jax.Array]:
+    """Writes the sampling parameters of a prefix into the given slots of the decode state."""
+    if prefix_sampling_params is None:
+      prefix_sampling_params = self._default_sampling_params(batch_size=1)
+    slots = jnp.asarray(slots, dtype=jnp.int32)
+    sampling_params = jax.tree.map(
+        lambda full, new: full.at[slots].set(new, unique_indices=True),
+        sampling_params,
+        prefix_sampling_params,
+    )
+    return jax.lax.with_sharding_constraint(sampling_params, self.replicated_sharding)
 
   def get_prefix_destination_sharding(self) -> Any:
-    return {
+    sharding = {
         "logits": self.replicated_sharding,
         "cache": self.prefill_kv_cache_shardings,
         "next_pos": self.replicated_sharding,
         "generated_tokens": self.replicated_sharding,
         "tokens": self.replicated_sharding,
     }
+    if self.config.decode_sampling_per_request:
+      sharding["sampling_params"] = self.replicated_sharding
+    if self.config.attention == "paged":
+      sharding["num_shared_pages"] = self.replicated_sharding
+      sharding["prefill_slot"] = self.replicated_sharding
+    return sharding
 
   def get_tokenizer(self) -> TokenizerParameters:
     """Return a protobuf of tokenizer info, callable from Py or C++."""
@@ -1258,11 +1549,11 @@ class MaxEngine(engine_api.Engine):
       raise KeyError(f"Unsupported tokenizer type: {self.config.tokenizer_type}") from None
 
   def build_tokenizer(self, metadata: TokenizerParameters) -> tokenizer_api.Tokenizer:
-    """Return a tokenizer"""
+    """Return a tokenizer, wrapped in a BatchTokenizer"""
     if metadata.tokenizer_type == TokenizerType.tiktoken:
-      return token_utils.TikToken(metadata)
+      tokenizer_model = token_utils.TikToken(metadata)
     elif metadata.tokenizer_type == TokenizerType.sentencepiece:
-      return token_utils.SentencePieceTokenizer(metadata)
+      tokenizer_model = token_utils.SentencePieceTokenizer(metadata)
     elif metadata.tokenizer_type == TokenizerType.huggingface:
       tokenizer_model = token_utils.HuggingFaceTokenizer(metadata)
       if tokenizer_model.tokenizer.pad_token_id is None:
@@ -1270,9 +1561,9 @@ class MaxEngine(engine_api.Engine):
           tokenizer_model.tokenizer.pad_token_id = tokenizer_model.tokenizer.unk_token_id
         else:
           tokenizer_model.tokenizer.pad_token_id = -1
-      return tokenizer_model
     else:
       raise ValueError(f"Unsupported tokenizer type: {metadata.tokenizer_type}")
+    return BatchTokenizer(tokenizer_model, self.config.tokenizer_encode_cache_size)
 
   def init_decode_state(
       self,
@@ -1327,7 +1618,7 @@ class MaxEngine(engine_api.Engine):
           (int(self.config.per_device_batch_size * jax.device_count()), 1),
           dtype=jnp.int32,
       )
-      return {
+      decode_state = {
           "logits": jnp.zeros(
               (
                   int(self.config.per_device_batch_size * jax.device_count()),
@@ -1340,6 +1631,11 @@ class MaxEngine(engine_api.Engine):
           "generated_tokens": generated_tokens,
           "tokens": tokens,
       }
+      if self.config.decode_sampling_per_request:
+        decode_state["sampling_params"] = self._default_sampling_params(
+            batch_size=int(self.config.per_device_batch_size * jax.device_count())
+        )
+      return decode_state
 
     with nn_partitioning.axis_rules(self.config.logical_axis_rules):
       abstract_outputs = jax.eval_shape(init, self.abstract_params, page_state)
@@ -21,6 +21,7 @@ import pathwaysutils  # pylint: disable=unused-import
 from MaxText import pyconfig
 
 from MaxText import maxengine_config
+from MaxText import prefix_cache
 from jetstream.core import server_lib, config_lib
 
 # _PORT = flags.DEFINE_integer('port', 9000, 'port to listen on')
@@ -35,12 +36,30 @@ from jetstream.core import server_lib, config_lib
 
 
 def _create_prefix_caching_config(config) -> config_lib.PrefixCachingConfig | None:
+  """Creates the JetStream prefix caching config.
+
+  JetStream builds its own LRU prefix cache from the HBM and DRAM bytes only. The eviction policy, TTL
+  and disk options apply to the MaxText PrefixCache, e.g. in inference_microbenchmark and the MMLU eval,
+  and are rejected here instead of being silently ignored.
+  """
   if not config.enable_prefix_caching:
     return None
 
   if not config.use_chunked_prefill:
     raise ValueError("Prefix caching requires chunked prefill.")
 
+  # Fail early on invalid policy.
+  prefix_cache.create_eviction_strategy(config.prefix_caching_eviction_policy, config.prefix_caching_ttl_seconds)
+  if config.prefix_caching_eviction_policy != "lru" or config.prefix_caching_ttl_seconds > 0:
+    raise ValueError(
+        "JetStream prefix caching only supports the lru eviction policy, prefix_caching_eviction_policy and"
+        " prefix_caching_ttl_seconds only apply to the MaxText PrefixCache."
+    )
+  if config.prefix_caching_disk_dir:
+    raise ValueError(
+        "JetStream prefix caching has no disk layer, prefix_caching_disk_dir only applies to the MaxText PrefixCache."
+    )
+
   return config_lib.PrefixCachingConfig(
       max_hbm_byte=config.prefix_caching_hbm_byte,
       max_dram_byte=config.prefix_caching_dram_byte,
@@ -54,6 +73,8 @@ def main(config):
   devices = server_lib.get_devices()
   server_config = maxengine_config.get_server_config(config.inference_server, config)
 
+  prefix_caching_config = _create_prefix_caching_config(config)
+
   metrics_server_config: config_lib.MetricsServerConfig | None = None
   if config.prometheus_port != 0:
     metrics_server_config = config_lib.MetricsServerConfig(port=config.prometheus_port)
@@ -73,7 +94,7 @@ def main(config):
       enable_model_warmup=config.enable_model_warmup if config.enable_model_warmup else False,
       lora_input_adapters_path=config.lora_input_adapters_path,
       multi_sampling=config.multi_sampling if config.multi_sampling else False,
-      prefix_caching_config=_create_prefix_caching_config(config),
+      prefix_caching_config=prefix_caching_config,
   )
   jetstream_server.wait_for_termination()
 
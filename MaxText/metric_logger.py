@@ -20,11 +20,18 @@ limitations under the License.
 import jax
 import json
 import os
+import queue
+import shutil
+import threading
+
 import numpy as np
 
 from MaxText import max_logging
 from MaxText.utils import gcs_utils
 
+# Steps of metrics the background writer may fall behind before write_metrics blocks.
+_MAX_PENDING_WRITES = 8
+
 
 def _prepare_metrics_for_json(metrics, step, run_name):
   """Converts metric dictionary into json supported types (e.g. float)"""
@@ -34,48 +41,223 @@ def _prepare_metrics_for_json(metrics, step, run_name):
   return metrics_dict
 
 
+def _start_host_copies(metrics):
+  """Starts copying the metrics to host without waiting for the step that computes them."""
+  for leaf in jax.tree.leaves(metrics):
+    if isinstance(leaf, jax.Array):
+      leaf.copy_to_host_async()
+
+
+class MetricsSink:
+  """Destination of the metrics written by MetricLogger.
+
+  Sinks receive metrics already copied to host, so they never block on the device.
+  """
+
+  def write(self, metrics, step, is_training):
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class LocalFileSink(MetricsSink):
+  """Appends the scalar metrics of each step as a json line to a local file, used for testing."""
+
+  def __init__(self, metrics_file, run_name):
+    self.metrics_file = metrics_file
+    self.run_name = run_name
+
+  def write(self, metrics, step, is_training):
+    with open(self.metrics_file, "a", encoding="utf8") as local_metrics_file:
+      if step == 0:
+        local_metrics_file.truncate(0)
+
+      metrics_dict = _prepare_metrics_for_json(metrics, step, self.run_name)
+      local_metrics_file.write(str(json.dumps(metrics_dict)) + "\n")
+
+
+class TensorBoardSink(MetricsSink):
+  """Writes metrics to TensorBoard, flushing every log_period steps."""
+
+  def __init__(self, writer, tensorboard_dir, log_period):
+    self.writer = writer
+    self.tensorboard_dir = tensorboard_dir
+    self.log_period = log_period
+
+  def write(self, metrics, step, is_training):
+    for metric_name in metrics.get("scalar", []):
+      self.writer.add_scalar(metric_name, metrics["scalar"][metric_name], step)
+    for metric_name in metrics.get("scalars", []):
+      self.writer.add_scalars(metric_name, metrics["scalars"][metric_name], step)
+    for metric_name in metrics.get("histogram", []):
+      self._add_histogram(metric_name, metrics["histogram"][metric_name], step)
+
+    if is_training and step % self.log_period == 0:
+      max_logging.log(f"To see full metrics 'tensorboard --logdir={self.tensorboard_dir}'")
+      self.writer.flush()
+
+  def _add_histogram(self, metric_name, counts, step):
+    """Writes counts over the buckets 0..len(counts)-1, e.g. the load of each expert."""
+    counts = np.asarray(counts, dtype=np.float64)
+    buckets = np.arange(counts.shape[0], dtype=np.float64)
+    self.writer.add_histogram_raw(
+        metric_name,
+        min=0,
+        max=counts.shape[0] - 1,
+        num=counts.sum(),
+        sum=(buckets * counts).sum(),
+        sum_squares=(buckets**2 * counts).sum(),
+        bucket_limits=(buckets + 0.5).tolist(),
+        bucket_counts=counts.tolist(),
+        global_step=step,
+    )
+
+  def close(self):
+    self.writer.flush()
+
+
+def _copy_to_local_store(destination_name, source_file_name):
+  """Stand-in for upload_blob when metrics_dir is a local directory."""
+  os.makedirs(os.path.dirname(destination_name), exist_ok=True)
+  shutil.copyfile(source_file_name, destination_name)
+
+
+class ObjectStoreSink(MetricsSink):
+  """Keeps the metrics of every log_period steps in memory and uploads them as one file.
+
+  Files are uploaded to GCS, or copied when metrics_dir is a local directory.
+  """
+
+  def __init__(self, metrics_dir, run_name, log_period, steps, upload_fn=None):
+    self.metrics_dir = metrics_dir
+    self.run_name = run_name
+    self.log_period = log_period
+    self.steps = steps
+    if upload_fn is None:
+      upload_fn = gcs_utils.upload_blob if metrics_dir.startswith("gs://") else _copy_to_local_store
+    self.upload_fn = upload_fn
+    self.running_metrics = []
+
+  def write(self, metrics, step, is_training):
+    self.running_metrics.append(_prepare_metrics_for_json(metrics, step, self.run_name))
+    if is_training and (step + 1) % self.log_period == 0 or step == self.steps - 1:
+      start_step = (step // self.log_period) * self.log_period
+      metrics_filename = f"metrics_step_{start_step:06}_to_step_{step:06}.txt"
+      with open(metrics_filename, "w", encoding="utf8") as metrics_for_gcs:
+        for metrics_step in self.running_metrics:
+          metrics_for_gcs.write(str(json.dumps(metrics_step)) + "\n")
+
+      gcs_filename = os.path.join(self.metrics_dir, metrics_filename)
+      max_logging.log(f"Moving file {metrics_filename} to {self.metrics_dir}...")
+      self.upload_fn(gcs_filename, metrics_filename)
+      max_logging.log(f"File {metrics_filename} moved successfully!")
+      self.running_metrics = []
+
+
+def create_sinks(writer, config):
+  """Returns the metrics sinks enabled in the config for this process."""
+  sinks = []
+  if config.enable_tensorboard and jax.process_index() == 0:
+    sinks.append(TensorBoardSink(writer, config.tensorboard_dir, config.log_period))
+  if config.metrics_file:
+    sinks.append(LocalFileSink(config.metrics_file, config.run_name))
+  if config.gcs_metrics and jax.process_index() == 0:
+    sinks.append(ObjectStoreSink(config.metrics_dir, config.run_name, config.log_period, config.steps))
+  return sinks
+
+
 class MetricLogger:
   """
   Logger for saving metrics to a local file, GCS and TensorBoard.
   """
 
-  def __init__(self, writer, config):
+  def __init__(self, writer, config, sinks=None):
     self.buffered_step = None
     self.buffered_metrics = None
     self.writer = writer
     self.config = config
+    self.sinks = create_sinks(writer, config) if sinks is None else sinks
+    self._queue = None
+    self._thread = None
+    if config.async_metrics_writer:
+      self._queue = queue.Queue(maxsize=_MAX_PENDING_WRITES)
+      self._thread = threading.Thread(target=self._run_writer, name="metrics_writer", daemon=True)
+      self._thread.start()
 
-  def write_metrics(self, running_gcs_metrics, metrics, step, is_training=True):
+  def write_metrics(self, metrics, step, is_training=True):
     """Entry point for all metrics writing in Train's Main.
 
-    To avoid introducing an unnecessary dependency, we "double buffer" -- we hold
+    Each step's metrics are copied to host with one batched device_get before they reach the sinks.
+
+    With async_metrics_writer, the copies start without blocking and a background thread waits for
+    them and writes the sinks, so slow storage does not add to the step time. The train loop still
+    waits for the previous training step to finish, as with double buffering, so that the step time
+    measured by the caller is the device time rather than the dispatch time. At most
+    _MAX_PENDING_WRITES steps are queued, after which write_metrics waits for the writer.
+
+    Otherwise, to avoid introducing an unnecessary dependency, we "double buffer" -- we hold
     onto the last metrics and step and only publish when we receive a new metrics and step.
     The logic is that this ensures that Jax is able to queues train_steps and we
     don't block when turning "lazy" Jax arrays into real Python numbers.
     """
-    metrics_to_write, steps_to_write = None, None
+    if self._queue is not None:
+      _start_host_copies(metrics)
+      if is_training:
+        if self.buffered_metrics is not None:
+          jax.block_until_ready(self.buffered_metrics)
+        self.buffered_metrics = metrics
+      self._queue.put((metrics, step, is_training))
+      return
+
+    if is_training:
+      metrics, self.buffered_metrics = self.buffered_metrics, metrics
+      step, self.buffered_step = self.buffered_step, step
+      if metrics is None:
+        return
+      if step is None:
+        raise ValueError(f"When writing metrics, {self.buffered_step=} was none")
+    self._write_to_sinks(metrics, step, is_training)
+
+  def flush(self):
+    """Writes the buffered metrics and waits until all metrics written so far reach the sinks."""
+    if self._queue is not None:
+      self._queue.join()
+      self.buffered_metrics = None
+    elif self.buffered_metrics is not None:
+      self._write_to_sinks(self.buffered_metrics, self.buffered_step, is_training=True)
+      self.buffered_metrics, self.buffered_step = None, None
+
+  def close(self):
+    """Flushes all metrics and stops the background writer. Call before closing the summary writer."""
+    self.flush()
+    if self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._queue, self._thread = None, None
+    for sink in self.sinks:
+      sink.close()
+
+  def _run_writer(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        metrics, step, is_training = item
+        try:
+          self._write_to_sinks(metrics, step, is_training)
+        except Exception as e:  # pylint: disable=broad-except
+          max_logging.log(f"Failed to write metrics for step {step}: {e}")
+      finally:
+        self._queue.task_done()
+
+  def _write_to_sinks(self, metrics, step, is_training):
+    metrics = jax.device_get(metrics)
     if is_training:
-      if self.buffered_metrics is not None:
-        if self.buffered_step is None:
-          raise ValueError(f"When writing metrics, {self.buffered_step=} was none")
-        metrics_to_write = self.buffered_metrics
-        steps_to_write = self.buffered_step
-        self.log_metrics(metrics_to_write, steps_to_write)
-      self.buffered_metrics = metrics
-      self.buffered_step = step
-    else:
-      metrics_to_write = metrics
-      steps_to_write = step
-
-    if metrics_to_write:
-      if self.config.enable_tensorboard:
-        self.write_metrics_to_tensorboard(metrics_to_write, steps_to_write, is_training)
-
-      if self.config.metrics_file:
-        self.write_metrics_locally(metrics_to_write, steps_to_write)
-
-      if self.config.gcs_metrics and jax.process_index() == 0:
-        running_gcs_metrics = self.write_metrics_for_gcs(metrics_to_write, steps_to_write, running_gcs_metrics, is_training)
+      self.log_metrics(metrics, step)
+    for sink in self.sinks:
+      sink.write(metrics, step, is_training)
 
   def log_metrics(self, metrics, step):
     """Logs metrics via max_logging"""
@@ -86,45 +268,3 @@ class MetricLogger:
         f"total_weights: {metrics['scalar']['learning/total_weights']}, "
         f"loss: {metrics['scalar']['learning/loss']:.3f}"
     )
-
-  def write_metrics_locally(self, metrics, step):
-    """Writes metrics locally for testing"""
-    with open(self.config.metrics_file, "a", encoding="utf8") as local_metrics_file:
-      if step == 0:
-        local_metrics_file.truncate(0)
-
-      metrics_dict = _prepare_metrics_for_json(metrics, step, self.config.run_name)
-      local_metrics_file.write(str(json.dumps(metrics_dict)) + "\n")
-
-  def write_metrics_for_gcs(self, metrics, step, running_metrics, is_training):
-    """Writes metrics to gcs"""
-    metrics_dict_step = _prepare_metrics_for_json(metrics, step, self.config.run_name)
-    running_metrics.append(metrics_dict_step)
-    if is_training and (step + 1) % self.config.log_period == 0 or step == self.config.steps - 1:
-      start_step = (step // self.config.log_period) * self.config.log_period
-      metrics_filename = f"metrics_step_{start_step:06}_to_step_{step:06}.txt"
-      with open(metrics_filename, "w", encoding="utf8") as metrics_for_gcs:
-        for metrics_step in running_metrics:
-          metrics_for_gcs.write(str(json.dumps(metrics_step)) + "\n")
-
-      gcs_filename = os.path.join(self.config.metrics_dir, metrics_filename)
-      max_logging.log(f"Moving file {metrics_filename} to GCS...")
-      gcs_utils.upload_blob(gcs_filename, metrics_filename)
-      max_logging.log(f"File {metrics_filename} moved successfully!")
-      running_metrics = []  # reset running_metrics to empty list
-    return running_metrics
-
-  def write_metrics_to_tensorboard(self, metrics, step, is_training):
-    """Writes metrics to TensorBoard"""
-    if jax.process_index() == 0:
-      for metric_name in metrics.get("scalar", []):
-        self.writer.add_scalar(metric_name, np.array(metrics["scalar"][metric_name]), step)
-      for metric_name in metrics.get("scalars", []):
-        self.writer.add_scalars(metric_name, metrics["scalars"][metric_name], step)
-
-    if is_training:
-      full_log = step % self.config.log_period == 0
-
-      if full_log and jax.process_index() == 0:
-        max_logging.log(f"To see full metrics 'tensorboard --logdir={self.config.tensorboard_dir}'")
-        self.writer.flush()
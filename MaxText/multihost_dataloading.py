@@ -24,6 +24,8 @@ from functools import lru_cache, partial  # pylint: disable=g-importing-member
 from typing import Callable, Any, Union, Sequence
 from collections.abc import Iterator, Iterable
 import tensorflow as tf  # pylint: disable=g-import-not-at-top
+import queue
+import threading
 import time
 import numpy as np
 
@@ -93,23 +95,45 @@ def get_next_batch_sharded(local_iterator: Iterator, global_mesh: Mesh) -> jax.A
 
 
 class MultiHostDataLoadIterator:
-  """fold get_next_batch_sharded into a iterator class"""
+  """fold get_next_batch_sharded into a iterator class
 
-  def __init__(self, dataloader: Union[tf.data.Dataset, Iterable], global_mesh: Mesh):
+  With prefetch_depth > 0, a background thread loads up to prefetch_depth global batches ahead
+  of the training step. local_iterator then checkpoints the state after the last batch returned
+  by __next__, so batches in the prefetch buffer are not skipped on restore.
+  """
+
+  def __init__(self, dataloader: Union[tf.data.Dataset, Iterable], global_mesh: Mesh, prefetch_depth: int = 0):
     self.global_mesh = global_mesh
     self.dataloader = dataloader
-    if isinstance(self.dataloader, tf.data.Dataset):
-      self.local_iterator = self.dataloader.as_numpy_iterator()
-    elif isinstance(self.dataloader, Iterable):
-      self.local_iterator = iter(self.dataloader)
-    else:
-      raise ValueError("Type error: dataloader should be either tf.data.Dataset or Iterable.")
+    self.prefetch_depth = prefetch_depth
+    self._prefetch_thread = None
+    self._prefetch_queue = None
+    self._prefetch_stop = None
+    self._prefetch_error = None
+    self._iterator_state = None
+    self._prefetch_metrics = {}
+    self.reset()
+
+  @property
+  def local_iterator(self):
+    if self._prefetch_thread is not None and hasattr(self._local_iterator, "get_state"):
+      return _PrefetchIteratorCheckpoint(self)
+    return self._local_iterator
+
+  @local_iterator.setter
+  def local_iterator(self, local_iterator):
+    if isinstance(local_iterator, _PrefetchIteratorCheckpoint):
+      # Restored in place by _PrefetchIteratorCheckpoint.set_state.
+      return
+    self._stop_prefetch()
+    self._local_iterator = local_iterator
 
   def reset(self):
+    self._stop_prefetch()
     if isinstance(self.dataloader, tf.data.Dataset):
-      self.local_iterator = self.dataloader.as_numpy_iterator()
+      self._local_iterator = self.dataloader.as_numpy_iterator()
     elif isinstance(self.dataloader, Iterable):
-      self.local_iterator = iter(self.dataloader)
+      self._local_iterator = iter(self.dataloader)
     else:
       raise ValueError("Type error: dataloader should be either tf.data.Dataset or grain.DataLoader.")
 
@@ -118,7 +142,102 @@ class MultiHostDataLoadIterator:
     return self
 
   def __next__(self):
-    return get_next_batch_sharded(self.local_iterator, self.global_mesh)
+    if self.prefetch_depth <= 0:
+      return get_next_batch_sharded(self._local_iterator, self.global_mesh)
+    if self._prefetch_error is not None:
+      raise self._prefetch_error
+    if self._prefetch_thread is None:
+      self._start_prefetch()
+
+    queue_depth = self._prefetch_queue.qsize()
+    start = time.perf_counter()
+    input_gdas, iterator_state, error = self._prefetch_queue.get()
+    self._prefetch_metrics = {
+        "perf/data_prefetch_queue_depth": queue_depth,
+        "perf/data_prefetch_stall_seconds": time.perf_counter() - start,
+    }
+    if error is not None:
+      self._prefetch_error = error
+      raise error
+    self._iterator_state = iterator_state
+    return input_gdas
+
+  def get_prefetch_metrics(self) -> dict[str, float]:
+    """Prefetch buffer depth and time waited for the batch when __next__ was last called."""
+    return self._prefetch_metrics
+
+  def _start_prefetch(self):
+    if hasattr(self._local_iterator, "get_state"):
+      self._iterator_state = self._local_iterator.get_state()
+    self._prefetch_queue = queue.Queue(maxsize=self.prefetch_depth)
+    self._prefetch_stop = threading.Event()
+    self._prefetch_thread = threading.Thread(
+        target=self._prefetch,
+        args=(self._local_iterator, self._prefetch_queue, self._prefetch_stop),
+        name="multihost_dataloading_prefetch",
+        daemon=True,
+    )
+    self._prefetch_thread.start()
+
+  def _stop_prefetch(self):
+    """Stops the prefetch thread and drops the prefetched batches."""
+    if self._prefetch_thread is None:
+      return
+    self._prefetch_stop.set()
+    while self._prefetch_thread.is_alive():
+      try:
+        self._prefetch_queue.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    self._prefetch_thread = None
+    self._prefetch_queue = None
+    self._prefetch_error = None
+
+  def _prefetch(self, local_iterator, prefetch_queue, stop):
+    """Loads global batches into prefetch_queue, along with the iterator state after each batch."""
+    while not stop.is_set():
+      try:
+        input_gdas = get_next_batch_sharded(local_iterator, self.global_mesh)
+        iterator_state = local_iterator.get_state() if hasattr(local_iterator, "get_state") else None
+        item = (input_gdas, iterator_state, None)
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        # Raised in __next__, including StopIteration at the end of the data.
+        item = (None, None, e)
+      while not stop.is_set():
+        try:
+          prefetch_queue.put(item, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      if item[2] is not None:
+        return
+
+  def _checkpoint_state(self):
+    if self._prefetch_thread is None:
+      return self._local_iterator.get_state()
+    return self._iterator_state
+
+  def _restore_state(self, state):
+    self._stop_prefetch()
+    self._local_iterator.set_state(state)
+
+
+class _PrefetchIteratorCheckpoint:
+  """Checkpoints a prefetching MultiHostDataLoadIterator with PyGrainCheckpointSave and PyGrainCheckpointRestore."""
+
+  def __init__(self, iterator: MultiHostDataLoadIterator):
+    self._iterator = iterator
+
+  def get_state(self):
+    return self._iterator._checkpoint_state()  # pylint: disable=protected-access
+
+  def set_state(self, state):
+    self._iterator._restore_state(state)  # pylint: disable=protected-access
+
+  def start_prefetch(self):
+    # pylint: disable=protected-access
+    if hasattr(self._iterator._local_iterator, "start_prefetch"):
+      self._iterator._local_iterator.start_prefetch()
 
 
 @colocated_python.colocated_python
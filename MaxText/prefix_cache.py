@@ -58,16 +58,34 @@ if cached_prefix is None or matched_len != orig_key_len:
         tokens=full_key,
     ))
 
+iv) Block granular reuse
+
+PrefixCacheRadixTree indexes prompts by fixed-size token blocks and returns the exact matched length
+with KV reference of each matched block, so prefill only needs to compute the unmatched suffix.
+
+tree = PrefixCacheRadixTree(block_size=page_size)
+tree.insert(full_key, block_refs=pages_of_full_key)
+match = tree.match(new_key)
+prefill(new_key[match.matched_length:], cached_blocks=match.block_refs)
 """
 
 from collections import OrderedDict
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, Optional, Sequence, Tuple
 import abc
+import concurrent.futures
 import dataclasses
+import functools
+import hashlib
+import heapq
+import itertools
 import jax
 import jax.numpy as jnp
+import json
 import logging
+import numpy as np
+import os
 import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -174,6 +192,18 @@ class Value:
     return min(true_length, len(tokens))
 
 
+def _with_prefix(value: Value, prefix: Prefix) -> Value:
+  """Create a new value with prefix replaced and other attributes kept."""
+  return Value(
+      prefix=prefix,
+      true_length=value.true_length,
+      padded_length=value.padded_length,
+      tokens=value.tokens,
+      prefix_size_bytes=value.prefix_size_bytes,
+      device=value.device,
+  )
+
+
 def device_put_value(value: Value, device: Any = None) -> Value:
   """Create a new value with prefix put to device.
 
@@ -190,14 +220,7 @@ def device_put_value(value: Value, device: Any = None) -> Value:
   put_device = device
   if put_device is None:
     put_device = value.device
-  return Value(
-      prefix=jax.device_put(value.prefix, put_device),
-      true_length=value.true_length,
-      padded_length=value.padded_length,
-      tokens=value.tokens,
-      prefix_size_bytes=value.prefix_size_bytes,
-      device=value.device,
-  )
+  return _with_prefix(value, jax.device_put(value.prefix, put_device))
 
 
 class PrefixCacheTrie:
@@ -281,6 +304,194 @@ class PrefixCacheTrie:
       node = parent
 
 
+@dataclasses.dataclass
+class RadixMatch:
+  """Result of PrefixCacheRadixTree.match.
+
+  Attributes:
+    matched_length: Number of leading tokens of the key matched. Always a multiple of block_size.
+    block_refs: KV reference of each matched block in order. len(block_refs) * block_size == matched_length.
+  """
+
+  matched_length: int = 0
+  block_refs: list[Any] = dataclasses.field(default_factory=list)
+
+
+class PrefixCacheRadixTree:
+  """Compressed radix tree of token blocks mapping every cached block to its KV reference.
+
+  Keys are split into fixed-size blocks of block_size tokens and the trailing partial block is ignored.
+  Each edge stores a run of blocks with the KV reference of every block, so match returns the exact
+  matched length and the references of the matched blocks, even if the match ends in the middle of a stored key.
+  The caller only need to prefill the unmatched suffix key[matched_length:].
+
+  The lookup is one dict access per edge and one block comparison per block,
+  scaling with the number of blocks instead of the number of tokens.
+
+  The KV reference is opaque to the tree, e.g. page indices or slices of a cached prefix.
+  Insert a key sharing blocks with stored keys keeps the stored references of the shared blocks.
+  Erase follows PrefixCacheTrie: a key not ending at a leaf is ignored,
+  and a key ending at a leaf removes the blocks up to the nearest branch.
+  """
+
+  @dataclasses.dataclass
+  class Node:
+    """Radix tree node with the edge of blocks from parent to the node."""
+
+    parent: Optional["PrefixCacheRadixTree.Node"] = None
+    blocks: list[Key] = dataclasses.field(default_factory=list)
+    block_refs: list[Any] = dataclasses.field(default_factory=list)
+    children: dict[Key, "PrefixCacheRadixTree.Node"] = dataclasses.field(default_factory=dict)
+
+    def is_leaf(self):
+      return len(self.children) == 0
+
+  def __init__(self, block_size: int):
+    """
+    Args:
+      block_size: Number of tokens in a block. Should be > 0.
+    """
+    assert block_size > 0, "block_size should be > 0."
+    self._block_size = block_size
+    self._root = PrefixCacheRadixTree.Node()
+    self._num_blocks = 0
+
+  @property
+  def block_size(self) -> int:
+    return self._block_size
+
+  @property
+  def num_blocks(self) -> int:
+    """Number of distinct blocks stored in the tree."""
+    return self._num_blocks
+
+  def split_blocks(self, key: Key) -> list[Key]:
+    """Split key into full blocks, dropping the trailing partial block."""
+    num_full_blocks = len(key) // self._block_size
+    return [tuple(key[i * self._block_size : (i + 1) * self._block_size]) for i in range(num_full_blocks)]
+
+  def insert(self, key: Key, block_refs: list[Any]) -> int:
+    """Insert the full blocks of key with the KV reference of each block.
+
+    Args:
+      key: Tokens to insert. The trailing partial block is ignored.
+      block_refs: KV reference of each full block of key.
+    Returns:
+      Number of leading blocks already in the tree. Their stored references are kept and
+      block_refs of those blocks are not stored, the caller may release them.
+    """
+    blocks = self.split_blocks(key)
+    if len(block_refs) != len(blocks):
+      raise ValueError(f"Expected {len(blocks)} block_refs for key of {len(key)} tokens, got {len(block_refs)}.")
+
+    node = self._root
+    idx = 0
+    while idx < len(blocks):
+      child = node.children.get(blocks[idx])
+      if child is None:
+        node.children[blocks[idx]] = PrefixCacheRadixTree.Node(
+            parent=node, blocks=blocks[idx:], block_refs=list(block_refs[idx:])
+        )
+        self._num_blocks += len(blocks) - idx
+        return idx
+
+      matched = self._common_blocks_len(child.blocks, blocks, idx)
+      if matched < len(child.blocks):
+        child = self._split(child, matched)
+      node = child
+      idx += matched
+
+    return idx
+
+  def match(self, key: Key) -> RadixMatch:
+    """Return the longest block aligned prefix of key in the tree with KV references of each block."""
+    blocks = self.split_blocks(key)
+    result = RadixMatch()
+
+    node = self._root
+    idx = 0
+    while idx < len(blocks):
+      child = node.children.get(blocks[idx])
+      if child is None:
+        break
+      matched = self._common_blocks_len(child.blocks, blocks, idx)
+      result.block_refs.extend(child.block_refs[:matched])
+      idx += matched
+      if matched < len(child.blocks):
+        break
+      node = child
+
+    result.matched_length = idx * self._block_size
+    return result
+
+  def erase(self, key: Key) -> list[Any]:
+    """Erase key if it ends at a leaf and return KV references of the removed blocks."""
+    node = self._find_node_ending_at(self.split_blocks(key))
+    if node is None or node is self._root or not node.is_leaf():
+      return []
+
+    removed_refs: list[Any] = []
+    while node is not self._root and node.is_leaf():
+      parent = node.parent
+      assert parent is not None
+      del parent.children[node.blocks[0]]
+      removed_refs = node.block_refs + removed_refs
+      self._num_blocks -= len(node.blocks)
+      node = parent
+
+    if node is not self._root and len(node.children) == 1:
+      self._merge_with_only_child(node)
+
+    return removed_refs
+
+  def _find_node_ending_at(self, blocks: list[Key]) -> Optional["PrefixCacheRadixTree.Node"]:
+    """Return the node whose edge ends exactly after blocks, or None."""
+    node = self._root
+    idx = 0
+    while idx < len(blocks):
+      child = node.children.get(blocks[idx])
+      if child is None:
+        return None
+      if self._common_blocks_len(child.blocks, blocks, idx) != len(child.blocks):
+        return None
+      idx += len(child.blocks)
+      node = child
+    return node
+
+  @staticmethod
+  def _common_blocks_len(edge_blocks: list[Key], blocks: list[Key], start: int) -> int:
+    matched = 0
+    max_len = min(len(edge_blocks), len(blocks) - start)
+    while matched < max_len and edge_blocks[matched] == blocks[start + matched]:
+      matched += 1
+    return matched
+
+  def _split(self, node: "PrefixCacheRadixTree.Node", at: int) -> "PrefixCacheRadixTree.Node":
+    """Split the edge of node after at blocks and return the new upper node."""
+    parent = node.parent
+    assert parent is not None
+    upper = PrefixCacheRadixTree.Node(
+        parent=parent,
+        blocks=node.blocks[:at],
+        block_refs=node.block_refs[:at],
+    )
+    parent.children[upper.blocks[0]] = upper
+    node.blocks = node.blocks[at:]
+    node.block_refs = node.block_refs[at:]
+    node.parent = upper
+    upper.children[node.blocks[0]] = node
+    return upper
+
+  def _merge_with_only_child(self, node: "PrefixCacheRadixTree.Node") -> None:
+    """Merge the only child into node to keep the tree compressed."""
+    child = next(iter(node.children.values()))
+    node.blocks = node.blocks + child.blocks
+    node.block_refs = node.block_refs + child.block_refs
+    node.children = child.children
+    for grandchild in node.children.values():
+      grandchild.parent = node
+
+
 class ValueStorageInterface(abc.ABC):
   """Interface for Value storage."""
 
@@ -317,6 +528,14 @@ class ValueStorageInterface(abc.ABC):
   def contains(self, key: Key) -> bool:
     """If there is key in storage."""
 
+  @abc.abstractmethod
+  def keys(self) -> list[Key]:
+    """All keys in storage, including keys restored while init."""
+
+  @abc.abstractmethod
+  def get_size_bytes(self, key: Key) -> int:
+    """Bytes of the value of key in storage, or 0 if key is not in storage."""
+
 
 class BasicStorage:
   """Basic implement calculating size and save value into dict without modify."""
@@ -380,6 +599,15 @@ class BasicStorage:
     """If there is key in storage."""
     return key in self._saved_values
 
+  def keys(self) -> list[Key]:
+    """All keys in storage."""
+    return list(self._saved_values.keys())
+
+  def get_size_bytes(self, key: Key) -> int:
+    """Bytes of the value of key in storage, or 0 if key is not in storage."""
+    value = self._saved_values.get(key)
+    return value.prefix_size_bytes if value is not None else 0
+
 
 class HBMStorage(ValueStorageInterface):
   """Stores kv storage values in HBM.
@@ -445,16 +673,31 @@ class HBMStorage(ValueStorageInterface):
     """If there is key in storage."""
     return self._storage.contains(key)
 
+  def keys(self) -> list[Key]:
+    """All keys in storage."""
+    return self._storage.keys()
+
+  def get_size_bytes(self, key: Key) -> int:
+    """Bytes of the value of key in storage, or 0 if key is not in storage."""
+    return self._storage.get_size_bytes(key)
+
 
 class DRAMStorage(ValueStorageInterface):
-  """Stores KV Cache values in host DRAM."""
+  """Stores KV Cache values in host DRAM.
 
-  def __init__(self, max_size_bytes: int):
+  If executor is provided, the copy to host DRAM runs in the executor and add returns without waiting.
+  The value keeps the original prefix until the copy finished, and retrieve waits for the copy if not finished.
+  """
+
+  def __init__(self, max_size_bytes: int, executor: Optional[concurrent.futures.Executor] = None):
     """
     Args:
       max_size_bytes: Maximum bytes of host DRAM to use for storage
+      executor: Executor to copy values to host DRAM in background. If None, copy in add.
     """
     self._storage = BasicStorage(max_size_bytes)
+    self._executor = executor
+    self._pending_copies: dict[Key, concurrent.futures.Future] = {}
 
   def get_max_size_bytes(self) -> int:
     return self._storage.get_max_size_bytes()
@@ -468,21 +711,19 @@ class DRAMStorage(ValueStorageInterface):
 
     Return false if storage does not have enough space.
     Do not use this function to check if has enough space.
-    This function will first move to host DRAM before check the space.
+    Without executor, this function will first move to host DRAM before check the space.
     The storage will copy to the host DRAM if originally on device,
     or with the same reference to the value if originally on host.
     Do not use the value after this function if originally on host since the value will not copy.
     """
-    host_value = Value(
-        prefix=jax.device_get(value.prefix),
-        true_length=value.true_length,
-        padded_length=value.padded_length,
-        tokens=value.tokens,
-        prefix_size_bytes=value.prefix_size_bytes,
-        device=value.device,
-    )
+    if self._executor is None:
+      return self._storage.add(key, _with_prefix(value, jax.device_get(value.prefix)))
 
-    return self._storage.add(key, host_value)
+    self._collect_finished_copies()
+    if not self._storage.add(key, value):
+      return False
+    self._pending_copies[key] = self._executor.submit(jax.device_get, value.prefix)
+    return True
 
   def retrieve(self, key: Key, device: Any = None) -> Optional[Value]:
     """Return value from storage to the original device or None if not found.
@@ -490,6 +731,9 @@ class DRAMStorage(ValueStorageInterface):
     If the original device save in the storage is cpu, the storage will not copied.
     Do not modify the storage prefix retrieved.
     """
+    if key in self._pending_copies:
+      self._finish_copy(key)
+
     host_value = self._storage.retrieve(key)
     if host_value is None:
       return None
@@ -498,14 +742,321 @@ class DRAMStorage(ValueStorageInterface):
 
   def evict(self, key: Key) -> Optional[Value]:
     """Evict and return value, or None if key is not in storage."""
+    self._pending_copies.pop(key, None)
     return self._storage.evict(key)
 
   def contains(self, key: Key) -> bool:
     """If there is key in storage."""
     return self._storage.contains(key)
 
+  def keys(self) -> list[Key]:
+    """All keys in storage."""
+    return self._storage.keys()
+
+  def get_size_bytes(self, key: Key) -> int:
+    """Bytes of the value of key in storage, or 0 if key is not in storage."""
+    return self._storage.get_size_bytes(key)
+
+  def wait_pending_copies(self) -> None:
+    """Wait all background copies to host DRAM finished."""
+    for key in list(self._pending_copies.keys()):
+      self._finish_copy(key)
+
+  def _collect_finished_copies(self) -> None:
+    """Replace values of finished copies to release the original prefix."""
+    for key in [key for key, future in self._pending_copies.items() if future.done()]:
+      self._finish_copy(key)
+
+  def _finish_copy(self, key: Key) -> None:
+    host_prefix = self._pending_copies.pop(key).result()
+    value = self._storage.evict(key)
+    if value is not None:
+      self._storage.add(key, _with_prefix(value, host_prefix))
+
+
+def _prefix_structure_to_json(prefix: Prefix, leaves: list[Any]) -> Any:
+  """Json of the nested dict, list and tuple structure of prefix, appending the arrays to leaves in order.
+
+  Only the structure is stored in the disk index, so restoring it never runs code from the directory.
+  """
+  if isinstance(prefix, dict):
+    return {"dict": [[key, _prefix_structure_to_json(child, leaves)] for key, child in prefix.items()]}
+  if isinstance(prefix, (list, tuple)):
+    return {type(prefix).__name__: [_prefix_structure_to_json(child, leaves) for child in prefix]}
+  if prefix is None:
+    return {"none": None}
+  leaves.append(prefix)
+  return {"leaf": len(leaves) - 1}
+
+
+def _prefix_structure_from_json(structure: Any, leaves: list[Any]) -> Prefix:
+  """Rebuild the prefix of the structure created by _prefix_structure_to_json with leaves."""
+  node_type, children = next(iter(structure.items()))
+  if node_type == "dict":
+    return {key: _prefix_structure_from_json(child, leaves) for key, child in children}
+  if node_type == "list":
+    return [_prefix_structure_from_json(child, leaves) for child in children]
+  if node_type == "tuple":
+    return tuple(_prefix_structure_from_json(child, leaves) for child in children)
+  if node_type == "none":
+    return None
+  if node_type == "leaf":
+    return leaves[children]
+  raise ValueError(f"Unknown prefix structure {node_type=} in disk index.")
+
+
+class DiskStorage(ValueStorageInterface):
+  """Stores KV Cache values in files of a local disk directory, persisting across restarts.
+
+  Each value is a flat file of the raw bytes of all prefix leaves, read back with np.memmap.
+  The index file maps the hash of the key tokens to the key, the leaves layout and Value attributes.
+  Adds and evicts only mark the index dirty, it is rewritten once by flush, e.g. while closing PrefixCache.
+  Value files written after the last flush are not restored.
+  Values in the index of the directory are restored lazily while init: only the index is read,
+  and the value file is read while retrieve.
+  The devices of restored values are lost, they are retrieved to the device or default_device.
+  If executor is provided, the file is written in the executor and add returns without waiting.
+  """
+
+  INDEX_FILE_NAME = "index.json"
+  _ALIGNMENT_BYTES = 64
+
+  def __init__(
+      self,
+      max_size_bytes: int,
+      directory: str,
+      executor: Optional[concurrent.futures.Executor] = None,
+      default_device: Any = None,
+  ):
+    """
+    Args:
+      max_size_bytes: Maximum bytes of disk to use for storage
+      directory: Directory to store values and index. Values already in the index are restored.
+      executor: Executor to write values to disk in background. If None, write in add.
+      default_device: The same type as device in jax.device_put to retrieve restored values to.
+        If None, use the first local device.
+    """
+    self._max_size_bytes = max_size_bytes
+    self._remain_size_bytes = max_size_bytes
+    self._directory = directory
+    self._executor = executor
+    self._default_device = default_device
+    self._index_lock = threading.Lock()
+    self._size_bytes: dict[Key, int] = {}
+    self._entries: dict[Key, dict[str, Any]] = {}
+    self._devices: dict[Key, Any] = {}
+    self._pending_writes: dict[Key, concurrent.futures.Future] = {}
+    self._index_dirty = False
+    os.makedirs(directory, exist_ok=True)
+    self._restore_index()
+
+  def get_max_size_bytes(self) -> int:
+    return self._max_size_bytes
+
+  def has_enough_space(self, needed_bytes: int) -> bool:
+    """Calculate if needed_bytes size can add to storage."""
+    return self._remain_size_bytes >= needed_bytes
 
-class LRUStrategy:
+  def add(self, key: Key, value: Value) -> bool:
+    """Write value to disk and return True. If storage is full, return False."""
+    if not self.has_enough_space(value.prefix_size_bytes):
+      logger.warning(
+          "should check enough space before add to storage, but remain=%d not enough for value=%d",
+          self._remain_size_bytes,
+          value.prefix_size_bytes,
+      )
+      return False
+
+    self._size_bytes[key] = value.prefix_size_bytes
+    self._remain_size_bytes -= value.prefix_size_bytes
+    self._devices[key] = value.device
+    if self._executor is None:
+      self._write_entry(key, value)
+    else:
+      self._pending_writes[key] = self._executor.submit(self._write_entry, key, value)
+    return True
+
+  def retrieve(self, key: Key, device: Any = None) -> Optional[Value]:
+    """Read value from disk to the device or None if not found.
+
+    If device is None, put to the original device, or default_device if the value is restored.
+    """
+    host_value = self._read_host_value(key)
+    if host_value is None:
+      logger.warning("key=%r should exist in storage before retrieve, but not found", key)
+      return None
+    return device_put_value(host_value, device)
+
+  def evict(self, key: Key) -> Optional[Value]:
+    """Delete value from disk and return it on host, or None if key is not in storage."""
+    host_value = self._read_host_value(key)
+    if host_value is None:
+      logger.warning("key=%r should exist in storage before evict, but not found", key)
+      return None
+
+    self._remain_size_bytes += self._size_bytes.pop(key)
+    self._devices.pop(key, None)
+    with self._index_lock:
+      entry = self._entries.pop(key)
+      self._index_dirty = True
+    # The memory mapped prefix is still readable after the file is removed.
+    os.remove(os.path.join(self._directory, entry["file_name"]))
+    return host_value
+
+  def contains(self, key: Key) -> bool:
+    """If there is key in storage."""
+    return key in self._size_bytes
+
+  def keys(self) -> list[Key]:
+    """All keys in storage, including keys restored while init."""
+    return list(self._size_bytes.keys())
+
+  def get_size_bytes(self, key: Key) -> int:
+    """Bytes of the value of key in storage, including keys restored while init, or 0 if key is not in storage."""
+    return self._size_bytes.get(key, 0)
+
+  def clear(self) -> None:
+    """Delete all value files and the index from disk without reading the values."""
+    for future in self._pending_writes.values():
+      future.result()
+    self._pending_writes.clear()
+    with self._index_lock:
+      for entry in self._entries.values():
+        os.remove(os.path.join(self._directory, entry["file_name"]))
+      self._entries.clear()
+      self._index_dirty = False
+      index_path = os.path.join(self._directory, self.INDEX_FILE_NAME)
+      if os.path.exists(index_path):
+        os.remove(index_path)
+    self._size_bytes.clear()
+    self._devices.clear()
+    self._remain_size_bytes = self._max_size_bytes
+
+  def flush(self) -> None:
+    """Wait for the pending writes and rewrite the index if any value is added or evicted since the last flush."""
+    for future in self._pending_writes.values():
+      future.result()
+    self._pending_writes.clear()
+    with self._index_lock:
+      if self._index_dirty:
+        self._save_index()
+        self._index_dirty = False
+
+  def _read_host_value(self, key: Key) -> Optional[Value]:
+    """Memory map the value file of key on host, waiting for its pending write, or None if not found."""
+    if key in self._pending_writes:
+      self._pending_writes.pop(key).result()
+    with self._index_lock:
+      entry = self._entries.get(key)
+    if entry is None:
+      return None
+
+    path = os.path.join(self._directory, entry["file_name"])
+    # np.memmap cannot map an empty file.
+    data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > 0 else np.zeros((0,), dtype=np.uint8)
+    leaves = []
+    for leaf in entry["leaves"]:
+      dtype = jnp.dtype(leaf["dtype"])
+      num_bytes = int(np.prod(leaf["shape"], dtype=np.int64)) * dtype.itemsize
+      leaves.append(data[leaf["offset"] : leaf["offset"] + num_bytes].view(dtype).reshape(leaf["shape"]))
+    prefix = _prefix_structure_from_json(entry["structure"], leaves)
+
+    device = self._devices.get(key)
+    if device is None:
+      default_device = self._default_device if self._default_device is not None else jax.local_devices()[0]
+      device = jax.tree.map(lambda _: default_device, prefix)
+    return Value(
+        prefix=prefix,
+        true_length=entry["true_length"],
+        padded_length=entry["padded_length"],
+        tokens=tuple(entry["tokens"]),
+        prefix_size_bytes=entry["prefix_size_bytes"],
+        device=device,
+    )
+
+  def _write_entry(self, key: Key, value: Value) -> None:
+    """Write the value file and then add the entry to the index."""
+    leaves: list[Any] = []
+    structure = _prefix_structure_to_json(jax.device_get(value.prefix), leaves)
+    file_name = hashlib.sha256(np.asarray(key, dtype=np.int64).tobytes()).hexdigest() + ".kv"
+    path = os.path.join(self._directory, file_name)
+    leaves_layout = []
+    offset = 0
+    with open(path + ".tmp", "wb") as f:
+      for leaf in leaves:
+        leaf = np.ascontiguousarray(leaf)
+        padding = -offset % self._ALIGNMENT_BYTES
+        f.write(b"\0" * padding)
+        offset += padding
+        leaves_layout.append({"dtype": leaf.dtype.name, "shape": list(leaf.shape), "offset": offset})
+        f.write(leaf.tobytes())
+        offset += leaf.nbytes
+    os.replace(path + ".tmp", path)
+
+    with self._index_lock:
+      self._entries[key] = {
+          "key": list(key),
+          "tokens": [int(token) for token in value.tokens],
+          "file_name": file_name,
+          "true_length": value.true_length,
+          "padded_length": value.padded_length,
+          "prefix_size_bytes": value.prefix_size_bytes,
+          "structure": structure,
+          "leaves": leaves_layout,
+      }
+      self._index_dirty = True
+
+  def _save_index(self) -> None:
+    """Write the index atomically. Should hold the index lock."""
+    path = os.path.join(self._directory, self.INDEX_FILE_NAME)
+    with open(path + ".tmp", "wt", encoding="utf-8") as f:
+      json.dump({"entries": list(self._entries.values())}, f)
+    os.replace(path + ".tmp", path)
+
+  def _restore_index(self) -> None:
+    """Restore the entries of existing index without reading the values."""
+    path = os.path.join(self._directory, self.INDEX_FILE_NAME)
+    if not os.path.exists(path):
+      return
+    with open(path, "rt", encoding="utf-8") as f:
+      entries = json.load(f)["entries"]
+
+    for entry in entries:
+      key = tuple(entry["key"])
+      if "structure" not in entry:
+        logger.warning("Skip restoring key=%r of an index without prefix structure.", key)
+        continue
+      if not os.path.exists(os.path.join(self._directory, entry["file_name"])):
+        logger.warning("Skip restoring key=%r without value file.", key)
+        continue
+      if not self.has_enough_space(entry["prefix_size_bytes"]):
+        logger.warning("Skip restoring key=%r exceeding max_size_bytes=%d.", key, self._max_size_bytes)
+        os.remove(os.path.join(self._directory, entry["file_name"]))
+        continue
+      self._entries[key] = entry
+      self._size_bytes[key] = entry["prefix_size_bytes"]
+      self._remain_size_bytes -= entry["prefix_size_bytes"]
+    # Rewrite the index without the skipped entries on the next flush.
+    self._index_dirty = len(self._entries) < len(entries)
+
+
+class EvictionStrategy(abc.ABC):
+  """Interface of strategy choosing the key to evict from a storage."""
+
+  @abc.abstractmethod
+  def evict(self) -> Optional[Key]:
+    """Return and pop the key to evict next, or None if no key."""
+
+  @abc.abstractmethod
+  def use(self, key: Key, size_bytes: int = 0) -> None:
+    """Updated the usage history with key of value size_bytes."""
+
+  def pop_expired(self) -> list[Key]:
+    """Return and pop keys should be evicted regardless of space. None expired by default."""
+    return []
+
+
+class LRUStrategy(EvictionStrategy):
   """Least recently used cache strategy manage key."""
 
   def __init__(self):
@@ -517,7 +1068,7 @@ class LRUStrategy:
       return None
     return self._order.popitem(last=False)[0]
 
-  def use(self, key: Key) -> None:
+  def use(self, key: Key, size_bytes: int = 0) -> None:
     """Updated the usage history."""
     if key not in self._order:
       self._order[key] = None
@@ -525,32 +1076,222 @@ class LRUStrategy:
       self._order.move_to_end(key, last=True)
 
 
+class TTLStrategy(LRUStrategy):
+  """Least recently used strategy also expiring keys not used within ttl_seconds."""
+
+  def __init__(self, ttl_seconds: float, clock: Callable[[], float] = time.monotonic):
+    """
+    Args:
+      ttl_seconds: Keys not used for longer than ttl_seconds are expired.
+      clock: Function returning current time in seconds.
+    """
+    super().__init__()
+    self._ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._last_used: dict[Key, float] = {}
+
+  def evict(self) -> Optional[Key]:
+    key = super().evict()
+    if key is not None:
+      del self._last_used[key]
+    return key
+
+  def use(self, key: Key, size_bytes: int = 0) -> None:
+    super().use(key, size_bytes)
+    self._last_used[key] = self._clock()
+
+  def pop_expired(self) -> list[Key]:
+    """Return and pop keys not used within ttl_seconds from the least recently used."""
+    expire_before = self._clock() - self._ttl_seconds
+    expired_keys: list[Key] = []
+    while len(self._order) > 0:
+      key = next(iter(self._order))
+      if self._last_used[key] > expire_before:
+        break
+      expired_keys.append(key)
+      self.evict()
+    return expired_keys
+
+
+class _PriorityStrategy(EvictionStrategy):
+  """Evict the key with the lowest priority with ties broken by least recently used.
+
+  Use a heap with lazy deletion of outdated priorities.
+  """
+
+  def __init__(self):
+    self._heap: list[tuple[float, int, Key]] = []
+    self._entries: dict[Key, tuple[float, int]] = {}
+    self._counter = itertools.count()
+
+  @abc.abstractmethod
+  def _priority(self, key: Key, size_bytes: int) -> float:
+    """Update the key history and return the new priority of the key."""
+
+  def _on_evict(self, key: Key, priority: float) -> None:
+    """Hook to update the history after key evicted."""
+
+  def evict(self) -> Optional[Key]:
+    while self._heap:
+      priority, count, key = heapq.heappop(self._heap)
+      if self._entries.get(key) == (priority, count):
+        del self._entries[key]
+        self._on_evict(key, priority)
+        return key
+    return None
+
+  def use(self, key: Key, size_bytes: int = 0) -> None:
+    entry = (self._priority(key, size_bytes), next(self._counter))
+    self._entries[key] = entry
+    heapq.heappush(self._heap, (*entry, key))
+    if len(self._heap) > 2 * len(self._entries) + 64:
+      self._heap = [(priority, count, key) for key, (priority, count) in self._entries.items()]
+      heapq.heapify(self._heap)
+
+
+class LFUStrategy(_PriorityStrategy):
+  """Least frequently used cache strategy manage key.
+
+  The frequency is forgotten after the key evicted.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self._frequency: dict[Key, int] = {}
+
+  def _priority(self, key: Key, size_bytes: int) -> float:
+    self._frequency[key] = self._frequency.get(key, 0) + 1
+    return self._frequency[key]
+
+  def _on_evict(self, key: Key, priority: float) -> None:
+    del self._frequency[key]
+
+
+class GDSFStrategy(_PriorityStrategy):
+  """GreedyDual-Size-Frequency cache strategy manage key.
+
+  The priority is clock + frequency / size_bytes, so large values need more hits than
+  small values to stay in cache. The clock is raised to the priority of the evicted key,
+  aging values not used for a long time.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self._clock = 0.0
+    self._frequency: dict[Key, int] = {}
+    self._size_bytes: dict[Key, int] = {}
+
+  def _priority(self, key: Key, size_bytes: int) -> float:
+    self._frequency[key] = self._frequency.get(key, 0) + 1
+    if size_bytes > 0 or key not in self._size_bytes:
+      self._size_bytes[key] = max(size_bytes, 1)
+    return self._clock + self._frequency[key] / self._size_bytes[key]
+
+  def _on_evict(self, key: Key, priority: float) -> None:
+    self._clock = max(self._clock, priority)
+    del self._frequency[key]
+    del self._size_bytes[key]
+
+
+EVICTION_POLICIES = ("lru", "lfu", "gdsf", "ttl")
+
+
+def create_eviction_strategy(policy: str, ttl_seconds: float = 0.0) -> EvictionStrategy:
+  """Create eviction strategy by policy name.
+
+  Args:
+    policy: One of EVICTION_POLICIES.
+    ttl_seconds: Seconds a key can stay without used. Only used and should be > 0 for ttl policy.
+  Returns:
+    Eviction strategy of the policy.
+  """
+  if policy == "lru":
+    return LRUStrategy()
+  if policy == "lfu":
+    return LFUStrategy()
+  if policy == "gdsf":
+    return GDSFStrategy()
+  if policy == "ttl":
+    if ttl_seconds <= 0:
+      raise ValueError(f"ttl eviction policy requires ttl_seconds > 0, got {ttl_seconds=}.")
+    return TTLStrategy(ttl_seconds)
+  raise ValueError(f"Unknown eviction policy {policy=}, should be one of {EVICTION_POLICIES}.")
+
+
+@dataclasses.dataclass
+class CacheLayerStats:
+  """Counters of a cache layer.
+
+  Attributes:
+    hits: Number of retrieves found in the layer.
+    misses: Number of retrieves not found in the layer.
+    hit_bytes: Bytes of values retrieved from the layer.
+    miss_bytes: Bytes of values not found in the layer but found in a lower layer.
+    evictions: Number of values evicted from the layer.
+  """
+
+  hits: int = 0
+  misses: int = 0
+  hit_bytes: int = 0
+  miss_bytes: int = 0
+  evictions: int = 0
+
+  @property
+  def hit_ratio(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total > 0 else 0.0
+
+  @property
+  def byte_hit_ratio(self) -> float:
+    total_bytes = self.hit_bytes + self.miss_bytes
+    return self.hit_bytes / total_bytes if total_bytes > 0 else 0.0
+
+
 @dataclasses.dataclass
 class StorageWithStrategy:
   """Storage with corresponding strategy"""
 
   storage: ValueStorageInterface
-  strategy: LRUStrategy
+  strategy: EvictionStrategy
+  stats: CacheLayerStats = dataclasses.field(default_factory=CacheLayerStats)
 
 
 class HierarchicalCache:
-  """Hierarchical Cache contains two layers of ValueStorageInterface.
+  """Hierarchical Cache contains two or more layers of ValueStorageInterface.
 
-  The first layer contains subset fo key / value pairs of the second layer.
-  The second storage max size bytes should >= first storage max size bytes.
-  Use LRU for each layer.
+  Each layer contains subset fo key / value pairs of the next layer.
+  The next storage max size bytes should >= the storage max size bytes.
+  Keys already in the storage while init, e.g. restored from disk, are added to the strategy with their size.
+  Use the strategy created by strategy_factory for each layer, LRU by default.
+  Keys expired by the strategy are evicted on add.
   Add the Value will save to all layers.
   Retrieve the Value will retrieve to HBM and then saved to all layers.
   The added value size should less than the first layer max size.
   If the first layer max size cannot contains the added Value, add will failed.
   """
 
-  def __init__(self, layers: Tuple[ValueStorageInterface, ValueStorageInterface]):
-    assert (
-        layers[0].get_max_size_bytes() <= layers[1].get_max_size_bytes()
-    ), "Bottom layer of storage need to be larger than top."
+  def __init__(
+      self,
+      layers: Sequence[ValueStorageInterface],
+      strategy_factory: Callable[[], EvictionStrategy] = LRUStrategy,
+  ):
+    for upper, lower in zip(layers[:-1], layers[1:]):
+      assert upper.get_max_size_bytes() <= lower.get_max_size_bytes(), "Bottom layer of storage need to be larger than top."
+
+    self._layers = [StorageWithStrategy(storage, strategy_factory()) for storage in layers]
+    # Keys prefetched and not retrieved yet, their stats are recorded while prefetch.
+    self._prefetched: set[Key] = set()
+    for layer in self._layers:
+      for key in layer.storage.keys():
+        layer.strategy.use(key, layer.storage.get_size_bytes(key))
+
+  def keys(self) -> list[Key]:
+    """All keys in the hierarchical cache, which are the keys of the last layer."""
+    return self._layers[-1].storage.keys()
 
-    self._layers = [StorageWithStrategy(storage, LRUStrategy()) for storage in layers]
+  def get_stats(self) -> list[CacheLayerStats]:
+    """Return a copy of counters of each layer from the top."""
+    return [dataclasses.replace(layer.stats) for layer in self._layers]
 
   def add(self, key: Key, value: Value) -> tuple[bool, dict[Key, Value]]:
     """Add to all layers and return (ok, dict[fully evicted from hierarchical cache key value pair]).
@@ -566,6 +1307,8 @@ class HierarchicalCache:
       )
       return False, {}
 
+    expired_key_values = self._evict_expired()
+
     # Only return last layers evicted key value pair which is fully evicted from hierarchical cache.
     all_ok = True
     last_layer_evicted_key_values: dict[Key, Value] = {}
@@ -576,6 +1319,8 @@ class HierarchicalCache:
 
       ok, last_layer_evicted_key_values = self._evict_to_enough_space(layer, needed_bytes)
       all_ok = all_ok and ok
+    last_layer_evicted_key_values.update(expired_key_values)
+    self._prefetched.difference_update(last_layer_evicted_key_values)
 
     if not all_ok:
       logging.error("Cannot evict enough space after checking max_size is enough for bytes=%d.", needed_bytes)
@@ -587,7 +1332,7 @@ class HierarchicalCache:
           logging.error("Cannot add to storage. key=%r, needed_bytes=%d", key, needed_bytes)
           return False, last_layer_evicted_key_values
 
-      layer.strategy.use(key)
+      layer.strategy.use(key, needed_bytes)
 
     return True, last_layer_evicted_key_values
 
@@ -604,10 +1349,20 @@ class HierarchicalCache:
       The Value.device is not changed to device retrieved.
     """
     value: Optional[Value] = None
+    missed_layers: list[StorageWithStrategy] = []
+    hit_layer: Optional[StorageWithStrategy] = None
     for layer in self._layers:
       if layer.storage.contains(key):
         value = layer.storage.retrieve(key, device)
+        hit_layer = layer
         break
+      missed_layers.append(layer)
+
+    # A prefetched key is counted as a hit of the layer it was prefetched from.
+    if key in self._prefetched:
+      self._prefetched.discard(key)
+    else:
+      self._record_stats(hit_layer, missed_layers, value)
 
     if value is None:
       logging.warning("Should check key exist before retrieve, but fail for key=%r", key)
@@ -623,10 +1378,55 @@ class HierarchicalCache:
           logging.error("Cannot add retrieved Value to other layers.")
           continue
 
-      layer.strategy.use(key)
+      layer.strategy.use(key, value.prefix_size_bytes)
 
     return value
 
+  def prefetch(self, key: Key) -> bool:
+    """Start copying the value to the layers above the first layer containing key.
+
+    The copy is dispatched by jax.device_put without waiting, to overlap with other work before retrieve.
+    The value is added to the upper layers but the usage history of the lower layers is not updated.
+    The stats are recorded as a retrieve from the layer containing key, and not again by the next retrieve.
+
+    Returns:
+      True if key is in the first layer after prefetch.
+    """
+    missed_layers: list[StorageWithStrategy] = []
+    value: Optional[Value] = None
+    for layer in self._layers:
+      if layer.storage.contains(key):
+        value = layer.storage.retrieve(key)
+        if value is not None and key not in self._prefetched:
+          self._record_stats(layer, missed_layers, value)
+          self._prefetched.add(key)
+        break
+      missed_layers.append(layer)
+
+    if value is None:
+      return False
+
+    for layer in missed_layers:
+      ok, _ = self._evict_to_enough_space(layer, value.prefix_size_bytes)
+      if not ok or not layer.storage.add(key, value):
+        logging.warning("Cannot prefetch key=%r to upper layer.", key)
+        return False
+      layer.strategy.use(key, value.prefix_size_bytes)
+
+    return True
+
+  def _record_stats(
+      self, hit_layer: Optional[StorageWithStrategy], missed_layers: list[StorageWithStrategy], value: Optional[Value]
+  ) -> None:
+    """Count a hit of hit_layer and misses of the layers above it for a retrieved value, or None if not found."""
+    if value is not None:
+      hit_layer.stats.hits += 1
+      hit_layer.stats.hit_bytes += value.prefix_size_bytes
+    for layer in missed_layers:
+      layer.stats.misses += 1
+      if value is not None:
+        layer.stats.miss_bytes += value.prefix_size_bytes
+
   def _evict_to_enough_space(self, layer: StorageWithStrategy, needed_bytes: int) -> tuple[bool, dict[Key, Value]]:
     """Evict layer to enough bytes for add and return (ok, dict[evicted key, evicted value])."""
     evicted_key_values: dict[Key, Value] = {}
@@ -641,18 +1441,35 @@ class HierarchicalCache:
         logging.error("Key should in storage before evict but not. key=%r", evicted_key)
         continue
 
+      layer.stats.evictions += 1
       evicted_key_values[evicted_key] = evicted_value
 
     return True, evicted_key_values
 
+  def _evict_expired(self) -> dict[Key, Value]:
+    """Evict keys expired by strategy from all layers and return dict[fully evicted key, evicted value]."""
+    evicted_key_values: dict[Key, Value] = {}
+    for layer in self._layers:
+      for expired_key in layer.strategy.pop_expired():
+        evicted_value = layer.storage.evict(expired_key)
+        if evicted_value is None:
+          continue
+        layer.stats.evictions += 1
+        evicted_key_values[expired_key] = evicted_value
+    return {
+        key: value
+        for key, value in evicted_key_values.items()
+        if not any(layer.storage.contains(key) for layer in self._layers)
+    }
+
 
 class PrefixCache:
   """Store Prefix KV cache.
 
   Use hierarchical cache of two layers the first in the HBM and the second in the host DRAM.
   Assuming HBM is available, or the cache would degrade to two layers on DRAM.
-  If cache is full, evict least-recently used entries (LRU).
-  LRU strategy is apply to all layers.
+  If cache is full, evict entries by the eviction policy, least-recently used entries (LRU) by default.
+  The eviction policy is apply to all layers.
   The cache in HBM will be subset of the cache in host DRAM.
   For example:
     For HBM can contain 2 values, and DRAM can contain 5 values,
@@ -660,24 +1477,60 @@ class PrefixCache:
   Always return cache after load into HBM.
   The value need to be <= to the max size in HBM.
   DRAM max size need to be >= than HBM max size.
+
+  With async_transfer, copies between HBM and DRAM do not block the lock, which only guards the metadata:
+  save copies to DRAM in a background thread, and fetch_longest_common_prefix_key starts copying
+  the matched value from DRAM to HBM, overlapping the transfer with other work before load.
+
+  With disk_dir, a third layer persists values on local disk and the DRAM cache is a subset of it.
+  Values saved by a previous process in disk_dir are restored lazily, and can be fetched and loaded
+  from the first request after restart if the cache was closed. clear() also deletes values on disk.
   """
 
-  def __init__(self, hbm_bytes: int, dram_bytes: int):
+  def __init__(
+      self,
+      hbm_bytes: int,
+      dram_bytes: int,
+      *,
+      eviction_policy: str = "lru",
+      ttl_seconds: float = 0.0,
+      async_transfer: bool = True,
+      disk_bytes: int = 0,
+      disk_dir: str = "",
+  ):
     """
-    dram_bytes >= hbm_bytes
+    disk_bytes >= dram_bytes >= hbm_bytes
     Args:
       hbm_bytes: Total amount of HBM to use for cache.
       dram_bytes: Total amount of DRAM to use for cache.
+      eviction_policy: One of EVICTION_POLICIES.
+      ttl_seconds: Seconds an entry can stay without used for ttl eviction_policy.
+      async_transfer: Copy to DRAM and disk in background and prefetch matched key to HBM.
+      disk_bytes: Total amount of disk to use for cache. Only used with disk_dir.
+      disk_dir: Local directory to persist cache. If empty, do not use disk.
     """
     # TODO(yuyanpeng): way to disable DRAM cache
     assert dram_bytes >= hbm_bytes, "DRAM max size need to be >= than HBM max size."
+    assert not disk_dir or disk_bytes >= dram_bytes, "Disk max size need to be >= than DRAM max size."
+    # Fail early on invalid policy.
+    create_eviction_strategy(eviction_policy, ttl_seconds)
     self._lock = threading.Lock()
     self._hbm_bytes = hbm_bytes
     self._dram_bytes = dram_bytes
-    # init in clear()
+    self._eviction_policy = eviction_policy
+    self._ttl_seconds = ttl_seconds
+    self._async_transfer = async_transfer
+    self._executor: Optional[concurrent.futures.Executor] = None
+    if async_transfer:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefix_cache_dram")
+    self._disk_storage: Optional[DiskStorage] = None
+    if disk_dir:
+      self._disk_storage = DiskStorage(disk_bytes, disk_dir, executor=self._executor)
+    # init in _init_cache()
     self._trie: PrefixCacheTrie
     self._cache: HierarchicalCache
-    self.clear()
+    with self._lock:
+      self._init_cache()
 
   def fetch_longest_common_prefix_key(self, key: Key) -> Optional[Key]:
     """Returns key with longest common prefix matched or None if not found."""
@@ -685,6 +1538,8 @@ class PrefixCache:
     with self._lock:
       matched_key = self._trie.get_longest_common_prefix_key(key)
       logger.debug("matched_key=%r", matched_key)
+      if matched_key is not None and self._async_transfer:
+        self._cache.prefetch(matched_key)
       return matched_key
 
   def save(self, key: Key, value: Value) -> bool:
@@ -726,10 +1581,103 @@ class PrefixCache:
     """Clear entire cache."""
     logger.debug("clear cache")
     with self._lock:
-      self._trie = PrefixCacheTrie()
-      self._cache = HierarchicalCache(
-          layers=(
-              HBMStorage(self._hbm_bytes),
-              DRAMStorage(self._dram_bytes),
-          )
-      )
+      if self._disk_storage is not None:
+        self._disk_storage.clear()
+      self._init_cache()
+
+  def get_stats(self) -> dict[str, CacheLayerStats]:
+    """Returns counters of the HBM, DRAM and disk if used layers, reset after clear."""
+    with self._lock:
+      return dict(zip(("hbm", "dram", "disk"), self._cache.get_stats()))
+
+  def close(self):
+    """Wait for the background copies, stop the copy thread and write the disk index.
+
+    The cache cannot save after close.
+    """
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+    if self._disk_storage is not None:
+      with self._lock:
+        self._disk_storage.flush()
+
+  def __enter__(self) -> "PrefixCache":
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _init_cache(self):
+    """Init empty HBM and DRAM layers, and the trie with keys restored from disk. Should hold the lock."""
+    layers: list[ValueStorageInterface] = [
+        HBMStorage(self._hbm_bytes),
+        DRAMStorage(self._dram_bytes, executor=self._executor),
+    ]
+    if self._disk_storage is not None:
+      layers.append(self._disk_storage)
+    self._cache = HierarchicalCache(
+        layers=layers,
+        strategy_factory=functools.partial(create_eviction_strategy, self._eviction_policy, self._ttl_seconds),
+    )
+    self._trie = PrefixCacheTrie()
+    for key in self._cache.keys():
+      self._trie.insert(key)
+
+
+class PagedPrefixCache:
+  """Prefix cache of full KV pages shared in the paged attention KV pool.
+
+  The cache does not hold any KV data. It indexes the pages of prompts with PrefixCacheRadixTree
+  using tokens_per_page as block size, and returns which pages the caller should retain or release
+  in the PageManager reference counts. Slots sharing a prompt prefix map the same physical pages.
+  Only full pages are cached, the trailing partial page of a prompt is always private to the slot.
+  If more than max_pages are cached, evict least-recently saved keys.
+  """
+
+  def __init__(self, tokens_per_page: int, max_pages: int):
+    """
+    Args:
+      tokens_per_page: Number of tokens in a page.
+      max_pages: Maximum number of pages held by the cache.
+    """
+    self._lock = threading.Lock()
+    self._max_pages = max_pages
+    self._tree = PrefixCacheRadixTree(block_size=tokens_per_page)
+    self._strategy = LRUStrategy()
+
+  @property
+  def num_pages(self) -> int:
+    """Number of pages held by the cache."""
+    return self._tree.num_blocks
+
+  def lookup(self, key: Key) -> RadixMatch:
+    """Returns matched length and the pages of the longest cached prefix of key."""
+    with self._lock:
+      return self._tree.match(key)
+
+  def save(self, key: Key, pages: Sequence[int]) -> tuple[list[int], list[int]]:
+    """Save the full pages of key and return (pages to retain, pages to release).
+
+    Args:
+      key: Prompt tokens.
+      pages: Pages of the slot holding key in order. Pages after the full pages of key are ignored.
+    Returns:
+      Pages newly held by the cache, the caller should increment the reference count,
+      and pages evicted from the cache, the caller should decrement the reference count.
+    """
+    num_full_pages = len(key) // self._tree.block_size
+    if num_full_pages == 0 or num_full_pages > self._max_pages:
+      return [], []
+
+    key = tuple(key[: num_full_pages * self._tree.block_size])
+    pages = list(pages[:num_full_pages])
+    with self._lock:
+      num_existing_pages = self._tree.insert(key, pages)
+      self._strategy.use(key)
+      released_pages: list[int] = []
+      while self._tree.num_blocks > self._max_pages:
+        evicted_key = self._strategy.evict()
+        if evicted_key is None:
+          break
+        released_pages.extend(self._tree.erase(evicted_key))
+      return pages[num_existing_pages:], released_pages
@@ -182,6 +182,11 @@ def validate_keys(keys):
         " use_replicator_service and replicator_backup_interval_minutes"
     )
 
+  assert keys["moe_token_dispatch"] in ("mask", "index"), "moe_token_dispatch should be mask or index."
+  if keys["async_eval"]:
+    assert keys["async_metrics_writer"], "async_eval needs async_metrics_writer to read the eval metrics in the background."
+    assert keys["target_eval_loss"] <= 0, "async_eval does not wait for the eval loss, so target_eval_loss can't be used."
+
   validate_multiple_slices(keys)
   if keys["num_experts"] > 1:
     validate_sparse_matmul_parallelism(keys)
@@ -233,6 +238,21 @@ def validate_data_input(keys):
     if keys["eval_interval"] > 0:
       assert keys["eval_split"], "Please specify eval_split or set eval_interval to <=0."
 
+  assert keys["packing_strategy"] in (
+      "greedy",
+      "best_fit",
+  ), f"packing_strategy should be greedy or best_fit, but got {keys['packing_strategy']}"
+  if keys["packing_strategy"] == "best_fit":
+    assert keys["packing_window_size"] > 0, "packing_window_size should be positive"
+
+  if keys["document_chunking"]:
+    assert (
+        keys["dataset_type"] == "grain" and not keys["use_dpo"]
+    ), "document_chunking is only supported by the grain pretrain pipeline"
+    assert (
+        0 <= keys["document_chunk_overlap"] < keys["max_target_length"]
+    ), f"document_chunk_overlap should be in [0, max_target_length), but got {keys['document_chunk_overlap']}"
+
   if "tokenizer_llama3.tiktoken" in keys["tokenizer_path"]:
     assert (
         keys["tokenizer_type"] == "tiktoken"
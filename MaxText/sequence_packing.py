@@ -18,6 +18,7 @@ limitations under the License.
 
 from typing import Dict, Optional, List, Union
 
+import numpy as np
 import tensorflow as tf
 
 AUTOTUNE = tf.data.experimental.AUTOTUNE
@@ -97,6 +98,125 @@ def pack_dataset(
   return dataset.map(my_fn, num_parallel_calls=AUTOTUNE)
 
 
+def pack_dataset_best_fit(
+    dataset: tf.data.Dataset,
+    key2length: Union[int, Dict[str, int]],
+    pad_id: int,
+    window_size: int,
+    keys: Optional[List[str]] = None,
+) -> tf.data.Dataset:
+  """Packs a dataset with BestFitPacker, a drop-in replacement of pack_dataset.
+
+  Windows of window_size examples are ragged batched and packed by BestFitPacker
+  in a tf.numpy_function, then unbatched into packed examples.
+  Args:
+    dataset: a tf.data.Dataset
+    key2length: an integer, or a dict from feature-key to integer
+    pad_id: the token id to pad the features with
+    window_size: the number of examples packed together
+    keys: a list of strings (e.g. ["inputs", "targets"])
+  Returns:
+    a tf.data.Dataset
+  """
+  if keys is None:
+    keys = list(dataset.element_spec.keys())
+  if isinstance(key2length, int):
+    key2length = {k: key2length for k in keys}
+  packer = BestFitPacker({k: key2length[k] for k in keys}, window_size, pad_id)
+  output_key2length = {k + suffix: key2length[k] for k in keys for suffix in ("", "_segmentation", "_position")}
+  output_keys = list(output_key2length.keys())
+
+  def pack_window(*values_and_row_lengths):
+    examples = [{} for _ in values_and_row_lengths[1]]
+    for k, values, row_lengths in zip(keys, values_and_row_lengths[::2], values_and_row_lengths[1::2]):
+      for example, value in zip(examples, np.split(values, np.cumsum(row_lengths)[:-1])):
+        example[k] = value
+    rows = packer.pack(examples)
+    return [np.stack([row[k] for row in rows]).astype(np.int32) for k in output_keys]
+
+  def map_fn(x):
+    args = []
+    for k in keys:
+      args.extend([tf.cast(x[k].flat_values, tf.int32), x[k].row_lengths()])
+    packed = tf.numpy_function(pack_window, args, [tf.int32] * len(output_keys), stateful=False)
+    return {k: tf.reshape(v, [-1, output_key2length[k]]) for k, v in zip(output_keys, packed)}
+
+  dataset = dataset.map(lambda x: {k: x[k] for k in keys}, num_parallel_calls=AUTOTUNE)
+  dataset = dataset.ragged_batch(window_size)
+  dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE)
+  return dataset.unbatch()
+
+
+class BestFitPacker:
+  """Packs examples into fixed-length rows with best-fit-decreasing placement.
+
+  Examples of a window are placed longest first, each into the open row with the least room
+  left that fits it, or into a new row. Features of an example are placed together, so every
+  feature of a row holds the same segments. Longer examples are truncated to the row length.
+
+  Example, rows of length 6 and a window of 3 examples:
+    {"inputs": [1, 2]}, {"inputs": [3, 4, 5, 6]}, {"inputs": [7, 8, 9]}
+  are packed into
+    {"inputs": [3, 4, 5, 6, 1, 2], "inputs_segmentation": [1, 1, 1, 1, 2, 2], "inputs_position": [0, 1, 2, 3, 0, 1]}
+    {"inputs": [7, 8, 9, 0, 0, 0], "inputs_segmentation": [1, 1, 1, 0, 0, 0], "inputs_position": [0, 1, 2, 0, 0, 0]}
+  """
+
+  def __init__(self, key2length: Dict[str, int], window_size: int, pad_id: int = 0):
+    if window_size < 1:
+      raise ValueError(f"window_size should be positive, but got {window_size}")
+    self.keys = list(key2length.keys())
+    self.row_lengths = np.array([key2length[k] for k in self.keys], dtype=np.int64)
+    self.window_size = window_size
+    self.pad_id = pad_id
+
+  def pack(self, examples: List[Dict[str, np.ndarray]]) -> List[Dict[str, np.ndarray]]:
+    """Packs a window of examples into rows."""
+    examples = [
+        {k: np.asarray(example[k])[:length] for k, length in zip(self.keys, self.row_lengths)} for example in examples
+    ]
+    lengths = np.array([[example[k].shape[0] for k in self.keys] for example in examples], dtype=np.int64)
+    lengths = lengths.reshape(len(examples), len(self.keys))
+    # Longest first, stable so that ties keep the order of the window.
+    order = np.argsort(-lengths.sum(axis=1), kind="stable")
+    room = np.empty((0, len(self.keys)), dtype=np.int64)
+    rows = []
+    for i in order:
+      fits = np.all(room >= lengths[i], axis=1)
+      if fits.any():
+        row = int(np.argmin(np.where(fits, room.sum(axis=1), np.iinfo(np.int64).max)))
+      else:
+        row = len(rows)
+        rows.append([])
+        room = np.concatenate([room, self.row_lengths[None]])
+      rows[row].append(examples[i])
+      room[row] -= lengths[i]
+    return [self._make_row(segments) for segments in rows]
+
+  def _make_row(self, segments: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    row = {}
+    for k, length in zip(self.keys, self.row_lengths):
+      values = [segment[k] for segment in segments]
+      num_tokens = sum(v.shape[0] for v in values)
+      row[k] = np.full(length, self.pad_id, dtype=np.int32)
+      row[k][:num_tokens] = np.concatenate(values)
+      row[k + "_segmentation"] = np.zeros(length, dtype=np.int32)
+      row[k + "_segmentation"][:num_tokens] = np.repeat(np.arange(1, len(values) + 1), [v.shape[0] for v in values])
+      row[k + "_position"] = np.zeros(length, dtype=np.int32)
+      row[k + "_position"][:num_tokens] = np.concatenate([np.arange(v.shape[0]) for v in values])
+    return row
+
+  def pack_iterator(self, examples):
+    """Packs an iterator of examples window by window, yields the rows."""
+    window = []
+    for example in examples:
+      window.append(example)
+      if len(window) == self.window_size:
+        yield from self.pack(window)
+        window = []
+    if window:
+      yield from self.pack(window)
+
+
 def _pack_with_tf_ops(dataset: tf.data.Dataset, keys: List[str], key2length: Dict[str, int], pad_id: int) -> tf.data.Dataset:
   """Helper-function for packing a dataset which has already been batched.
   Helper for pack_dataset()  Uses tf.while_loop.
@@ -54,6 +54,14 @@ def data_load_loop(config, state=None):
   end = datetime.datetime.now()
   if jax.process_index() == 0:
     max_logging.log(f"STANDALONE DATALOADER : {config.steps} batches loaded in {(end-start).seconds} seconds, on host 0")
+    steady_state_seconds = (end - first_end).total_seconds()
+    if config.steps > start_step + 1 and steady_state_seconds > 0:
+      steps_per_second = (config.steps - start_step - 1) / steady_state_seconds
+      tokens_per_second = steps_per_second * config.global_batch_size_to_load * config.max_target_length
+      max_logging.log(
+          f"STANDALONE DATALOADER : after the first batch, {steps_per_second:.2f} batches/s,"
+          f" {tokens_per_second:.0f} tokens/s across hosts"
+      )
   return state
 
 
@@ -812,6 +812,80 @@ class AttentionTest(unittest.TestCase):
     )
 
 
+  def test_sliding_window_autoregression(self):
+    """Test decode of sliding window attention with a ring buffer of the window as ar cache"""
+    sliding_window_size = 8
+    prefill_length = self.cfg.max_prefill_predict_length
+    # float32, so that the decode steps match the full pass up to the order of the sums, not bf16 rounding
+    dtype = jnp.float32
+    lnx, decoder_segment_ids, decoder_positions = self.get_structured_data(dtype)
+
+    sliding_attn = Attention(
+        config=self.cfg,
+        num_query_heads=self.num_query_heads,
+        num_kv_heads=self.num_kv_heads,
+        head_dim=self.head_dim,
+        max_target_length=self.max_target_length,
+        max_prefill_predict_length=self.max_prefill_predict_length,
+        mesh=self.mesh,
+        attention_kernel="dot_product",
+        dtype=dtype,
+        dropout_rate=self.cfg.dropout_rate,
+        name="sliding_window_attention",
+        attention_type=attentions.AttentionType.LOCAL_SLIDING,
+        sliding_window_size=sliding_window_size,
+    )
+    attn_variable = sliding_attn.init(
+        {"params": self.rng, "aqt": self.rng},
+        jnp.ones((self.global_batch_size, self.max_target_length, self.embed_dim)),
+        jnp.ones((self.global_batch_size, self.max_target_length, self.embed_dim)),
+        jnp.ones((self.global_batch_size, self.max_target_length)),
+    )
+
+    sliding_full = sliding_attn.apply(
+        attn_variable,
+        lnx,
+        lnx,
+        decoder_segment_ids=decoder_segment_ids,
+        inputs_positions=decoder_positions,
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_TRAIN,
+        rngs={"aqt": self.rng},
+    )
+
+    _, output_cache = sliding_attn.apply(
+        attn_variable,
+        lnx[:, 0:prefill_length, :],
+        lnx[:, 0:prefill_length, :],
+        decoder_segment_ids=decoder_segment_ids[:, 0:prefill_length],
+        inputs_positions=decoder_positions[:, 0:prefill_length],
+        deterministic=True,
+        model_mode=common_types.MODEL_MODE_PREFILL,
+        rngs={"aqt": self.rng},
+        mutable=["cache"],
+    )
+    ar_segment_ids = [
+        leaf
+        for path, leaf in jax.tree_util.tree_flatten_with_path(output_cache)[0]
+        if "cache_ar_segment_id" in jax.tree_util.keystr(path)
+    ]
+    self.assertEqual(ar_segment_ids[0].shape, (self.global_batch_size, sliding_window_size))
+
+    for idx in range(prefill_length, self.max_target_length):
+      attn_variable.update(output_cache)
+      sliding_idx, output_cache = sliding_attn.apply(
+          attn_variable,
+          lnx[:, idx : idx + 1, :],
+          lnx[:, idx : idx + 1, :],
+          inputs_positions=decoder_positions[:, idx : idx + 1],
+          deterministic=True,
+          model_mode=common_types.MODEL_MODE_AUTOREGRESSIVE,
+          rngs={"aqt": self.rng},
+          mutable=["cache"],
+      )
+      self.assertTrue(jax.numpy.allclose(sliding_full[:, idx : idx + 1, :], sliding_idx, rtol=1e-04, atol=1e-04))
+
+
 class MLATest(parameterized.TestCase):
   """Test for the Multi-Headed Latent Attention"""
 
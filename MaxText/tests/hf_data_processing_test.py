@@ -17,6 +17,7 @@ limitations under the License.
 import sys
 import os.path
 
+import datasets
 import jax
 from jax.sharding import Mesh
 from jax.experimental import mesh_utils
@@ -26,6 +27,7 @@ import unittest
 from MaxText import pyconfig
 from MaxText.globals import PKG_DIR
 from MaxText.input_pipeline import _hf_data_processing
+from MaxText.input_pipeline import _input_pipeline_utils
 from MaxText.input_pipeline import input_pipeline_interface
 
 
@@ -102,5 +104,54 @@ class HfDataProcessingTest(unittest.TestCase):
     self.assertTrue((train_batch1["targets"] == train_batch2["targets"]).all())  # pytype: disable=unsupported-operands
 
 
+class HFDataSourceTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    records = [{"text": i} for i in range(64)]
+    self.dataset = datasets.Dataset.from_list(records).to_iterable_dataset(num_shards=8)
+
+  def _make_source(self, host_index, host_count=2, worker_count=2, num_threads=2):
+    return _input_pipeline_utils.HFDataSource(
+        self.dataset,
+        host_index,
+        host_count,
+        num_threads,
+        generate_padding_example=False,
+        max_target_length=8,
+        data_column_names=["text"],
+        grain_worker_count=worker_count,
+    )
+
+  def _read_all(self, source, host_index, start=0):
+    examples = []
+    for local_index in range(start, 1000):
+      try:
+        examples.append(source[host_index * source.RECORDS_PER_HOST + local_index]["text"])
+      except StopIteration:
+        break
+    return examples
+
+  def test_workers_read_disjoint_shards(self):
+    examples = []
+    for host_index in range(2):
+      examples.extend(self._read_all(self._make_source(host_index), host_index))
+    self.assertEqual(sorted(examples), list(range(64)))
+
+  def test_out_of_order_reads(self):
+    source = self._make_source(0, host_count=1)
+    in_order = [source[i]["text"] for i in range(16)]
+    source = self._make_source(0, host_count=1)
+    reversed_order = [source[i]["text"] for i in reversed(range(16))]
+    self.assertEqual(in_order, list(reversed(reversed_order)))
+
+  def test_resume_from_stream_positions(self):
+    source = self._make_source(0, host_count=1)
+    first = [source[i]["text"] for i in range(12)]
+    self.assertEqual(source.get_stream_positions(), {0: 3, 1: 3, 2: 3, 3: 3})
+    restored = self._make_source(0, host_count=1)
+    self.assertEqual(first + self._read_all(restored, 0, start=12), self._read_all(self._make_source(0, host_count=1), 0))
+
+
 if __name__ == "__main__":
   unittest.main()
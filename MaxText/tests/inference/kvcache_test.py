@@ -151,3 +151,50 @@ class MlaKVCacheTest(unittest.TestCase):
     )
     self.assertEqual(ar_low_rank_main[0][0][0][0], low_rank_main_1[0][0][0])
     self.assertEqual(ar_key_rope[0][0][0][0], key_rope_1[0][0][0][0])
+
+
+class RaggedAppendTest(unittest.TestCase):
+  """Tests for the per slot append of ragged attention."""
+
+  def setUp(self):
+    super().setUp()
+    self.rng = jax.random.PRNGKey(0)
+    self.batchsize = 8
+    self.ar_len = 16
+    self.heads = 2
+    self.head_dim = 8
+    self.dtype = jnp.bfloat16
+    self.ar_cache_axis_order = (1, 2, 0, 3)
+    self.test_module = kvcache.KVCache(16, 16 + self.ar_len, self.dtype, ar_cache_axis_order=self.ar_cache_axis_order)
+
+  def _loop_append(self, cache, one_token, lengths, batch_axis, sequence_axis):
+    """Previous implementation, with one update per slot."""
+    cache_locations = [slice(None)] * 4
+    new_token_locations = [slice(None)] * 4
+    new_token_locations[sequence_axis] = 0
+
+    def body(i, val):
+      cache_locations[batch_axis] = i
+      cache_locations[sequence_axis] = lengths[i]
+      new_token_locations[batch_axis] = i
+      return val.at[tuple(cache_locations)].set(one_token[tuple(new_token_locations)])
+
+    return jax.lax.fori_loop(0, lengths.shape[0], body, cache, unroll=8)
+
+  def _get_data(self):
+    rng_cache, rng_token, rng_lengths = jax.random.split(self.rng, 3)
+    logical_shape = (self.batchsize, self.ar_len, self.heads, self.head_dim)
+    cache = jax.random.normal(rng_cache, logical_shape, dtype=self.dtype)
+    one_token = jax.random.normal(rng_token, (self.batchsize, 1, self.heads, self.head_dim), dtype=self.dtype)
+    lengths = jax.random.randint(rng_lengths, (self.batchsize,), 0, self.ar_len)
+    cache = jnp.transpose(cache, self.ar_cache_axis_order)
+    one_token = jnp.transpose(one_token, self.ar_cache_axis_order)
+    batch_axis = self.ar_cache_axis_order.index(0)
+    sequence_axis = self.ar_cache_axis_order.index(1)
+    return cache, one_token, lengths, batch_axis, sequence_axis
+
+  def test_append_per_slot_matches_loop(self):
+    cache, one_token, lengths, batch_axis, sequence_axis = self._get_data()
+    expected = self._loop_append(cache, one_token, lengths, batch_axis, sequence_axis)
+    actual = self.test_module.append_per_slot(cache, one_token, lengths, batch_axis, sequence_axis)
+    self.assertTrue(jnp.array_equal(expected, actual))
@@ -0,0 +1,103 @@
+#  Copyright 2025 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Tests for PageManager."""
+
+import unittest
+
+import jax.numpy as jnp
+
+from MaxText.inference.page_manager import PageManager
+
+
+class PageManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tokens_per_page = 4
+    self.page_manager = PageManager(
+        num_pages=16,
+        tokens_per_page=self._tokens_per_page,
+        max_target_length=32,
+        max_prefill_length=16,
+        batch_size=2,
+    )
+
+  def test_reserve_and_release_prefix_slot_pages(self):
+    page_state = self.page_manager.get_initial_page_state()
+    page_state = self.page_manager.reserve_prefix_slot_pages(slot=0, true_length=10, page_state=page_state)
+    assert int(page_state.num_pages_used[0]) == 3
+    assert int(page_state.sequence_lengths[0]) == 10
+    used_pages = page_state.page_map[0, :3]
+    assert (page_state.page_status[used_pages] == 1).all()
+    page_state = self.page_manager.release_slot_pages(0, page_state)
+    assert int(page_state.page_status.sum()) == 0
+
+  def test_shared_pages_are_reference_counted(self):
+    page_state = self.page_manager.get_initial_page_state()
+    page_state = self.page_manager.reserve_prefix_slot_pages(slot=0, true_length=10, page_state=page_state)
+    shared_pages = page_state.page_map[0, :2].tolist()
+    # Prefix cache holds the full pages of slot 0.
+    page_state = self.page_manager.retain_pages(shared_pages, page_state)
+    page_state = self.page_manager.reserve_prefix_slot_pages(
+        slot=1, true_length=9, page_state=page_state, shared_pages=shared_pages
+    )
+    assert page_state.page_map[1, :2].tolist() == shared_pages
+    assert page_state.page_status[jnp.array(shared_pages)].tolist() == [3, 3]
+    # The partial last page is never shared.
+    assert int(page_state.page_map[1, 2]) not in page_state.page_map[0, :3].tolist()
+    assert int(page_state.num_pages_used.sum()) == 6
+    assert int((page_state.page_status > 0).sum()) == 4
+
+    page_state = self.page_manager.release_slot_pages(0, page_state)
+    page_state = self.page_manager.release_slot_pages(1, page_state)
+    assert page_state.page_status[jnp.array(shared_pages)].tolist() == [1, 1]
+    page_state = self.page_manager.release_pages(shared_pages, page_state)
+    assert int(page_state.page_status.sum()) == 0
+
+  def test_shared_pages_should_be_full_pages(self):
+    page_state = self.page_manager.get_initial_page_state()
+    with self.assertRaises(ValueError):
+      self.page_manager.reserve_prefix_slot_pages(slot=0, true_length=5, page_state=page_state, shared_pages=[1, 2])
+
+  def test_reserve_decode_step_pages_allocates_for_all_slots(self):
+    page_state = self.page_manager.get_initial_page_state()
+    page_state = self.page_manager.reserve_prefix_slot_pages(slot=0, true_length=4, page_state=page_state)
+    page_state = self.page_manager.reserve_prefix_slot_pages(slot=1, true_length=8, page_state=page_state)
+    page_state = self.page_manager.reserve_decode_step_pages(page_state)
+    assert page_state.num_pages_used.tolist() == [2, 3]
+    used_pages = page_state.page_map[0, :2].tolist() + page_state.page_map[1, :3].tolist()
+    assert 0 not in used_pages
+    assert len(set(used_pages)) == 5
+    assert page_state.current_page.tolist() == [used_pages[1], used_pages[4]]
+    assert int(page_state.page_status.sum()) == 5
+    # No slot crosses a page boundary in the next step.
+    next_page_state = self.page_manager.reserve_decode_step_pages(page_state)
+    assert (next_page_state.page_map == page_state.page_map).all()
+    assert int(next_page_state.page_status.sum()) == 5
+
+  def test_release_slots_pages(self):
+    page_state = self.page_manager.get_initial_page_state()
+    page_state = self.page_manager.reserve_prefix_slot_pages(slot=0, true_length=10, page_state=page_state)
+    shared_pages = page_state.page_map[0, :2].tolist()
+    page_state = self.page_manager.reserve_prefix_slot_pages(
+        slot=1, true_length=9, page_state=page_state, shared_pages=shared_pages
+    )
+    page_state = self.page_manager.release_slots_pages(jnp.array([0, 1]), page_state)
+    assert int(page_state.page_status.sum()) == 0
+    assert int(page_state.page_map.sum()) == 0
+    assert int(page_state.num_pages_used.sum()) == 0
+
+
+if __name__ == "__main__":
+  unittest.main()
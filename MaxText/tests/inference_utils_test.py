@@ -0,0 +1,105 @@
+#  Copyright 2025 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Tests for inference_utils sampling."""
+
+import unittest
+
+import jax
+import jax.numpy as jnp
+
+from MaxText import inference_utils
+
+
+class SamplingPerSlotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rng = jax.random.PRNGKey(0)
+    self.logits = jax.random.normal(jax.random.PRNGKey(1), (4, 1, 32))
+    self.steps = jnp.zeros((4,), dtype=jnp.int32)
+
+  def _concat(self, *params):
+    return jax.tree.map(lambda *x: jnp.concatenate(x), *params)
+
+  def test_greedy_matches_argmax(self):
+    params = inference_utils.make_sampling_params("greedy", batch_size=4)
+    tokens = inference_utils.sampling_per_slot(self.logits, self.rng, params, self.steps)
+    assert tokens.shape == (4, 1)
+    assert (tokens == jnp.argmax(self.logits, axis=-1)).all()
+
+  def test_mixed_batch(self):
+    params = self._concat(
+        inference_utils.make_sampling_params("greedy"),
+        inference_utils.make_sampling_params("topk", topk=1, temperature=0.5),
+        inference_utils.make_sampling_params("nucleus", nucleus_topp=1e-6, temperature=2.0),
+        inference_utils.make_sampling_params("weighted", temperature=1.0),
+    )
+    tokens = jax.jit(inference_utils.sampling_per_slot)(self.logits, self.rng, params, self.steps)
+    expected = jnp.argmax(self.logits, axis=-1)
+    # Top-1 and a tiny nucleus only keep the best logit.
+    assert (tokens[:3] == expected[:3]).all()
+
+  def test_topk_restricts_candidates(self):
+    params = inference_utils.make_sampling_params("topk", topk=3, temperature=100.0, batch_size=4)
+    top3 = jax.lax.top_k(self.logits, 3)[1]
+    for i in range(8):
+      tokens = inference_utils.sampling_per_slot(self.logits, jax.random.PRNGKey(i), params, self.steps)
+      assert (tokens[..., None] == top3).any(axis=-1).all()
+
+  def test_seeded_slots_are_reproducible(self):
+    params = inference_utils.make_sampling_params("weighted", temperature=100.0, seed=7, batch_size=4)
+    tokens = inference_utils.sampling_per_slot(self.logits, jax.random.PRNGKey(1), params, self.steps)
+    other_rng_tokens = inference_utils.sampling_per_slot(self.logits, jax.random.PRNGKey(2), params, self.steps)
+    assert (tokens == other_rng_tokens).all()
+
+  def test_nucleus_matches_sample_nucleus_topp_logits(self):
+    # Top-p restricts the unscaled logits before the temperature is applied.
+    logits = 4.0 * self.logits[0]
+    for temperature in [0.3, 1.0, 3.0]:
+      for i in range(4):
+        rng = jax.random.PRNGKey(i)
+        expected = inference_utils.sample_nucleus_topp_logits(logits, 0.8, temperature, rng)
+        tokens = inference_utils._sample_slot(logits, rng, temperature, 0, 0.8)  # pylint: disable=protected-access
+        assert (tokens == expected).all()
+
+  def test_invalid_params(self):
+    with self.assertRaises(ValueError):
+      inference_utils.make_sampling_params("topk", topk=0)
+    with self.assertRaises(ValueError):
+      inference_utils.make_sampling_params("beam")
+
+
+class NucleusSamplingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.logits = 4.0 * jax.random.normal(jax.random.PRNGKey(1), (8, 1, 256))
+
+  def test_candidates_match_full_sort(self):
+    for i in range(4):
+      rng = jax.random.PRNGKey(i)
+      expected = inference_utils.sample_nucleus_topp_logits(self.logits, 0.8, 1.0, rng)
+      tokens = inference_utils.sample_nucleus_topp_logits(self.logits, 0.8, 1.0, rng, nucleus_candidates=64)
+      assert (tokens == expected).all()
+
+  def test_falls_back_to_full_sort(self):
+    # Two candidates can't cover the nucleus of a flat distribution.
+    logits = jnp.zeros((2, 1, 256))
+    rng = jax.random.PRNGKey(0)
+    expected = inference_utils.sample_nucleus_topp_logits(logits, 0.5, 1.0, rng)
+    tokens = jax.jit(inference_utils.sample_nucleus_topp_logits, static_argnums=(1, 4))(logits, 0.5, 1.0, rng, 2)
+    assert (tokens == expected).all()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,168 @@
+"""
+Copyright 2025 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the streaming HuggingFace checkpoint conversion """
+
+import tempfile
+import unittest
+
+import jax
+import numpy as np
+import psutil
+import torch
+from jax import tree
+from safetensors.torch import save_file
+
+from MaxText import checkpointing
+from MaxText import llama_or_mistral_ckpt
+
+MODEL_PARAMS = {
+    "num_layers": 3,
+    "num_heads": 4,
+    "num_kv_heads": 2,
+    "dims_per_head": 8,
+    "vocab": 64,
+}
+EMB_DIM = 32
+MLP_DIM = 48
+
+
+def _write_hf_checkpoint(path, num_experts=None):
+  """Writes a small random Llama (or Mixtral if num_experts is set) checkpoint split over two safetensors files.
+
+  Returns the written tensors by their HuggingFace names.
+  """
+  torch.manual_seed(0)
+  kv_dim = MODEL_PARAMS["num_kv_heads"] * MODEL_PARAMS["dims_per_head"]
+  shards = [{}, {}]
+  shards[0]["model.embed_tokens.weight"] = torch.randn(MODEL_PARAMS["vocab"], EMB_DIM)
+  shards[1]["model.norm.weight"] = torch.randn(EMB_DIM)
+  shards[1]["lm_head.weight"] = torch.randn(MODEL_PARAMS["vocab"], EMB_DIM)
+  for layer_idx in range(MODEL_PARAMS["num_layers"]):
+    shard = shards[layer_idx % 2]
+    prefix = f"model.layers.{layer_idx}"
+    shard[f"{prefix}.input_layernorm.weight"] = torch.randn(EMB_DIM)
+    shard[f"{prefix}.post_attention_layernorm.weight"] = torch.randn(EMB_DIM)
+    shard[f"{prefix}.self_attn.q_proj.weight"] = torch.randn(EMB_DIM, EMB_DIM)
+    shard[f"{prefix}.self_attn.k_proj.weight"] = torch.randn(kv_dim, EMB_DIM)
+    shard[f"{prefix}.self_attn.v_proj.weight"] = torch.randn(kv_dim, EMB_DIM)
+    shard[f"{prefix}.self_attn.o_proj.weight"] = torch.randn(EMB_DIM, EMB_DIM)
+    if num_experts is None:
+      shard[f"{prefix}.mlp.gate_proj.weight"] = torch.randn(MLP_DIM, EMB_DIM)
+      shard[f"{prefix}.mlp.up_proj.weight"] = torch.randn(MLP_DIM, EMB_DIM)
+      shard[f"{prefix}.mlp.down_proj.weight"] = torch.randn(EMB_DIM, MLP_DIM)
+    else:
+      shard[f"{prefix}.block_sparse_moe.gate.weight"] = torch.randn(num_experts, EMB_DIM)
+      for expert_idx in range(num_experts):
+        # spread the experts of a layer over both files
+        expert_shard = shards[(layer_idx + expert_idx) % 2]
+        expert_prefix = f"{prefix}.block_sparse_moe.experts.{expert_idx}"
+        expert_shard[f"{expert_prefix}.w1.weight"] = torch.randn(MLP_DIM, EMB_DIM)
+        expert_shard[f"{expert_prefix}.w3.weight"] = torch.randn(MLP_DIM, EMB_DIM)
+        expert_shard[f"{expert_prefix}.w2.weight"] = torch.randn(EMB_DIM, MLP_DIM)
+  tensors = {}
+  for i, shard in enumerate(shards):
+    shard = {k: v.to(torch.bfloat16) for k, v in shard.items()}
+    save_file(shard, f"{path}/model-{i:05d}-of-00002.safetensors")
+    tensors.update(shard)
+  return tensors
+
+
+def _to_numpy(tensor):
+  return tensor.to(torch.float32).numpy().astype(llama_or_mistral_ckpt.CAST_DTYPE)
+
+
+def _restore_params(maxtext_model_path, like):
+  """Restores the params saved by save_weights_to_checkpoint, with the structure, shapes and dtypes of like."""
+  sharding = jax.sharding.SingleDeviceSharding(jax.devices()[0])
+  abstract_params = tree.map(lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype, sharding=sharding), {"params": like})
+  restored = checkpointing.load_params_from_path(f"{maxtext_model_path}/0/items", abstract_params, 1)
+  return restored["params"]
+
+
+class StreamingConversionTest(unittest.TestCase):
+
+  def test_streaming_matches_in_memory_conversion(self):
+    with tempfile.TemporaryDirectory() as base_model_path, tempfile.TemporaryDirectory() as scratch_dir:
+      _write_hf_checkpoint(base_model_path)
+      for model_size in ("llama2-7b", "llama3.1-8b"):
+        expected = llama_or_mistral_ckpt._convert_huggingface_to_jax_weights(  # pylint: disable=protected-access
+            base_model_path, model_size, MODEL_PARAMS, psutil.Process()
+        )
+        streamed = llama_or_mistral_ckpt._convert_huggingface_to_jax_weights_streaming(  # pylint: disable=protected-access
+            base_model_path, model_size, MODEL_PARAMS, psutil.Process(), scratch_dir, num_workers=2
+        )
+        self.assertEqual(tree.structure(expected), tree.structure(streamed))
+        for expected_weight, streamed_weight in zip(tree.leaves(expected), tree.leaves(streamed)):
+          # the in-memory conversion may promote the scaled query kernel, the checkpoint keeps CAST_DTYPE
+          expected_weight = np.asarray(expected_weight).astype(llama_or_mistral_ckpt.CAST_DTYPE)
+          self.assertEqual(streamed_weight.dtype, llama_or_mistral_ckpt.CAST_DTYPE)
+          np.testing.assert_array_equal(expected_weight.astype(np.float32), np.asarray(streamed_weight).astype(np.float32))
+
+  def test_streaming_moe_matches_safetensors(self):
+    num_experts = 4
+    model_params = {**MODEL_PARAMS, "num_experts": num_experts}
+    with tempfile.TemporaryDirectory() as base_model_path, tempfile.TemporaryDirectory() as scratch_dir:
+      tensors = _write_hf_checkpoint(base_model_path, num_experts=num_experts)
+      streamed = llama_or_mistral_ckpt._convert_huggingface_to_jax_weights_streaming(  # pylint: disable=protected-access
+          base_model_path, "mixtral-8x7b", model_params, psutil.Process(), scratch_dir, num_workers=3
+      )
+      moe_block = streamed["decoder"]["layers"]["MoeBlock_0"]
+      self.assertNotIn("mlp", streamed["decoder"]["layers"])
+      self.assertEqual(moe_block["gate"]["kernel"].shape, (EMB_DIM, MODEL_PARAMS["num_layers"], num_experts))
+      self.assertEqual(moe_block["wi_0"].shape, (num_experts, MODEL_PARAMS["num_layers"], EMB_DIM, MLP_DIM))
+      self.assertEqual(moe_block["wo"].shape, (num_experts, MODEL_PARAMS["num_layers"], MLP_DIM, EMB_DIM))
+      for layer_idx in range(MODEL_PARAMS["num_layers"]):
+        prefix = f"model.layers.{layer_idx}.block_sparse_moe"
+        np.testing.assert_array_equal(
+            moe_block["gate"]["kernel"][:, layer_idx], _to_numpy(tensors[f"{prefix}.gate.weight"]).transpose()
+        )
+        for expert_idx in range(num_experts):
+          expert_prefix = f"{prefix}.experts.{expert_idx}"
+          np.testing.assert_array_equal(
+              moe_block["wi_0"][expert_idx, layer_idx], _to_numpy(tensors[f"{expert_prefix}.w1.weight"]).transpose()
+          )
+          np.testing.assert_array_equal(
+              moe_block["wi_1"][expert_idx, layer_idx], _to_numpy(tensors[f"{expert_prefix}.w3.weight"]).transpose()
+          )
+          np.testing.assert_array_equal(
+              moe_block["wo"][expert_idx, layer_idx], _to_numpy(tensors[f"{expert_prefix}.w2.weight"]).transpose()
+          )
+
+  def test_streaming_checkpoint_restores(self):
+    with (
+        tempfile.TemporaryDirectory() as base_model_path,
+        tempfile.TemporaryDirectory() as scratch_dir,
+        tempfile.TemporaryDirectory() as maxtext_model_path,
+    ):
+      _write_hf_checkpoint(base_model_path)
+      streamed = llama_or_mistral_ckpt._convert_huggingface_to_jax_weights_streaming(  # pylint: disable=protected-access
+          base_model_path, "llama3.1-8b", MODEL_PARAMS, psutil.Process(), scratch_dir, num_workers=2
+      )
+      # copy before saving, save_weights_to_checkpoint consumes its input
+      expected = tree.map(np.array, streamed)
+      llama_or_mistral_ckpt.save_weights_to_checkpoint(
+          maxtext_model_path, streamed, jax.device_count(), use_ocdbt=True, use_zarr3=True
+      )
+      restored = _restore_params(maxtext_model_path, expected)
+      self.assertEqual(tree.structure(expected), tree.structure(restored))
+      for expected_weight, restored_weight in zip(tree.leaves(expected), tree.leaves(restored)):
+        self.assertEqual(restored_weight.dtype, expected_weight.dtype)
+        np.testing.assert_array_equal(expected_weight.astype(np.float32), np.asarray(restored_weight).astype(np.float32))
+
+
+if __name__ == "__main__":
+  unittest.main()
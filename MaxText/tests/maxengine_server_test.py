@@ -0,0 +1,73 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the prefix caching config of the maxengine server."""
+
+import types
+import unittest
+
+from MaxText import maxengine_server
+
+_create_prefix_caching_config = maxengine_server._create_prefix_caching_config  # pylint: disable=protected-access
+
+
+def _config(**kwargs):
+  """Returns a config enabling prefix caching with the options overridden by kwargs."""
+  config = {
+      "enable_prefix_caching": True,
+      "use_chunked_prefill": True,
+      "prefix_caching_hbm_byte": 1_000,
+      "prefix_caching_dram_byte": 10_000,
+      "prefix_caching_eviction_policy": "lru",
+      "prefix_caching_ttl_seconds": 0,
+      "prefix_caching_disk_dir": "",
+  }
+  config.update(kwargs)
+  return types.SimpleNamespace(**config)
+
+
+class PrefixCachingConfigTest(unittest.TestCase):
+  """Tests for _create_prefix_caching_config."""
+
+  def test_disabled(self):
+    self.assertIsNone(_create_prefix_caching_config(_config(enable_prefix_caching=False)))
+
+  def test_lru(self):
+    prefix_caching_config = _create_prefix_caching_config(_config())
+    self.assertEqual(prefix_caching_config.max_hbm_byte, 1_000)
+    self.assertEqual(prefix_caching_config.max_dram_byte, 10_000)
+
+  def test_requires_chunked_prefill(self):
+    with self.assertRaises(ValueError):
+      _create_prefix_caching_config(_config(use_chunked_prefill=False))
+
+  def test_invalid_eviction_policy(self):
+    with self.assertRaisesRegex(ValueError, "Unknown eviction policy"):
+      _create_prefix_caching_config(_config(prefix_caching_eviction_policy="fifo"))
+
+  def test_rejects_maxtext_only_eviction_policy(self):
+    with self.assertRaisesRegex(ValueError, "only apply to the MaxText PrefixCache"):
+      _create_prefix_caching_config(_config(prefix_caching_eviction_policy="lfu"))
+
+  def test_rejects_ttl(self):
+    with self.assertRaisesRegex(ValueError, "only apply to the MaxText PrefixCache"):
+      _create_prefix_caching_config(_config(prefix_caching_eviction_policy="ttl", prefix_caching_ttl_seconds=60))
+
+  def test_rejects_disk_dir(self):
+    with self.assertRaisesRegex(ValueError, "only applies to the MaxText PrefixCache"):
+      _create_prefix_caching_config(_config(prefix_caching_disk_dir="/tmp/prefix_cache"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -30,6 +30,7 @@ import numpy as np
 from MaxText import common_types
 from MaxText.layers import models
 from MaxText.layers import quantizations
+from MaxText import max_utils
 from MaxText import maxtext_utils
 from MaxText.maxengine import MaxEngine
 from MaxText import pyconfig, maxengine
@@ -126,6 +127,112 @@ class MaxEngineTest(unittest.TestCase):
     self.assertNotEqual(prefill_result["tokens"], jnp.array([0]))
     self.assertTrue(jnp.array_equal(first_token.data.size, 3))
 
+  def test_bulk_insert_matches_insert(self):
+    config = self.init_pyconfig(per_device_batch_size=4.0)
+    engine = MaxEngine(config, jax.devices())
+    params = engine.load_params(rng=self.rng)
+    input_tokens = jnp.array([1, 306, 5360, 304])
+    prefix, _ = engine.prefill(params=params, padded_tokens=input_tokens, true_length=3)
+    slots = [0, 2, 3]
+
+    expected = engine.init_decode_state()
+    for slot in slots:
+      expected = engine.insert(jax.tree.map(jnp.copy, prefix), expected, slot)
+    actual = engine.bulk_insert(jax.tree.map(jnp.copy, prefix), engine.init_decode_state(), slots)
+
+    jax.tree.map(
+        np.testing.assert_array_equal,
+        max_utils.unbox_logicallypartioned(actual),
+        max_utils.unbox_logicallypartioned(expected),
+    )
+
+  @pytest.mark.tpu_only
+  def test_paged_bulk_insert_matches_insert(self):
+    config = self.init_pyconfig(per_device_batch_size=4.0, attention="paged", pagedattn_tokens_per_page=2)
+    input_tokens = jnp.array([1, 306, 5360, 304])
+    slots = [0, 2, 3]
+
+    expected_engine = MaxEngine(config, jax.devices())
+    params = expected_engine.load_params(rng=self.rng)
+    expected = expected_engine.init_decode_state()
+    for slot in slots:
+      prefix, _ = expected_engine.prefill(params=params, padded_tokens=input_tokens, true_length=3, slot=slot)
+      expected = expected_engine.insert(prefix, expected, slot)
+
+    # The prefill slot is not one of the slots, so its pages should be released.
+    engine = MaxEngine(config, jax.devices())
+    actual = engine.init_decode_state()
+    prefix, _ = engine.prefill(params=params, padded_tokens=input_tokens, true_length=3, slot=1)
+    actual = engine.bulk_insert(prefix, actual, slots)
+
+    def slot_pages(engine, decode_state, slot):
+      pages = engine.page_state.page_map[slot, : engine.page_state.num_pages_used[slot]]
+      return jax.tree.map(lambda cache: cache[:, pages], max_utils.unbox_logicallypartioned(decode_state["cache"]))
+
+    for slot in slots:
+      jax.tree.map(
+          np.testing.assert_array_equal,
+          slot_pages(engine, actual, slot),
+          slot_pages(expected_engine, expected, slot),
+      )
+    for key in ["logits", "next_pos", "generated_tokens", "tokens"]:
+      np.testing.assert_array_equal(actual[key][np.array(slots)], expected[key][np.array(slots)])
+    # The full page of the prompt is shared, each slot only holds its own partial page.
+    self.assertEqual(int(engine.page_state.num_pages_used[1]), 0)
+    self.assertEqual(int(jnp.sum(engine.page_state.page_status)), 2 * len(slots))
+    self.assertEqual(int(jnp.sum(engine.page_state.page_status > 0)), 1 + len(slots))
+
+  @pytest.mark.tpu_only
+  def test_paged_fused_generate_matches_unfused(self):
+    input_tokens = jnp.array([1, 306, 5360, 304])
+    slot = 1
+    num_steps = 4
+
+    def run(fuse_page_allocation):
+      config = self.init_pyconfig(
+          per_device_batch_size=4.0,
+          attention="paged",
+          pagedattn_tokens_per_page=2,
+          pagedattn_fuse_page_allocation=fuse_page_allocation,
+      )
+      engine = MaxEngine(config, jax.devices())
+      params = engine.load_params(rng=self.rng)
+      prefix, _ = engine.prefill(params=params, padded_tokens=input_tokens, true_length=3, slot=slot)
+      decode_state = engine.insert(prefix, engine.init_decode_state(), slot)
+      tokens = []
+      for _ in range(num_steps):
+        decode_state, result = engine.generate(params, decode_state, rng=self.rng)
+        tokens.append(result.data[slot])
+      return engine.page_state, tokens
+
+    expected_page_state, expected_tokens = run(fuse_page_allocation=False)
+    actual_page_state, actual_tokens = run(fuse_page_allocation=True)
+
+    np.testing.assert_array_equal(actual_tokens, expected_tokens)
+    jax.tree.map(np.testing.assert_array_equal, actual_page_state, expected_page_state)
+    # The prompt of 3 tokens fills 2 pages, and the decode steps cross into 2 more pages.
+    self.assertEqual(int(actual_page_state.num_pages_used[slot]), 4)
+
+  def test_paged_prefill_pages_reserved_in_jit(self):
+    config = self.init_pyconfig(attention="paged", pagedattn_tokens_per_page=2)
+    engine = MaxEngine(config, jax.devices())
+    page_manager = engine.page_manager
+    expected = page_manager.reserve_prefix_slot_pages(slot=0, true_length=3, page_state=engine.page_state)
+    # prefill reserves pages with a traced true_length when it is jitted as a whole, e.g. in prefill_insert
+    actual = jax.jit(lambda true_length, page_state: page_manager.reserve_prefix_slot_pages(0, true_length, page_state))(
+        3, engine.page_state
+    )
+    jax.tree.map(np.testing.assert_array_equal, actual, expected)
+    self.assertEqual(int(actual.num_pages_used[0]), 2)
+
+  def test_prefill_insert_rejects_paged_prefix_cache(self):
+    config = self.init_pyconfig(attention="paged", pagedattn_tokens_per_page=2, pagedattn_prefix_caching_num_pages=4)
+    engine = MaxEngine(config, jax.devices())
+    input_tokens = jnp.array([1, 306, 5360, 304])
+    # the prefix cache lookup needs the prompt tokens on the host, which a traced prefill_insert doesn't have
+    with self.assertRaisesRegex(ValueError, "paged prefix cache"):
+      jax.jit(engine.prefill_insert)(input_tokens, 3, self.rng, {}, 0, {})
+
   @pytest.mark.skip(reason="Can only pass on CPU.")
   def test_chunked_prefill(self):
     """Test identical result between chunked prefill with single and multiple chunked.
@@ -0,0 +1,170 @@
+"""
+Copyright 2025 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the metric logger and its sinks """
+import json
+import os
+import tempfile
+import threading
+import types
+import unittest
+
+import jax.numpy as jnp
+
+from MaxText import metric_logger
+
+
+class _RecordingSink(metric_logger.MetricsSink):
+
+  def __init__(self, block_event=None):
+    self.records = []
+    self.block_event = block_event
+    self.closed = False
+
+  def write(self, metrics, step, is_training):
+    if self.block_event is not None:
+      self.block_event.wait()
+    self.records.append((float(metrics["scalar"]["learning/loss"]), step, is_training))
+
+  def close(self):
+    self.closed = True
+
+
+class _RecordingSummaryWriter:
+
+  def __init__(self):
+    self.histograms = {}
+
+  def add_scalar(self, *args, **kwargs):
+    pass
+
+  def add_histogram_raw(self, tag, global_step=None, **kwargs):
+    self.histograms[(tag, global_step)] = kwargs
+
+  def flush(self):
+    pass
+
+
+def _make_metrics(loss):
+  return {
+      "scalar": {
+          "learning/loss": jnp.array(loss),
+          "learning/total_weights": jnp.array(8.0),
+          "perf/step_time_seconds": 0.1,
+          "perf/per_device_tflops_per_sec": 1.0,
+          "perf/per_device_tokens_per_sec": 10.0,
+      }
+  }
+
+
+def _make_config(async_metrics_writer):
+  return types.SimpleNamespace(async_metrics_writer=async_metrics_writer)
+
+
+class MetricLoggerTest(unittest.TestCase):
+
+  def test_sync_writer_double_buffers(self):
+    sink = _RecordingSink()
+    logger = metric_logger.MetricLogger(None, _make_config(False), sinks=[sink])
+    logger.write_metrics(_make_metrics(1.0), 0)
+    self.assertEqual(sink.records, [])
+    logger.write_metrics(_make_metrics(2.0), 1)
+    self.assertEqual(sink.records, [(1.0, 0, True)])
+    logger.close()
+    self.assertEqual(sink.records, [(1.0, 0, True), (2.0, 1, True)])
+    self.assertTrue(sink.closed)
+
+  def test_async_writer_does_not_block_on_sinks(self):
+    block_event = threading.Event()
+    sink = _RecordingSink(block_event)
+    logger = metric_logger.MetricLogger(None, _make_config(True), sinks=[sink])
+    for step in range(3):
+      logger.write_metrics(_make_metrics(float(step)), step)
+    logger.write_metrics({"scalar": {"learning/loss": 5.0}}, 2, is_training=False)
+    self.assertEqual(sink.records, [])
+    block_event.set()
+    logger.close()
+    self.assertEqual(sink.records, [(0.0, 0, True), (1.0, 1, True), (2.0, 2, True), (5.0, 2, False)])
+
+  def test_async_writer_bounds_pending_writes(self):
+    block_event = threading.Event()
+    sink = _RecordingSink(block_event)
+    logger = metric_logger.MetricLogger(None, _make_config(True), sinks=[sink])
+    num_steps = metric_logger._MAX_PENDING_WRITES + 2  # pylint: disable=protected-access
+    writer_thread = threading.Thread(
+        target=lambda: [logger.write_metrics(_make_metrics(float(step)), step) for step in range(num_steps)]
+    )
+    writer_thread.start()
+    writer_thread.join(timeout=1.0)
+    self.assertTrue(writer_thread.is_alive())
+    block_event.set()
+    writer_thread.join()
+    logger.close()
+    self.assertEqual([step for _, step, _ in sink.records], list(range(num_steps)))
+
+  def test_local_file_sink(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      metrics_file = os.path.join(tmp_dir, "metrics.txt")
+      sink = metric_logger.LocalFileSink(metrics_file, "test")
+      logger = metric_logger.MetricLogger(None, _make_config(True), sinks=[sink])
+      for step in range(2):
+        logger.write_metrics(_make_metrics(float(step)), step)
+      logger.close()
+      with open(metrics_file, "r", encoding="utf8") as f:
+        lines = [json.loads(line) for line in f]
+    self.assertEqual(
+        [(line["step"], line["learning/loss"], line["run_name"]) for line in lines],
+        [(0, 0, "test"), (1, 1, "test")],
+    )
+
+  def test_tensorboard_sink_writes_histograms(self):
+    writer = _RecordingSummaryWriter()
+    sink = metric_logger.TensorBoardSink(writer, "tensorboard", log_period=10)
+    expert_load = [0.5, 0.25, 0.0, 0.25]
+    sink.write({"scalar": {}, "histogram": {"moe/expert_load/layers/000": expert_load}}, 3, is_training=True)
+    histogram = writer.histograms[("moe/expert_load/layers/000", 3)]
+    self.assertEqual(histogram["bucket_counts"], expert_load)
+    self.assertEqual(histogram["bucket_limits"], [0.5, 1.5, 2.5, 3.5])
+    self.assertAlmostEqual(histogram["num"], 1.0)
+    self.assertAlmostEqual(histogram["sum"], 0.25 + 0.75)
+
+  def test_object_store_sink_uploads_every_log_period(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      metrics_dir = os.path.join(tmp_dir, "metrics")
+      cwd = os.getcwd()
+      os.chdir(tmp_dir)
+      try:
+        sink = metric_logger.ObjectStoreSink(metrics_dir, "test", log_period=2, steps=5)
+        for step in range(5):
+          sink.write({"scalar": {"learning/loss": float(step)}}, step, is_training=True)
+      finally:
+        os.chdir(cwd)
+      uploaded = sorted(os.listdir(metrics_dir))
+      with open(os.path.join(metrics_dir, uploaded[-1]), "r", encoding="utf8") as f:
+        last_steps = [json.loads(line)["step"] for line in f]
+    self.assertEqual(
+        uploaded,
+        [
+            "metrics_step_000000_to_step_000001.txt",
+            "metrics_step_000002_to_step_000003.txt",
+            "metrics_step_000004_to_step_000004.txt",
+        ],
+    )
+    self.assertEqual(last_steps, [4])
+
+
+if __name__ == "__main__":
+  unittest.main()
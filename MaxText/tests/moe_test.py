@@ -162,6 +162,66 @@ class TokenDroppingTest(unittest.TestCase):
     self.assertTrue((expected_dispatch_mask == actual_dispatch_mask).all())
     self.assertTrue(jax.numpy.allclose(expected_combine_mask, actual_combine_mask, rtol=1e-02, atol=1e-02))
 
+  def test_index_dispatch_matches_masks(self):
+    batch_size, seq_len, emb_dim = 2, 16, 4
+    rng_logits, rng_inputs = jax.random.split(self.rng)
+    logits = jax.random.normal(rng_logits, (batch_size, seq_len, self.cfg.num_experts))
+    inputs = jax.random.normal(rng_inputs, (batch_size, seq_len, emb_dim))
+    top_k_weights, top_k_indices = jax.lax.top_k(logits, self.cfg.num_experts_per_tok)
+    weights = self.model.reshape_and_update_weights(top_k_weights, top_k_indices)
+
+    dispatch_mask, combine_mask = self.model.generate_masks(top_k_indices, weights)
+    expected_dispatch = jnp.einsum("BSM,BSEC -> EBCM", inputs, dispatch_mask.astype(inputs.dtype))
+    expected_output = jnp.einsum("EBCM,BSEC -> BSM", expected_dispatch, combine_mask.astype(inputs.dtype))
+
+    expert_capacity = self.model.get_expert_capacity(seq_len)
+    slots = self.model.generate_dispatch_slots(top_k_indices, expert_capacity)
+    actual_dispatch = self.model.index_dispatch(inputs, slots, expert_capacity)
+    actual_output = self.model.index_combine(actual_dispatch, slots, top_k_weights.astype(self.model.dtype))
+
+    self.assertTrue(jax.numpy.allclose(expected_dispatch, actual_dispatch))
+    self.assertTrue(jax.numpy.allclose(expected_output, actual_output, rtol=1e-02, atol=1e-02))
+
+  def test_routing_metrics_match_masks(self):
+    cfg = pyconfig.initialize(
+        [None, os.path.join(PKG_DIR, "configs", "base.yml")],
+        run_name="routing_metrics_test",
+        enable_checkpointing=False,
+        model_name="mixtral-8x7b",
+        megablox=False,
+        sparse_matmul=False,
+        max_target_length=80,
+        per_device_batch_size=1,
+        capacity_factor=1,
+        record_moe_metrics=True,
+    )
+    model = self.model.clone(config=cfg)
+    batch_size, seq_len = 2, 16
+    logits = jax.random.normal(self.rng, (batch_size, seq_len, cfg.num_experts))
+    top_k_weights, top_k_indices = jax.lax.top_k(logits, cfg.num_experts_per_tok)
+    expert_capacity = model.get_expert_capacity(seq_len)
+    _, variables = model.apply(
+        {},
+        logits,
+        top_k_indices,
+        expert_capacity,
+        method=moe.MoeBlock.sow_routing_metrics,
+        mutable=["intermediates"],
+    )
+    metrics = variables["intermediates"]
+
+    weights = model.reshape_and_update_weights(jax.nn.softmax(top_k_weights, axis=-1), top_k_indices)
+    dispatch_mask, _ = model.generate_masks(top_k_indices, weights)
+    expected_drop_rate = 1 - jnp.sum(dispatch_mask) / top_k_indices.size
+    expected_load = jnp.bincount(jnp.ravel(top_k_indices), length=cfg.num_experts) / top_k_indices.size
+    probs = jax.nn.softmax(logits, axis=-1)
+    expected_entropy = -jnp.mean(jnp.sum(probs * jnp.log(probs), axis=-1))
+
+    self.assertGreater(expected_drop_rate, 0)
+    self.assertTrue(jax.numpy.allclose(metrics["moe_drop_rate"][0], expected_drop_rate))
+    self.assertTrue(jax.numpy.allclose(metrics["moe_expert_load"][0], expected_load))
+    self.assertTrue(jax.numpy.allclose(metrics["moe_routing_entropy"][0], expected_entropy, rtol=1e-05))
+
 
 class DeepSeekRoutingTest(unittest.TestCase):
 
@@ -70,5 +70,54 @@ class MultihostDataloadingTest(unittest.TestCase):
     self.assertTrue(not np.array_equal(first_batch, sec_batch, equal_nan=True))
 
 
+class _StatefulIterator:
+  """Iterator over batches of a constant value with a grain-like get_state/set_state."""
+
+  def __init__(self, num_batches, batch_size):
+    self.step = 0
+    self.num_batches = num_batches
+    self.batch_size = batch_size
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.step >= self.num_batches:
+      raise StopIteration
+    self.step += 1
+    return np.full((self.batch_size, 4), self.step, dtype=np.int32)
+
+  def get_state(self):
+    return self.step
+
+  def set_state(self, state):
+    self.step = state
+
+
+class MultihostDataloadingPrefetchTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.mesh = Mesh(mesh_utils.create_device_mesh((jax.device_count(),)), ["data"])
+    self.local_iterator = _StatefulIterator(num_batches=10, batch_size=jax.device_count())
+    self.multihost_gen = multihost_dataloading.MultiHostDataLoadIterator([], self.mesh, prefetch_depth=3)
+    self.multihost_gen.local_iterator = self.local_iterator
+
+  def test_prefetch_keeps_order(self):
+    steps = [int(next(self.multihost_gen)[0, 0]) for _ in range(10)]
+    self.assertEqual(steps, list(range(1, 11)))
+    with self.assertRaises(StopIteration):
+      next(self.multihost_gen)
+
+  def test_checkpoint_state_is_last_consumed_batch(self):
+    next(self.multihost_gen)
+    next(self.multihost_gen)
+    # The prefetch thread has loaded more batches than were consumed.
+    self.assertEqual(self.multihost_gen.local_iterator.get_state(), 2)
+    self.multihost_gen.local_iterator.set_state(5)
+    self.assertEqual(int(next(self.multihost_gen)[0, 0]), 6)
+    self.assertIn("perf/data_prefetch_stall_seconds", self.multihost_gen.get_prefetch_metrics())
+
+
 if __name__ == "__main__":
   unittest.main()
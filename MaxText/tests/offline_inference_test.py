@@ -0,0 +1,138 @@
+#  Copyright 2025 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Tests for the offline inference scheduler."""
+
+import collections
+import threading
+import types
+import unittest
+
+import numpy as np
+
+from MaxText.inference_mlperf.offline_inference import ContinuousBatchingScheduler, InputData, OfflineInference
+
+
+def _row(idx, true_length, padded_length):
+  return InputData(id=str(idx), tokens=np.zeros(padded_length, dtype=np.int32), true_length=true_length)
+
+
+class _DummyEngine:
+  """The engine attributes OfflineInference reads, its prefills and generate steps run in dummy mode."""
+
+  max_concurrent_decodes = 4
+  config = types.SimpleNamespace(max_prefill_predict_length=64, max_target_length=64 + 12)
+
+  def load_params(self):
+    return {}
+
+  def get_tokenizer(self):
+    return None
+
+  def build_tokenizer(self, metadata):
+    del metadata
+    return types.SimpleNamespace(eos_id=-1)
+
+
+class ContinuousBatchingSchedulerTest(unittest.TestCase):
+
+  def _scheduler(self, **kwargs):
+    init_kwargs = {
+        "batch_size": 8,
+        "max_prefill_length": 1024,
+        "max_decode_length": 1024,
+        "max_decode_steps": 10,
+    } | kwargs
+    return ContinuousBatchingScheduler(**init_kwargs)
+
+  def test_first_fit_packing(self):
+    scheduler = self._scheduler()
+    rows = [_row(0, 400, 512), _row(1, 500, 512), _row(2, 300, 512), _row(3, 100, 128)]
+    batches = scheduler.pack(rows)
+    assert [[row.id for row in batch.rows] for batch in batches] == [["0", "1", "3"], ["2"]]
+    assert batches[0].num_tokens == 1000
+    assert batches[0].padded_length == 512
+
+  def test_packing_leaves_room_for_padded_length(self):
+    scheduler = self._scheduler()
+    # Copying 1024 tokens from the second prompt, which starts at 200, overflows the prefill.
+    rows = [_row(0, 200, 256), _row(1, 300, 512), _row(2, 100, 1024)]
+    batches = scheduler.pack(rows)
+    assert [[row.id for row in batch.rows] for batch in batches] == [["0", "1"], ["2"]]
+
+  def test_no_batch_prefill(self):
+    scheduler = self._scheduler(enable_batch_prefill=False)
+    batches = scheduler.pack([_row(0, 10, 64), _row(1, 10, 64)])
+    assert len(batches) == 2
+
+  def test_packing_limited_by_max_prompts_per_prefill(self):
+    scheduler = self._scheduler(max_prompts_per_prefill=2)
+    batches = scheduler.pack([_row(i, 10, 64) for i in range(5)])
+    assert [len(batch.rows) for batch in batches] == [2, 2, 1]
+
+  def test_prefill_limited_by_free_slots_and_budget(self):
+    scheduler = self._scheduler(prefill_token_budget=512)
+    scheduler.add_requests([_row(i, 200, 256) for i in range(6)])
+    iteration = scheduler.schedule(num_free_slots=8, decode_steps_left=[])
+    assert sum(len(batch.rows) for batch in iteration.prefill_batches) == 2
+    # Prompts wait on the budget with free slots, only a single generate step runs.
+    assert iteration.decode_steps == 1
+    assert scheduler.num_pending == 4
+
+    iteration = scheduler.schedule(num_free_slots=1, decode_steps_left=[1000, 1000])
+    assert sum(len(batch.rows) for batch in iteration.prefill_batches) == 1
+    assert iteration.decode_steps == 10
+
+  def test_decode_steps_stop_at_earliest_finishing_slot(self):
+    scheduler = self._scheduler()
+    iteration = scheduler.schedule(num_free_slots=0, decode_steps_left=[3, 500, 0])
+    assert not iteration.prefill_batches
+    assert iteration.decode_steps == 3
+    iteration = scheduler.schedule(num_free_slots=8, decode_steps_left=[])
+    assert iteration.decode_steps == 0
+
+  def test_record_utilization(self):
+    scheduler = self._scheduler()
+    scheduler.record("prefill", used=768, capacity=1024, time_sec=0.5)
+    scheduler.record("decode", used=40, capacity=80, time_sec=0.5)
+    assert scheduler.stats["prefill"].utilization == 0.75
+    assert scheduler.stats["decode"].utilization == 0.5
+    assert scheduler.stats["decode"].iterations == 1
+
+
+class DynamicSchedulerInferenceTest(unittest.TestCase):
+
+  def test_slots_freed_after_max_decode_length_without_eos(self):
+    engine = _DummyEngine()
+    offline_inf = OfflineInference(engine, None, None, True, enable_dynamic_scheduler=True, max_decode_steps=5)
+    offline_inf.dummy = True
+    data = [_row(i, 10 + i, 64) for i in range(10)]
+    tokens = collections.defaultdict(list)
+
+    def emit(id_, token):
+      tokens[id_].append(token)
+      return False  # no prompt hits EOS
+
+    thread = threading.Thread(target=offline_inf.batch_inference_with_callback, args=(data, emit, emit, "test"), daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive(), "the dynamic scheduler waits on slots that are never freed"
+    max_decode_length = engine.config.max_target_length - engine.config.max_prefill_predict_length
+    # the first token of the prefill, then one per generate step
+    assert {id_: len(row_tokens) for id_, row_tokens in tokens.items()} == {row.id: 1 + max_decode_length for row in data}
+    assert offline_inf.scheduler_stats["prefill"].iterations > 1
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -16,8 +16,13 @@
 
 from MaxText import prefix_cache
 
+import concurrent.futures
+import os
 import pytest
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 import jax
 import jax.numpy as jnp
 
@@ -256,6 +261,89 @@ class PrefixCacheTrieTest(unittest.TestCase):
     assert trie.get_longest_common_prefix_key((4, 5, 6)) == (4, 5, 6)
 
 
+class PrefixCacheRadixTreeTest(unittest.TestCase):
+  """Test for PrefixCacheRadixTree."""
+
+  def test_match_return_matched_length_and_block_refs(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    assert tree.insert((1, 2, 3, 4, 5, 6), ["a", "b", "c"]) == 0
+    match = tree.match((1, 2, 3, 4, 5, 6))
+    assert match.matched_length == 6
+    assert match.block_refs == ["a", "b", "c"]
+
+  def test_partial_match_in_the_middle_of_stored_key(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4, 5, 6), ["a", "b", "c"])
+    match = tree.match((1, 2, 3, 4, 7, 8, 9))
+    assert match.matched_length == 4
+    assert match.block_refs == ["a", "b"]
+
+  def test_match_is_block_aligned(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4), ["a", "b"])
+    # (3, 5) differs in the second block, partial block matching is not returned.
+    match = tree.match((1, 2, 3, 5))
+    assert match.matched_length == 2
+    assert match.block_refs == ["a"]
+    # Trailing partial block is ignored.
+    assert tree.match((1, 2, 3)).matched_length == 2
+
+  def test_no_match(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4), ["a", "b"])
+    match = tree.match((2, 1, 3, 4))
+    assert match.matched_length == 0
+    assert not match.block_refs
+
+  def test_insert_ignore_trailing_partial_block(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3), ["a"])
+    assert tree.num_blocks == 1
+    assert tree.match((1, 2, 3)).matched_length == 2
+
+  def test_insert_wrong_number_of_block_refs_raise(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    with self.assertRaises(ValueError):
+      tree.insert((1, 2, 3, 4), ["a"])
+
+  def test_insert_shared_prefix_keep_stored_refs(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4, 5, 6), ["a", "b", "c"])
+    assert tree.insert((1, 2, 3, 4, 7, 8), ["x", "y", "z"]) == 2
+    assert tree.num_blocks == 4
+    assert tree.match((1, 2, 3, 4, 5, 6)).block_refs == ["a", "b", "c"]
+    assert tree.match((1, 2, 3, 4, 7, 8)).block_refs == ["a", "b", "z"]
+    assert tree.insert((1, 2), ["x"]) == 1
+    assert tree.num_blocks == 4
+
+  def test_erase_leaf_return_removed_refs_and_keep_shared_blocks(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4, 5, 6), ["a", "b", "c"])
+    tree.insert((1, 2, 7, 8), ["a", "d"])
+    assert tree.erase((1, 2, 3, 4, 5, 6)) == ["b", "c"]
+    assert tree.num_blocks == 2
+    assert tree.match((1, 2, 3, 4)).matched_length == 2
+    assert tree.match((1, 2, 7, 8)).block_refs == ["a", "d"]
+    assert tree.erase((1, 2, 7, 8)) == ["a", "d"]
+    assert tree.num_blocks == 0
+    assert tree.match((1, 2, 7, 8)).matched_length == 0
+
+  def test_erase_not_leaf_or_not_exist_will_not_effect(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4), ["a", "b"])
+    assert not tree.erase((1, 2))
+    assert not tree.erase((1, 2, 3, 4, 5, 6))
+    assert not tree.erase((5, 6))
+    assert tree.match((1, 2, 3, 4)).block_refs == ["a", "b"]
+
+  def test_insert_after_erase_to_empty(self):
+    tree = prefix_cache.PrefixCacheRadixTree(block_size=2)
+    tree.insert((1, 2, 3, 4), ["a", "b"])
+    tree.erase((1, 2, 3, 4))
+    assert tree.insert((1, 2, 5, 6), ["c", "d"]) == 0
+    assert tree.match((1, 2, 5, 6)).block_refs == ["c", "d"]
+
+
 class BasicStorageTest(unittest.TestCase):
 
   def test_is_enough_space_remain(self):
@@ -456,6 +544,21 @@ class DRAMStorageTest(unittest.TestCase):
     assert storage.has_enough_space(value.prefix_size_bytes) is True
     assert storage.add(key, value) is True
 
+  def test_add_copy_to_host_in_executor(self):
+    key = (1,)
+    value = create_default_value()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      storage = prefix_cache.DRAMStorage(max_size_bytes=value.prefix_size_bytes * 2, executor=executor)
+      assert storage.add(key, value) is True
+      assert storage.contains(key) is True
+      assert storage.has_enough_space(value.prefix_size_bytes) is True
+      assert storage.retrieve(key) == value
+      assert storage.add((2,), value) is True
+      storage.wait_pending_copies()
+      assert storage.retrieve((2,)) == value
+      assert storage.evict(key) == value
+      assert storage.retrieve(key) is None
+
   @pytest.mark.tpu_only
   def test_move_value_between_device_and_host(self):
     origin_hbm_byte = get_byte_in_use()
@@ -521,6 +624,117 @@ class DRAMStorageTest(unittest.TestCase):
     assert device_1_byte_after - device_1_byte_before == prefix_actually_used_byte
 
 
+class DiskStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._tmp_dir)
+
+  def test_basic_usage(self):
+    """Test basic usage of DiskStorage checking all functions work."""
+    key = (1,)
+    value = create_default_value()
+    storage = prefix_cache.DiskStorage(max_size_bytes=value.prefix_size_bytes, directory=self._tmp_dir)
+    assert storage.get_max_size_bytes() == value.prefix_size_bytes
+    assert storage.has_enough_space(value.prefix_size_bytes) is True
+    assert storage.contains(key) is False
+    assert storage.add(key, value) is True
+    assert storage.contains(key) is True
+    assert storage.keys() == [key]
+    assert storage.retrieve(key) == value
+    assert storage.has_enough_space(value.prefix_size_bytes) is False
+    assert storage.add((2,), value) is False
+    assert storage.evict(key) == value
+    assert storage.contains(key) is False
+    assert storage.retrieve(key) is None
+    assert storage.evict(key) is None
+    assert storage.has_enough_space(value.prefix_size_bytes) is True
+
+  def test_restore_values_from_directory(self):
+    prefix = {
+        "layer_0": {
+            "cached_prefill_key": jnp.arange(12, dtype=jnp.bfloat16).reshape(3, 4),
+            "cached_prefill_value": jnp.arange(3, dtype=jnp.int8),
+        },
+        "layer_1": [jnp.ones((2, 2), dtype=jnp.float32)],
+    }
+    value = create_default_value(prefix=prefix, true_length=3, padded_length=4, tokens=(1, 2, 3, 0))
+    storage = prefix_cache.DiskStorage(max_size_bytes=1024, directory=self._tmp_dir)
+    assert storage.add((1, 2, 3), value) is True
+    storage.flush()
+    del storage
+
+    restored_storage = prefix_cache.DiskStorage(max_size_bytes=1024, directory=self._tmp_dir)
+    assert restored_storage.keys() == [(1, 2, 3)]
+    assert not restored_storage.has_enough_space(1024)
+    restored_value = restored_storage.retrieve((1, 2, 3))
+    assert restored_value is not None
+    assert restored_value.true_length == 3
+    assert restored_value.padded_length == 4
+    assert restored_value.prefix_size_bytes == value.prefix_size_bytes
+    assert restored_value.prefix["layer_0"]["cached_prefill_key"].dtype == jnp.bfloat16
+    assert jax.tree.all(jax.tree.map(jnp.array_equal, restored_value.prefix, prefix))
+
+  def test_restored_values_keep_size_for_eviction(self):
+    small_value = create_default_value(prefix={"decoder": jnp.array([1])})
+    large_value = create_default_value(prefix={"decoder": jnp.array([1, 2, 3])})
+    max_bytes = small_value.prefix_size_bytes + large_value.prefix_size_bytes
+    storage = prefix_cache.DiskStorage(max_size_bytes=max_bytes, directory=self._tmp_dir)
+    assert storage.add((1,), small_value) is True
+    assert storage.add((2,), large_value) is True
+    storage.flush()
+    del storage
+
+    restored_storage = prefix_cache.DiskStorage(max_size_bytes=max_bytes, directory=self._tmp_dir)
+    assert restored_storage.get_size_bytes((2,)) == large_value.prefix_size_bytes
+    cache = prefix_cache.HierarchicalCache(layers=(restored_storage,), strategy_factory=prefix_cache.GDSFStrategy)
+    ok, evicted = cache.add((3,), small_value)
+    assert ok
+    assert list(evicted.keys()) == [(2,)]
+
+  def test_write_in_executor(self):
+    value = create_default_value()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      storage = prefix_cache.DiskStorage(
+          max_size_bytes=value.prefix_size_bytes * 2, directory=self._tmp_dir, executor=executor
+      )
+      assert storage.add((1,), value) is True
+      assert storage.retrieve((1,)) == value
+      assert storage.add((2,), value) is True
+      assert storage.evict((2,)) == value
+      storage.flush()
+    assert prefix_cache.DiskStorage(max_size_bytes=1024, directory=self._tmp_dir).keys() == [(1,)]
+
+  def test_index_written_on_flush(self):
+    value = create_default_value()
+    index_path = os.path.join(self._tmp_dir, prefix_cache.DiskStorage.INDEX_FILE_NAME)
+    storage = prefix_cache.DiskStorage(max_size_bytes=value.prefix_size_bytes * 2, directory=self._tmp_dir)
+    assert storage.add((1,), value) is True
+    assert storage.add((2,), value) is True
+    assert not os.path.exists(index_path)
+    with mock.patch.object(storage, "_save_index", wraps=storage._save_index) as save_index:  # pylint: disable=protected-access
+      storage.flush()
+      storage.flush()
+      assert save_index.call_count == 1
+      assert storage.evict((2,)) == value
+      storage.flush()
+      assert save_index.call_count == 2
+    assert prefix_cache.DiskStorage(max_size_bytes=1024, directory=self._tmp_dir).keys() == [(1,)]
+
+  def test_clear_delete_values(self):
+    value = create_default_value()
+    storage = prefix_cache.DiskStorage(max_size_bytes=1024, directory=self._tmp_dir)
+    assert storage.add((1,), value) is True
+    storage.flush()
+    with mock.patch.object(storage, "_read_host_value") as read_host_value:
+      storage.clear()
+      read_host_value.assert_not_called()
+    assert not storage.keys()
+    assert storage.has_enough_space(1024)
+    assert not os.listdir(self._tmp_dir)
+
+
 class LRUStrategyTest(unittest.TestCase):
 
   def test_evict_none_if_no_use(self):
@@ -547,6 +761,92 @@ class LRUStrategyTest(unittest.TestCase):
     assert strategy.evict() is None
 
 
+class LFUStrategyTest(unittest.TestCase):
+
+  def test_evict_least_frequently_used(self):
+    strategy = prefix_cache.LFUStrategy()
+    strategy.use((1,))
+    strategy.use((1,))
+    strategy.use((2,))
+    strategy.use((3,))
+    strategy.use((3,))
+    assert strategy.evict() == (2,)
+    assert strategy.evict() == (1,)
+    assert strategy.evict() == (3,)
+    assert strategy.evict() is None
+
+  def test_frequency_reset_after_evict(self):
+    strategy = prefix_cache.LFUStrategy()
+    strategy.use((1,))
+    strategy.use((1,))
+    assert strategy.evict() == (1,)
+    strategy.use((1,))
+    strategy.use((2,))
+    strategy.use((2,))
+    assert strategy.evict() == (1,)
+
+
+class GDSFStrategyTest(unittest.TestCase):
+
+  def test_evict_large_value_before_small_values_of_same_frequency(self):
+    strategy = prefix_cache.GDSFStrategy()
+    strategy.use((1,), size_bytes=100)
+    strategy.use((2,), size_bytes=10_000)
+    strategy.use((3,), size_bytes=100)
+    assert strategy.evict() == (2,)
+
+  def test_frequent_large_value_stay(self):
+    strategy = prefix_cache.GDSFStrategy()
+    strategy.use((1,), size_bytes=100)
+    for _ in range(1000):
+      strategy.use((2,), size_bytes=10_000)
+    assert strategy.evict() == (1,)
+
+  def test_aging_evict_old_values(self):
+    strategy = prefix_cache.GDSFStrategy()
+    for _ in range(3):
+      strategy.use((1,), size_bytes=100)
+    strategy.use((2,), size_bytes=100)
+    assert strategy.evict() == (2,)
+    # The clock is raised by the evicted value, new values catch up with old values.
+    strategy.use((3,), size_bytes=100)
+    strategy.use((3,), size_bytes=100)
+    assert strategy.evict() == (1,)
+
+
+class TTLStrategyTest(unittest.TestCase):
+
+  def test_pop_keys_not_used_within_ttl(self):
+    now = [0.0]
+    strategy = prefix_cache.TTLStrategy(ttl_seconds=10, clock=lambda: now[0])
+    strategy.use((1,))
+    now[0] = 5
+    strategy.use((2,))
+    assert not strategy.pop_expired()
+    now[0] = 12
+    assert strategy.pop_expired() == [(1,)]
+    strategy.use((2,))
+    now[0] = 20
+    assert not strategy.pop_expired()
+    assert strategy.evict() == (2,)
+    assert strategy.evict() is None
+
+
+class CreateEvictionStrategyTest(unittest.TestCase):
+
+  def test_create_by_policy(self):
+    assert isinstance(prefix_cache.create_eviction_strategy("lru"), prefix_cache.LRUStrategy)
+    assert isinstance(prefix_cache.create_eviction_strategy("lfu"), prefix_cache.LFUStrategy)
+    assert isinstance(prefix_cache.create_eviction_strategy("gdsf"), prefix_cache.GDSFStrategy)
+    assert isinstance(prefix_cache.create_eviction_strategy("ttl", ttl_seconds=1), prefix_cache.TTLStrategy)
+
+  def test_invalid_policy_raise(self):
+    with self.assertRaises(ValueError):
+      prefix_cache.create_eviction_strategy("fifo")
+    with self.assertRaises(ValueError):
+      prefix_cache.create_eviction_strategy("ttl")
+
+
 class HierarchicalCacheTest(unittest.TestCase):
 
   def test_add_to_all_layers(self):
@@ -693,6 +993,79 @@ class HierarchicalCacheTest(unittest.TestCase):
     # The device in the Value remain the original before saved
     assert retrieved_value.device == local_devices[0]
 
+  def test_prefetch_copy_to_upper_layers(self):
+    value = create_default_value()
+    size = value.prefix_size_bytes
+    cache = prefix_cache.HierarchicalCache(
+        layers=(prefix_cache.HBMStorage(size), prefix_cache.DRAMStorage(size * 2)),
+    )
+    assert cache.add((1,), value)[0]
+    assert cache.add((2,), value)[0]
+    assert cache.prefetch((1,)) is True
+    assert cache.retrieve((1,)) == value
+    # The prefetch is counted as a DRAM hit, the retrieve after it is not counted again.
+    hbm_stats, dram_stats = cache.get_stats()
+    assert (hbm_stats.hits, hbm_stats.misses) == (0, 1)
+    assert dram_stats.hits == 1
+    assert cache.retrieve((1,)) == value
+    assert cache.get_stats()[0].hits == 1
+    assert cache.prefetch((3,)) is False
+
+  def test_stats_count_hits_misses_and_bytes_per_layer(self):
+    value = create_default_value()
+    size = value.prefix_size_bytes
+    cache = prefix_cache.HierarchicalCache(
+        layers=(prefix_cache.HBMStorage(size), prefix_cache.DRAMStorage(size * 2)),
+    )
+    assert cache.add((1,), value)[0]
+    assert cache.add((2,), value)[0]
+    # (1,) is only in DRAM
+    assert cache.retrieve((1,)) is not None
+    assert cache.retrieve((1,)) is not None
+    hbm_stats, dram_stats = cache.get_stats()
+    assert (hbm_stats.hits, hbm_stats.misses) == (1, 1)
+    assert (hbm_stats.hit_bytes, hbm_stats.miss_bytes) == (size, size)
+    assert hbm_stats.hit_ratio == 0.5
+    assert hbm_stats.byte_hit_ratio == 0.5
+    assert hbm_stats.evictions == 2
+    assert (dram_stats.hits, dram_stats.misses, dram_stats.evictions) == (1, 0, 0)
+
+  def test_add_return_keys_expired_from_all_layers(self):
+    value = create_default_value()
+    size = value.prefix_size_bytes
+    now = [0.0]
+    cache = prefix_cache.HierarchicalCache(
+        layers=(prefix_cache.HBMStorage(size * 2), prefix_cache.DRAMStorage(size * 3)),
+        strategy_factory=lambda: prefix_cache.TTLStrategy(ttl_seconds=10, clock=lambda: now[0]),
+    )
+    for key in [(1,), (2,), (3,)]:
+      assert cache.add(key, value)[0]
+      now[0] += 1
+    # Only the HBM usage of (1,) is updated by prefetch.
+    now[0] = 5
+    assert cache.prefetch((1,)) is True
+    now[0] = 12.5
+    ok, evicted = cache.add((4,), value)
+    assert ok
+    # (1,) expired from DRAM but is still in HBM.
+    assert set(evicted.keys()) == {(2,), (3,)}
+    assert cache.retrieve((1,)) == value
+
+  def test_strategy_factory_apply_to_all_layers(self):
+    small_value = create_default_value(prefix=jnp.array([1]))
+    large_value = create_default_value(prefix=jnp.array([1, 2, 3]))
+    max_bytes = small_value.prefix_size_bytes * 4
+    cache = prefix_cache.HierarchicalCache(
+        layers=(prefix_cache.HBMStorage(max_bytes), prefix_cache.DRAMStorage(max_bytes)),
+        strategy_factory=prefix_cache.GDSFStrategy,
+    )
+    assert cache.add((1,), large_value)[0]
+    assert cache.add((2,), small_value)[0]
+    ok, evicted = cache.add((3,), small_value)
+    assert ok
+    # The large value is evicted even if it is not the least recently used one.
+    assert list(evicted.keys()) == [(1,)]
+
 
 class PrefixCacheTest(unittest.TestCase):
 
@@ -913,6 +1286,127 @@ class PrefixCacheTest(unittest.TestCase):
     assert loaded_value.prefix.device == local_devices[1]
     assert loaded_value.device == local_devices[0]
 
+  def test_evict_cache_with_LFU_policy(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes * 2
+    prefix_cache_inst = prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes, eviction_policy="lfu")
+    assert prefix_cache_inst.save((1,), value) is True
+    assert prefix_cache_inst.save((2,), value) is True
+    assert prefix_cache_inst.load((1,)) == value
+    assert prefix_cache_inst.load((2,)) == value
+    assert prefix_cache_inst.load((2,)) == value
+    assert prefix_cache_inst.save((3,), value) is True
+    assert prefix_cache_inst.fetch_longest_common_prefix_key((1,)) is None
+    assert prefix_cache_inst.fetch_longest_common_prefix_key((2,)) == (2,)
+
+  def test_get_stats(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes
+    prefix_cache_inst = prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes)
+    assert prefix_cache_inst.save((1,), value) is True
+    assert prefix_cache_inst.load((1,)) == value
+    stats = prefix_cache_inst.get_stats()
+    assert stats["hbm"].hits == 1
+    assert stats["dram"].hits == 0
+    prefix_cache_inst.clear()
+    assert prefix_cache_inst.get_stats()["hbm"].hits == 0
+
+  def test_fetch_prefetch_matched_key_to_hbm(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes
+    prefix_cache_inst = prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes * 2)
+    assert prefix_cache_inst.save((1,), value) is True
+    assert prefix_cache_inst.save((2,), value) is True
+    # (1,) is only in DRAM and copied to HBM while fetched.
+    assert prefix_cache_inst.fetch_longest_common_prefix_key((1, 2)) == (1,)
+    assert prefix_cache_inst.load((1,)) == value
+    stats = prefix_cache_inst.get_stats()
+    assert (stats["hbm"].hits, stats["hbm"].misses) == (0, 1)
+    assert stats["dram"].hits == 1
+    prefix_cache_inst.close()
+
+  def test_close_wait_background_copies(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes
+    with prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes * 2) as prefix_cache_inst:
+      assert prefix_cache_inst.save((1,), value) is True
+      assert prefix_cache_inst.save((2,), value) is True
+    # Values are still loaded after close, (1,) from DRAM.
+    assert prefix_cache_inst.load((1,)) == value
+    assert prefix_cache_inst.get_stats()["dram"].hits == 1
+
+  def test_without_async_transfer_load_from_dram(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes
+    prefix_cache_inst = prefix_cache.PrefixCache(hbm_bytes=max_bytes, dram_bytes=max_bytes * 2, async_transfer=False)
+    assert prefix_cache_inst.save((1,), value) is True
+    assert prefix_cache_inst.save((2,), value) is True
+    assert prefix_cache_inst.fetch_longest_common_prefix_key((1, 2)) == (1,)
+    assert prefix_cache_inst.load((1,)) == value
+    assert prefix_cache_inst.get_stats()["dram"].hits == 1
+
+  def test_restore_cache_from_disk_after_restart(self):
+    value = create_default_value()
+    max_bytes = value.prefix_size_bytes
+    with tempfile.TemporaryDirectory() as disk_dir:
+      prefix_cache_inst = prefix_cache.PrefixCache(
+          hbm_bytes=max_bytes, dram_bytes=max_bytes, disk_bytes=max_bytes * 2, disk_dir=disk_dir
+      )
+      assert prefix_cache_inst.save((1, 2), value) is True
+      assert prefix_cache_inst.save((3, 4), value) is True
+      # (1, 2) is only on disk
+      assert prefix_cache_inst.load((1, 2)) == value
+      assert prefix_cache_inst.get_stats()["disk"].hits == 1
+      prefix_cache_inst.close()
+
+      restarted_cache_inst = prefix_cache.PrefixCache(
+          hbm_bytes=max_bytes, dram_bytes=max_bytes, disk_bytes=max_bytes * 2, disk_dir=disk_dir
+      )
+      assert restarted_cache_inst.fetch_longest_common_prefix_key((1, 2, 3)) == (1, 2)
+      assert restarted_cache_inst.load((1, 2)) == value
+      assert restarted_cache_inst.fetch_longest_common_prefix_key((3, 4, 5)) == (3, 4)
+      restarted_cache_inst.clear()
+      assert restarted_cache_inst.fetch_longest_common_prefix_key((1, 2, 3)) is None
+
+  def test_invalid_eviction_policy_raise(self):
+    with self.assertRaises(ValueError):
+      prefix_cache.PrefixCache(hbm_bytes=1, dram_bytes=1, eviction_policy="fifo")
+
+
+class PagedPrefixCacheTest(unittest.TestCase):
+
+  def test_save_return_pages_to_retain_and_lookup_shared_pages(self):
+    cache = prefix_cache.PagedPrefixCache(tokens_per_page=2, max_pages=8)
+    retained, released = cache.save((1, 2, 3, 4, 5), [10, 11, 12])
+    # Trailing partial page is not cached.
+    assert retained == [10, 11]
+    assert not released
+    match = cache.lookup((1, 2, 3, 4, 6, 7))
+    assert match.matched_length == 4
+    assert match.block_refs == [10, 11]
+
+  def test_save_shared_prefix_only_retain_new_pages(self):
+    cache = prefix_cache.PagedPrefixCache(tokens_per_page=2, max_pages=8)
+    cache.save((1, 2, 3, 4), [10, 11])
+    retained, _ = cache.save((1, 2, 5, 6), [10, 20])
+    assert retained == [20]
+    assert cache.num_pages == 3
+
+  def test_evict_lru_key_release_unshared_pages(self):
+    cache = prefix_cache.PagedPrefixCache(tokens_per_page=2, max_pages=3)
+    cache.save((1, 2, 3, 4), [10, 11])
+    cache.save((1, 2, 5, 6), [10, 20])
+    retained, released = cache.save((7, 8), [30])
+    assert retained == [30]
+    assert released == [11]
+    assert cache.num_pages == 3
+    assert cache.lookup((1, 2, 3, 4)).block_refs == [10]
+
+  def test_save_too_long_key_is_ignored(self):
+    cache = prefix_cache.PagedPrefixCache(tokens_per_page=2, max_pages=1)
+    assert cache.save((1, 2, 3, 4), [10, 11]) == ([], [])
+    assert cache.num_pages == 0
+
 
 if __name__ == "__main__":
   unittest.main()
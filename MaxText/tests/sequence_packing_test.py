@@ -0,0 +1,100 @@
+"""
+Copyright 2023 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for best-fit sequence packing
+"""
+
+import unittest
+
+import grain.python as grain
+import numpy as np
+import tensorflow as tf
+
+from MaxText import sequence_packing
+from MaxText.input_pipeline import _input_pipeline_utils
+
+
+def _examples(lengths):
+  return [{"inputs": np.arange(1, n + 1), "targets": np.arange(1, n + 1)} for n in lengths]
+
+
+class BestFitPackerTest(unittest.TestCase):
+
+  def test_pack(self):
+    packer = sequence_packing.BestFitPacker({"inputs": 6}, window_size=3)
+    rows = packer.pack([{"inputs": np.array([1, 2])}, {"inputs": np.array([3, 4, 5, 6])}, {"inputs": np.array([7, 8, 9])}])
+    self.assertEqual(len(rows), 2)
+    np.testing.assert_array_equal(rows[0]["inputs"], [3, 4, 5, 6, 1, 2])
+    np.testing.assert_array_equal(rows[0]["inputs_segmentation"], [1, 1, 1, 1, 2, 2])
+    np.testing.assert_array_equal(rows[0]["inputs_position"], [0, 1, 2, 3, 0, 1])
+    np.testing.assert_array_equal(rows[1]["inputs"], [7, 8, 9, 0, 0, 0])
+    np.testing.assert_array_equal(rows[1]["inputs_segmentation"], [1, 1, 1, 0, 0, 0])
+
+  def test_pack_keeps_all_tokens(self):
+    lengths = [3, 9, 5, 2, 1, 7, 4, 8, 6, 2]
+    packer = sequence_packing.BestFitPacker({"inputs": 8, "targets": 8}, window_size=4, pad_id=-1)
+    rows = list(packer.pack_iterator(_examples(lengths)))
+    num_tokens = sum(int(np.sum(row["inputs_segmentation"] != 0)) for row in rows)
+    self.assertEqual(num_tokens, sum(min(n, 8) for n in lengths))
+    for row in rows:
+      np.testing.assert_array_equal(row["inputs"] == -1, row["inputs_segmentation"] == 0)
+      np.testing.assert_array_equal(row["inputs"], row["targets"])
+
+  def test_fewer_rows_than_greedy(self):
+    lengths = [5, 4, 5, 4, 3, 3]
+    packer = sequence_packing.BestFitPacker({"inputs": 8, "targets": 8}, window_size=len(lengths))
+    # Greedy concatenation needs 5 rows: [5], [4], [5], [4, 3], [3], best fit 3: [5, 3], [5, 3], [4, 4].
+    self.assertEqual(len(packer.pack(_examples(lengths))), 3)
+
+  def test_pack_dataset_best_fit(self):
+    lengths = [3, 9, 5, 2, 1, 7, 4]
+    dataset = tf.data.Dataset.from_generator(
+        lambda: iter(_examples(lengths)),
+        output_signature={k: tf.TensorSpec([None], tf.int64) for k in ("inputs", "targets")},
+    )
+    packed = list(sequence_packing.pack_dataset_best_fit(dataset, 8, 0, window_size=4).as_numpy_iterator())
+    expected = list(sequence_packing.BestFitPacker({"inputs": 8, "targets": 8}, 4).pack_iterator(_examples(lengths)))
+    self.assertEqual(len(packed), len(expected))
+    for row, expected_row in zip(packed, expected):
+      self.assertEqual(set(row.keys()), set(expected_row.keys()))
+      for k, v in expected_row.items():
+        np.testing.assert_array_equal(row[k], v)
+
+
+class BestFitPackIterDatasetTest(unittest.TestCase):
+
+  def test_restore_state(self):
+    lengths = [3, 9, 5, 2, 1, 7, 4, 8, 6, 2, 5, 1]
+    packer = sequence_packing.BestFitPacker({"inputs": 8, "targets": 8}, window_size=5)
+    dataset = _input_pipeline_utils.BestFitPackIterDataset(
+        grain.MapDataset.source(_examples(lengths)).to_iter_dataset(), packer
+    )
+    expected = [row["inputs"] for row in dataset]
+
+    iterator = iter(dataset)
+    for _ in range(3):
+      next(iterator)
+    state = iterator.get_state()
+    restored = iter(dataset)
+    restored.set_state(state)
+    rows = [row["inputs"] for row in restored]
+    self.assertEqual(len(rows), len(expected) - 3)
+    for row, expected_row in zip(rows, expected[3:]):
+      np.testing.assert_array_equal(row, expected_row)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -18,7 +18,9 @@ limitations under the License.
 """
 
 import numpy as np
+from MaxText import tokenizer
 from MaxText import train_tokenizer
+from MaxText.input_pipeline import _grain_tokenizer
 from MaxText.input_pipeline import _input_pipeline_utils
 from MaxText.globals import PKG_DIR
 
@@ -133,5 +135,69 @@ class HFTokenizerTest(unittest.TestCase):
     self.assertTrue(np.array_equal(self.hf_tokenizer.encode(text), self.sp_tokenizer.encode(text)))
 
 
+class GrainTokenizeAndTrimTest(unittest.TestCase):
+  """Tests for _grain_tokenizer.TokenizeAndTrim"""
+
+  def setUp(self):
+    super().setUp()
+    self.tokenizer = tokenizer.SentencePieceTokenizerGrain(
+        os.path.join(os.path.dirname(PKG_DIR), "assets", "tokenizer"), add_bos=False, add_eos=False
+    )
+    self.num_encodes = 0
+    encode_batch = self.tokenizer.encode_batch
+
+    def _counting_encode_batch(texts):
+      self.num_encodes += len(texts)
+      return encode_batch(texts)
+
+    self.tokenizer.encode_batch = _counting_encode_batch
+
+  def test_aliased_features_are_encoded_once(self):
+    text = "This is a test of tokenizing once"
+    features = {"inputs": text, "targets": text}
+    features = _grain_tokenizer.TokenizeAndTrim(("inputs", "targets"), (3, 5), False, False, self.tokenizer).map(features)
+    self.assertEqual(self.num_encodes, 1)
+    expected = np.asarray(self.tokenizer.encode(text), dtype=np.int32)
+    self.assertTrue(np.array_equal(features["inputs"], expected[:3]))
+    self.assertTrue(np.array_equal(features["targets"], expected[:5]))
+
+  def test_distinct_features_are_encoded_separately(self):
+    features = {"inputs": "a question", "targets": "an answer"}
+    _grain_tokenizer.TokenizeAndTrim(("inputs", "targets"), 8, False, False, self.tokenizer).map(features)
+    self.assertEqual(self.num_encodes, 2)
+
+  def test_encode_prefix_matches_full_encode(self):
+    text = " ".join(f"word{i}" for i in range(1000))
+    expected = self.tokenizer.encode(text)[:20]
+    self.assertEqual(tokenizer.encode_prefix(self.tokenizer, text, 20, chars_per_token=1), expected)
+    self.assertLess(len(expected), len(self.tokenizer.encode(text)))
+
+  def test_encode_batch_matches_encode(self):
+    texts = ["This is a test", "", "This is a test", "Another test"]
+    self.assertEqual(self.tokenizer.encode_batch(texts), [self.tokenizer.encode(text) for text in texts])
+
+  def test_encode_cache(self):
+    sp_tokenizer = tokenizer.SentencePieceTokenizerGrain(
+        os.path.join(os.path.dirname(PKG_DIR), "assets", "tokenizer"), add_bos=True, add_eos=False, encode_cache_size=2
+    )
+    texts = ["few-shot prefix", "question 1", "few-shot prefix"]
+    self.assertEqual(sp_tokenizer.encode_batch(texts), [sp_tokenizer.encode(text) for text in texts])
+    sp_tokenizer.encode_batch(texts)
+    self.assertEqual(sp_tokenizer._encode_cache.hits, 3)  # pylint: disable=protected-access
+    self.assertEqual(len(sp_tokenizer._encode_cache), 2)  # pylint: disable=protected-access
+
+  def test_chunk_windows(self):
+    text = " ".join(f"word{i}" for i in range(100))
+    expected = np.asarray(self.tokenizer.encode(text), dtype=np.int32)
+    chunk_op = _grain_tokenizer.TokenizeAndChunk(("inputs", "targets"), 64, False, False, self.tokenizer, chunk_overlap=8)
+    chunks = chunk_op.flat_map({"inputs": text, "targets": text})
+    self.assertEqual(self.num_encodes, 1)
+    self.assertEqual(len(chunks), int(np.ceil((len(expected) - 8) / 56)))
+    for i, chunk in enumerate(chunks):
+      self.assertTrue(np.array_equal(chunk["inputs"], expected[i * 56 : i * 56 + 64]))
+      self.assertTrue(np.array_equal(chunk["targets"], chunk["inputs"]))
+    self.assertEqual(chunks[-1]["inputs"][-1], expected[-1])
+
+
 if __name__ == "__main__":
   unittest.main()
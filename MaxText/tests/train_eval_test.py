@@ -0,0 +1,81 @@
+"""
+Copyright 2025 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""Tests for the eval loop of train.py"""
+import types
+import unittest
+
+import jax
+import jax.numpy as jnp
+from jax.experimental import mesh_utils
+from jax.sharding import Mesh
+import numpy as np
+
+from MaxText import train
+
+
+class _RecordingMetricLogger:
+
+  def __init__(self):
+    self.written = []
+
+  def write_metrics(self, metrics, step, is_training=True):
+    self.written.append((metrics, step, is_training))
+
+
+def _eval_step(state, batch, rng):  # pylint: disable=unused-argument
+  return {
+      "scalar": {
+          "evaluation/loss": batch.mean(),
+          "evaluation/total_loss": batch.sum(),
+          "evaluation/total_weights": jnp.array(batch.size, jnp.float32),
+          "evaluation/moe_lb_loss": jnp.array(0.5),
+      }
+  }
+
+
+class RunEvalTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.mesh = Mesh(mesh_utils.create_device_mesh((len(jax.devices()),)), ("data",))
+    self.batches = [jnp.full((2, 4), float(i)) for i in range(4)]
+
+  def _make_config(self, eval_steps=-1, async_eval=False):
+    return types.SimpleNamespace(eval_steps=eval_steps, logical_axis_rules=[], use_dpo=False, async_eval=async_eval)
+
+  def test_eval_metrics_are_summed_over_eval_steps(self):
+    config = self._make_config(eval_steps=3)
+    metrics, eval_step_count = train.run_eval(config, self.mesh, _eval_step, None, self.batches, None)
+    metrics = jax.device_get(metrics)
+    self.assertEqual(eval_step_count, 3)
+    np.testing.assert_allclose(metrics["scalar"]["eval/total_loss"], 8 * (0 + 1 + 2))
+    np.testing.assert_allclose(metrics["scalar"]["eval/total_weights"], 24)
+    np.testing.assert_allclose(metrics["scalar"]["eval/avg_loss"], 1.0, rtol=1e-6)
+    np.testing.assert_allclose(metrics["scalar"]["eval/avg_moe_lb_loss"], 0.5)
+
+  def test_async_eval_does_not_return_eval_loss(self):
+    metrics, eval_step_count = train.run_eval(self._make_config(), self.mesh, _eval_step, None, self.batches, None)
+    metric_logger = _RecordingMetricLogger()
+    async_config = self._make_config(async_eval=True)
+    self.assertIsNone(train.write_eval_metrics(async_config, metric_logger, metrics, eval_step_count, 7))
+    eval_loss = train.write_eval_metrics(self._make_config(), metric_logger, metrics, eval_step_count, 7)
+    self.assertAlmostEqual(eval_loss, 1.5, places=5)
+    self.assertEqual([(step, is_training) for _, step, is_training in metric_logger.written], [(7, False), (7, False)])
+
+
+if __name__ == "__main__":
+  unittest.main()
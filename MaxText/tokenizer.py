@@ -18,8 +18,10 @@ limitations under the License.
 
 from typing import Dict, Iterable, Union, Literal, Sequence, Collection, List
 from pathlib import Path
+import re
 import tensorflow as tf
 import tensorflow_text as tftxt
+from MaxText import encode_cache
 from MaxText import max_logging
 import transformers
 import tiktoken
@@ -29,6 +31,25 @@ from sentencepiece import SentencePieceProcessor
 
 Features = Dict[str, tf.Tensor]
 
+# Characters per token assumed by encode_prefix for the first prefix it encodes.
+ENCODE_PREFIX_CHARS_PER_TOKEN = 8
+
+
+def _make_encode_cache(encode_cache_size: int) -> encode_cache.EncodeCache | None:
+  return encode_cache.EncodeCache(encode_cache_size) if encode_cache_size > 0 else None
+
+
+def _encode_batch_with_cache(cache, texts: Sequence[str], encode_batch_fn, key_suffix: tuple = ()) -> List[List[int]]:
+  """Encodes texts with encode_batch_fn, looking up and filling cache if it is not None."""
+  if cache is None:
+    return [list(token_ids) for token_ids in encode_batch_fn(texts)]
+
+  def _encode_batch_to_tuples(missing_texts):
+    return [tuple(token_ids) for token_ids in encode_batch_fn(missing_texts)]
+
+  keys = [(s,) + key_suffix for s in texts]
+  return [list(token_ids) for token_ids in cache.encode_batch(keys, texts, _encode_batch_to_tuples)]
+
 
 class TikTokenTokenizer:
   """
@@ -41,12 +62,22 @@ class TikTokenTokenizer:
 
   pat_str = r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"  # pylint: disable=line-too-long
 
-  def __init__(self, model_path: str, add_bos: bool, add_eos: bool):
+  # The tiktoken tokenizer can handle <=400k chars without
+  # pyo3_runtime.PanicException.
+  TIKTOKEN_MAX_ENCODE_CHARS = 400_000
+
+  # https://github.com/openai/tiktoken/issues/195
+  # Here we iterate over subsequences and split if we exceed the limit
+  # of max consecutive non-whitespace or whitespace characters.
+  MAX_NO_WHITESPACES_CHARS = 25_000
+
+  def __init__(self, model_path: str, add_bos: bool, add_eos: bool, encode_cache_size: int = 0):
     """
     Initializes the Tokenizer with a Tiktoken model.
 
     Args:
         model_path (str): The path to the Tiktoken model file.
+        encode_cache_size (int): Number of strings encode_batch keeps the tokens of, 0 to disable.
     """
 
     mergeable_ranks = load_tiktoken_bpe(model_path)
@@ -72,6 +103,7 @@ class TikTokenTokenizer:
     )
     self.eos = add_eos
     self.bos = add_bos
+    self._encode_cache = _make_encode_cache(encode_cache_size)
     max_logging.log(f"Reloaded tiktoken model from {model_path}")
 
     self.n_words: int = self.model.n_vocab
@@ -115,24 +147,8 @@ class TikTokenTokenizer:
     """
     assert isinstance(s, str)
 
-    # The tiktoken tokenizer can handle <=400k chars without
-    # pyo3_runtime.PanicException.
-    TIKTOKEN_MAX_ENCODE_CHARS = 400_000
-
-    # https://github.com/openai/tiktoken/issues/195
-    # Here we iterate over subsequences and split if we exceed the limit
-    # of max consecutive non-whitespace or whitespace characters.
-    MAX_NO_WHITESPACES_CHARS = 25_000
-
-    substrs = (
-        substr
-        for i in range(0, len(s), TIKTOKEN_MAX_ENCODE_CHARS)
-        for substr in self._split_whitespaces_or_nonwhitespaces(
-            s[i : i + TIKTOKEN_MAX_ENCODE_CHARS], MAX_NO_WHITESPACES_CHARS
-        )
-    )
     t: List[int] = []
-    for substr in substrs:
+    for substr in self._substrs(s):
       t.extend(
           self.model.encode(
               substr,
@@ -146,6 +162,50 @@ class TikTokenTokenizer:
       t.append(self.eos_id)
     return t
 
+  def encode_batch(
+      self,
+      texts: Sequence[str],
+      *,
+      allowed_special: Union[Literal["all"], Collection[str]] = (),
+      disallowed_special: Union[Literal["all"], Collection[str]] = (),
+      num_threads: int = 8,
+  ) -> List[List[int]]:
+    """
+    Encodes a batch of strings with the threaded tiktoken batch encoding. Returns the same tokens as encode.
+    """
+
+    def _encode_batch(texts):
+      substrs, text_idx = [], []
+      for i, s in enumerate(texts):
+        assert isinstance(s, str)
+        for substr in self._substrs(s):
+          substrs.append(substr)
+          text_idx.append(i)
+      encoded = self.model.encode_batch(
+          substrs,
+          num_threads=num_threads,
+          allowed_special=set(allowed_special),
+          disallowed_special=disallowed_special,
+      )
+      t: List[List[int]] = [[self.bos_id] if self.bos else [] for _ in texts]
+      for i, substr_tokens in zip(text_idx, encoded):
+        t[i].extend(substr_tokens)
+      if self.eos:
+        for token_ids in t:
+          token_ids.append(self.eos_id)
+      return t
+
+    key_suffix = tuple(
+        special if isinstance(special, str) else frozenset(special) for special in (allowed_special, disallowed_special)
+    )
+    return _encode_batch_with_cache(self._encode_cache, texts, _encode_batch, key_suffix)
+
+  def _substrs(self, s: str):
+    for i in range(0, len(s), self.TIKTOKEN_MAX_ENCODE_CHARS):
+      yield from self._split_whitespaces_or_nonwhitespaces(
+          s[i : i + self.TIKTOKEN_MAX_ENCODE_CHARS], self.MAX_NO_WHITESPACES_CHARS
+      )
+
   def decode(self, t) -> str:
     """
     Decodes a list of token IDs into a string.
@@ -164,23 +224,14 @@ class TikTokenTokenizer:
     """
     Splits the string `s` so that each substring contains no more than `max_consecutive_slice_len`
     consecutive whitespaces or consecutive non-whitespaces.
+    Only the runs longer than `max_consecutive_slice_len`, found with a regex, are split.
     """
-    current_slice_len = 0
-    current_slice_is_space = s[0].isspace() if len(s) > 0 else False
     slice_start = 0
-
-    for i, _ in enumerate(s):
-      is_now_space = s[i].isspace()
-
-      if current_slice_is_space ^ is_now_space:
-        current_slice_len = 1
-        current_slice_is_space = is_now_space
-      else:
-        current_slice_len += 1
-        if current_slice_len > max_consecutive_slice_len:
-          yield s[slice_start:i]
-          slice_start = i
-          current_slice_len = 1
+    long_runs = rf"\s{{{max_consecutive_slice_len + 1},}}|\S{{{max_consecutive_slice_len + 1},}}"
+    for run in re.finditer(long_runs, s):
+      for i in range(run.start() + max_consecutive_slice_len, run.end(), max_consecutive_slice_len):
+        yield s[slice_start:i]
+        slice_start = i
     yield s[slice_start:]
 
 
@@ -189,17 +240,23 @@ class SentencePieceTokenizer:
   Tokenizing and encoding/decoding text using the Sentencepiece tokenizer loaded with tensorflow_text
   """
 
-  def __init__(self, model_path: str, add_bos: bool, add_eos: bool):
+  def __init__(self, model_path: str, add_bos: bool, add_eos: bool, encode_cache_size: int = 0):
     max_logging.log(f"Tokenizer path: {model_path}")
     with tf.io.gfile.GFile(model_path, "rb") as model_fp:
       sp_model = model_fp.read()
     self.sp_tokenizer = tftxt.SentencepieceTokenizer(model=sp_model, add_bos=add_bos, add_eos=add_eos, reverse=False)
     self.pad_id = self.sp_tokenizer.string_to_id("<pad>")
     self.unk_id = self.sp_tokenizer.string_to_id("<unk>")
+    self._encode_cache = _make_encode_cache(encode_cache_size)
 
   def encode(self, s: str) -> List[int]:
     return self.sp_tokenizer.tokenize(s)
 
+  def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+    return _encode_batch_with_cache(
+        self._encode_cache, texts, lambda texts: self.sp_tokenizer.tokenize(list(texts)).to_list()
+    )
+
   def decode(self, t: Sequence[int]) -> str:
     return self.sp_tokenizer.detokenize(t)
 
@@ -209,7 +266,7 @@ class SentencePieceTokenizerGrain:
   Tokenizing and encoding/decoding text using the Sentencepiece tokenizer loaded with sentencepiece
   """
 
-  def __init__(self, model_path: str, add_bos: bool, add_eos: bool):
+  def __init__(self, model_path: str, add_bos: bool, add_eos: bool, encode_cache_size: int = 0):
     max_logging.log(f"Loading sentencepiece tokenizer: {model_path}")
     self._tokenizer_model = SentencePieceProcessor()
     self._tokenizer_model.Load(model_path)
@@ -219,6 +276,7 @@ class SentencePieceTokenizerGrain:
     self.eos_id = self._tokenizer_model.eos_id()
     self.add_bos = add_bos
     self.add_eos = add_eos
+    self._encode_cache = _make_encode_cache(encode_cache_size)
 
   def encode(self, s: str) -> List[int]:
     token_ids = self._tokenizer_model.EncodeAsIds(s)
@@ -228,6 +286,17 @@ class SentencePieceTokenizerGrain:
       token_ids += [self.eos_id]
     return token_ids
 
+  def encode_batch(self, texts: Sequence[str], num_threads: int = -1) -> List[List[int]]:
+    """Encodes a batch of strings with the multithreaded sentencepiece batch encoding."""
+
+    def _encode_batch(texts):
+      batch_token_ids = self._tokenizer_model.Encode(list(texts), out_type=int, num_threads=num_threads)
+      bos = [self.bos_id] if self.add_bos else []
+      eos = [self.eos_id] if self.add_eos else []
+      return [bos + token_ids + eos for token_ids in batch_token_ids]
+
+    return _encode_batch_with_cache(self._encode_cache, texts, _encode_batch)
+
   def decode(self, t: Sequence[int]) -> str:
     return self._tokenizer_model.DecodeIds(t)
 
@@ -237,7 +306,7 @@ class HFTokenizer:
   Tokenizing using huggingface tokenizer
   """
 
-  def __init__(self, model_path: str, add_bos: bool, add_eos: bool, hf_access_token: str):
+  def __init__(self, model_path: str, add_bos: bool, add_eos: bool, hf_access_token: str, encode_cache_size: int = 0):
     max_logging.log(f"Loading HF tokenizer: {model_path}")
     self.tokenizer = transformers.AutoTokenizer.from_pretrained(
         model_path,
@@ -249,44 +318,81 @@ class HFTokenizer:
     self.unk_id = self.tokenizer.unk_token_id
     self.bos_id = self.tokenizer.bos_token_id
     self.eos_id = self.tokenizer.eos_token_id
+    self._encode_cache = _make_encode_cache(encode_cache_size)
 
   def encode(self, s: str) -> List[int]:
     return self.tokenizer.encode(s)
 
+  def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+    """Encodes a batch of strings with the native, parallel batch encoding of fast tokenizers."""
+    return _encode_batch_with_cache(self._encode_cache, texts, lambda texts: self.tokenizer(list(texts))["input_ids"])
+
   def decode(self, t: Sequence[int]) -> str:
     return self.tokenizer.decode(t)
 
 
-def build_tokenizer(tokenizer_path, tokenizer_type, add_bos, add_eos, hf_access_token, dataset_type):
+def encode_prefix(tokenizer, s: str, num_tokens: int, chars_per_token: int = ENCODE_PREFIX_CHARS_PER_TOKEN) -> List[int]:
+  """Returns the first num_tokens tokens of s without encoding all of a long document.
+
+  Prefixes of s are cut at a space, so that their tokens match the tokens of s, and doubled in
+  length until they have more than num_tokens tokens.
+  """
+  num_chars = num_tokens * chars_per_token
+  while num_chars < len(s):
+    cut = s.rfind(" ", 0, num_chars)
+    if cut > 0:
+      token_ids = tokenizer.encode(s[:cut])
+      # The last token can be an eos_id added by the tokenizer.
+      if len(token_ids) > num_tokens + 1:
+        return token_ids[:num_tokens]
+    num_chars *= 2
+  return tokenizer.encode(s)[:num_tokens]
+
+
+def build_tokenizer(tokenizer_path, tokenizer_type, add_bos, add_eos, hf_access_token, dataset_type, encode_cache_size=0):
   """Loads the tokenizer at `tokenizer_path`"""
   max_logging.log(f"Tokenizer path: {tokenizer_path}")
   if tokenizer_type == "tiktoken":
     assert "tiktoken" in tokenizer_path, f"Invalid tokenizer type: {tokenizer_type} chosen for {tokenizer_path}"
-    return TikTokenTokenizer(tokenizer_path, add_bos, add_eos)
+    return TikTokenTokenizer(tokenizer_path, add_bos, add_eos, encode_cache_size)
   elif tokenizer_type == "huggingface":
-    return HFTokenizer(tokenizer_path, add_bos, add_eos, hf_access_token)
+    return HFTokenizer(tokenizer_path, add_bos, add_eos, hf_access_token, encode_cache_size)
   elif tokenizer_type == "sentencepiece":
     if dataset_type == "tfds":
-      return SentencePieceTokenizer(tokenizer_path, add_bos, add_eos)
+      return SentencePieceTokenizer(tokenizer_path, add_bos, add_eos, encode_cache_size)
     else:
-      return SentencePieceTokenizerGrain(tokenizer_path, add_bos, add_eos)
+      return SentencePieceTokenizerGrain(tokenizer_path, add_bos, add_eos, encode_cache_size)
   else:
     raise ValueError(f"Invalid tokenizer_type:{tokenizer_type} chosen in config")
 
 
-def TokenizeOp(tokenizer, features: Features, data_keys: Iterable[str] = ("inputs", "targets")) -> Features:
-  """Op for tokenization"""
+def TokenizeOp(
+    tokenizer, features: Features, data_keys: Iterable[str] = ("inputs", "targets"), max_length: int = 0
+) -> Features:
+  """Op for tokenization. Keys holding the same tensor, e.g. inputs and targets from normalize_features, are encoded once.
+
+  With max_length > 0, TikToken and HF tokenizers stop encoding after the first max_length tokens.
+  """
 
   def _process_string(string_tensor):
     # Extract string value and decode it if necessary
     string_value = string_tensor.numpy().decode("utf-8")
     # encode and extract the tokenized integers
-    modified_string = tokenizer.encode(string_value)
+    if max_length > 0:
+      modified_string = encode_prefix(tokenizer, string_value, max_length)
+    else:
+      modified_string = tokenizer.encode(string_value)
     return [modified_string]
 
+  encoded = {}
   for k in data_keys:
+    string_tensor = features[k]
+    if id(string_tensor) in encoded:
+      features[k] = encoded[id(string_tensor)][1]
+      continue
     if isinstance(tokenizer, (TikTokenTokenizer, HFTokenizer)):
-      features[k] = tf.py_function(_process_string, [features[k]], Tout=[tf.int32])[0]
+      features[k] = tf.py_function(_process_string, [string_tensor], Tout=[tf.int32])[0]
     elif isinstance(tokenizer, SentencePieceTokenizer):
-      features[k] = tokenizer.encode(features[k])
+      features[k] = tokenizer.encode(string_tensor)
+    encoded[id(string_tensor)] = (string_tensor, features[k])
   return features
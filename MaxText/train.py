@@ -20,6 +20,7 @@ limitations under the License.
 # Calling jax.device_count here prevents a "TPU platform already registered" error.
 # See github.com/google/maxtext/issues/20 for more
 
+import collections
 import datetime
 import os
 import sys
@@ -222,6 +223,36 @@ def record_activation_metrics(output_metrics, intermediate_outputs, config):
       output_metrics["scalar"][f"activ_stdev/layer_{layer_num:03d}"] = layer["activation_stdev"][0]
 
 
+MOE_ROUTING_METRICS = ("moe_expert_load", "moe_drop_rate", "moe_routing_entropy")
+
+
+def record_moe_metrics(output_metrics, intermediate_outputs, config):
+  """Adds the expert load, token drop rate and routing entropy sown by each MoE layer to the metrics dict"""
+  routing_metrics = collections.defaultdict(dict)
+  for path, value in jax.tree_util.tree_flatten_with_path(intermediate_outputs["intermediates"])[0]:
+    keys = [getattr(key, "key", None) for key in path]
+    name = next((key for key in keys if key in MOE_ROUTING_METRICS), None)
+    if name is not None:
+      # Named after the decoder scope holding the MoE block, e.g. "layers" when scanned or "layers_3" when not.
+      routing_metrics[keys[1]][name] = value
+
+  # The intermediates of the microbatches are summed with gradient accumulation.
+  scale = 1.0 / config.gradient_accumulation_steps
+  for scope, metrics in routing_metrics.items():
+    expert_load = jnp.reshape(metrics["moe_expert_load"], (-1, config.num_experts)) * scale
+    drop_rate = jnp.reshape(metrics["moe_drop_rate"], (-1,)) * scale
+    routing_entropy = jnp.reshape(metrics["moe_routing_entropy"], (-1,)) * scale
+    # Layers of a scanned scope are stacked along the leading axis.
+    is_scanned = metrics["moe_drop_rate"].ndim > 0
+    for layer_num in range(drop_rate.shape[0]):
+      layer = f"{scope}/{layer_num:03d}" if is_scanned else scope
+      output_metrics["scalar"][f"moe/drop_rate/{layer}"] = drop_rate[layer_num]
+      output_metrics["scalar"][f"moe/routing_entropy/{layer}"] = routing_entropy[layer_num]
+      # Load of the busiest expert over the mean load, 1.0 when the experts are balanced.
+      output_metrics["scalar"][f"moe/load_imbalance/{layer}"] = jnp.max(expert_load[layer_num]) * config.num_experts
+      output_metrics["histogram"][f"moe/expert_load/{layer}"] = expert_load[layer_num]
+
+
 def _split_dpo_state(state):
   reference_params = state.params["reference_params"]
   new_state = state.replace(params={k: v for k, v in state.params.items() if k != "reference_params"})
@@ -499,14 +530,22 @@ def train_step(model, config, state_mesh_shardings, state, data, dropout_rng):
     scalar_metrics["learning/param_norm"] = max_utils.l2norm_pytree(new_state.params)
   if config.use_dpo:
     scalar_metrics["learning/dpo_reward_accuracy"] = aux["reward_accuracy"]
+  else:
+    # Fraction of the batch holding tokens rather than padding, and segments packed in each row.
+    scalar_metrics["packing/efficiency"] = jnp.mean(data["targets_segmentation"] != 0)
+    scalar_metrics["packing/segments_per_row"] = jnp.mean(jnp.max(data["targets_segmentation"], axis=-1))
   metrics = {
       "scalar": scalar_metrics,
       "scalars": {},
+      "histogram": {},
   }
 
   if config.record_internal_nn_metrics:
     record_activation_metrics(metrics, intermediate_outputs, config)
 
+  if config.record_moe_metrics:
+    record_moe_metrics(metrics, intermediate_outputs, config)
+
   if config.use_dpo:
     new_state = _merge_dpo_state(new_state, reference_params)
 
@@ -541,6 +580,73 @@ def eval_step(model, config, state, data, dropout_rng):
   return metrics
 
 
+@functools.partial(jax.jit, donate_argnums=(0,))
+def accumulate_eval_metrics(eval_totals, eval_metrics):
+  """Adds the totals of an eval step to eval_totals on device, eval_totals is None for the first step."""
+  step_totals = {
+      name: eval_metrics["scalar"][f"evaluation/{name}"]
+      for name in ("total_loss", "total_weights", "moe_lb_loss", "dpo_reward_accuracy")
+      if f"evaluation/{name}" in eval_metrics["scalar"]
+  }
+  if eval_totals is None:
+    return step_totals
+  return jax.tree.map(jnp.add, eval_totals, step_totals)
+
+
+def run_eval(config, mesh, p_eval_step, state, eval_data_iterator, dropout_rng):
+  """Runs the eval steps and returns the eval metrics, still on device, and the number of eval steps.
+
+  The eval step totals are summed on device, so eval steps are dispatched back to back and nothing is
+  read on the host until the metrics are written.
+  """
+  eval_totals = None
+  eval_step_count = 0
+  # pylint: disable=not-callable
+  for eval_batch in eval_data_iterator:
+    if config.eval_steps > 0 and eval_step_count >= config.eval_steps:
+      break
+    with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
+      eval_metrics = p_eval_step(state, eval_batch, dropout_rng)
+      eval_totals = accumulate_eval_metrics(eval_totals, eval_metrics)
+    max_logging.log(f"Completed eval step {eval_step_count}")
+    eval_step_count += 1
+  if eval_totals is None:
+    raise ValueError("Eval data iterator did not return any batch.")
+
+  cumulative_eval_metrics = {
+      "scalar": {
+          "eval/total_loss": eval_totals["total_loss"],
+          "eval/total_weights": eval_totals["total_weights"],
+          "eval/avg_loss": eval_totals["total_loss"] / (eval_totals["total_weights"] + EPS),
+          "eval/moe_lb_loss": eval_totals["moe_lb_loss"],
+          "eval/avg_moe_lb_loss": eval_totals["moe_lb_loss"] / eval_step_count,
+      }
+  }
+  if config.use_dpo:
+    cumulative_eval_metrics["scalar"]["eval/dpo_reward_accuracy"] = eval_totals["dpo_reward_accuracy"] / eval_step_count
+  return cumulative_eval_metrics, eval_step_count
+
+
+def write_eval_metrics(config, metric_logger, cumulative_eval_metrics, eval_step_count, step):
+  """Writes the eval metrics and returns the eval loss.
+
+  With async_eval, the metrics are read on the host by the background metrics writer and training
+  goes on without waiting for eval, so None is returned.
+  """
+  if config.async_eval:
+    metric_logger.write_metrics(cumulative_eval_metrics, step, is_training=False)
+    max_logging.log(f"Dispatched {eval_step_count} eval steps after {step=}, eval metrics are written when ready.")
+    return None
+  cumulative_eval_metrics = jax.device_get(cumulative_eval_metrics)
+  eval_loss = float(cumulative_eval_metrics["scalar"]["eval/avg_loss"])
+  metric_logger.write_metrics(cumulative_eval_metrics, step, is_training=False)
+  max_logging.log(
+      f"average loss after {step=}: {eval_step_count=}, {eval_loss=},"
+      f" total_weights={cumulative_eval_metrics['scalar']['eval/total_weights']}"
+  )
+  return eval_loss
+
+
 def create_goodput_recorder(config):
   if config.enable_goodput_recording:
     logger_name = f"goodput_{config.run_name}"
@@ -817,8 +923,6 @@ def train_loop(config, state=None):
     else:
       p_eval_step = None
 
-  running_gcs_metrics = [] if config.gcs_metrics else None
-
   start_step = get_first_step(state)  # this is the start_step for training
   prof = profiler.Profiler(config, offset_step=start_step)
   first_profiling_step = prof.start_initial_profile_step
@@ -862,6 +966,8 @@ def train_loop(config, state=None):
     step_time_delta = datetime.datetime.now() - last_step_completion
     last_step_completion = datetime.datetime.now()
     record_scalar_metrics(metrics, step_time_delta, per_device_tflops, learning_rate_schedule(step), per_device_tokens)
+    if hasattr(data_iterator, "get_prefetch_metrics"):
+      metrics["scalar"].update(data_iterator.get_prefetch_metrics())
     if performance_metric_queue:
       performance_metric_queue.put(step_time_delta.total_seconds())
 
@@ -873,9 +979,10 @@ def train_loop(config, state=None):
       # Upon preemption, exit when and only when all ongoing saves are complete.
       if checkpoint_manager.reached_preemption(step):
         checkpoint_manager.wait_until_finished()
+        metric_logger.close()
         sys.exit()
 
-    metric_logger.write_metrics(running_gcs_metrics, metrics, step)
+    metric_logger.write_metrics(metrics, step)
 
     if config.dump_hlo and step == (config.dump_step if config.dump_step >= 0 else start_step):
       jax.block_until_ready(state)  # Ensure compilation has finished.
@@ -889,43 +996,9 @@ def train_loop(config, state=None):
 
     if config.eval_interval > 0 and step > start_step and (step + 1) % config.eval_interval == 0:
       assert eval_data_iterator
-      cumulative_eval_metrics = {
-          "scalar": {
-              "eval/total_loss": 0.0,
-              "eval/total_weights": 0.0,
-              "eval/avg_loss": 0.0,
-              "eval/moe_lb_loss": 0.0,
-          }
-      }
-      eval_dpo_reward_accuracy = 0.0
-      eval_step_count = 0
-      # pylint: disable=not-callable
-      for eval_batch in eval_data_iterator:
-        if config.eval_steps > 0 and eval_step_count >= config.eval_steps:
-          break
-        with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-          eval_metrics = p_eval_step(state, eval_batch, nextrng)
-        cumulative_eval_metrics["scalar"]["eval/total_loss"] += float(eval_metrics["scalar"]["evaluation/total_loss"])
-        cumulative_eval_metrics["scalar"]["eval/total_weights"] += float(eval_metrics["scalar"]["evaluation/total_weights"])
-        cumulative_eval_metrics["scalar"]["eval/moe_lb_loss"] += float(eval_metrics["scalar"]["evaluation/moe_lb_loss"])
-        eval_dpo_reward_accuracy += float(eval_metrics["scalar"].get("evaluation/dpo_reward_accuracy", 0.0))  # for dpo only
-        max_logging.log(f"Completed eval step {eval_step_count}")
-        eval_step_count += 1
-      eval_loss = cumulative_eval_metrics["scalar"]["eval/total_loss"] / (
-          cumulative_eval_metrics["scalar"]["eval/total_weights"] + EPS
-      )
-      cumulative_eval_metrics["scalar"]["eval/avg_loss"] = eval_loss
-      cumulative_eval_metrics["scalar"]["eval/avg_moe_lb_loss"] = (
-          cumulative_eval_metrics["scalar"]["eval/moe_lb_loss"] / eval_step_count
-      )
-      if config.use_dpo:
-        cumulative_eval_metrics["scalar"]["eval/dpo_reward_accuracy"] = eval_dpo_reward_accuracy / eval_step_count
-      metric_logger.write_metrics(running_gcs_metrics, cumulative_eval_metrics, step, is_training=False)
-      max_logging.log(
-          f"average loss after {step=}: {eval_step_count=}, {eval_loss=},"
-          f" total_weights={cumulative_eval_metrics['scalar']['eval/total_weights']}"
-      )
-      if eval_loss <= config.target_eval_loss:
+      cumulative_eval_metrics, eval_step_count = run_eval(config, mesh, p_eval_step, state, eval_data_iterator, nextrng)
+      eval_loss = write_eval_metrics(config, metric_logger, cumulative_eval_metrics, eval_step_count, step)
+      if eval_loss is not None and eval_loss <= config.target_eval_loss:
         max_logging.log(f"Early stop and exit loop after reaching {config.target_eval_loss=}")
         prof.deactivate()
         break
@@ -954,7 +1027,7 @@ def train_loop(config, state=None):
         max_logging.log(f"Checkpoint is already saved for step {int(state.step)-1}.")
 
     checkpoint_manager.wait_until_finished()
-  metric_logger.write_metrics(running_gcs_metrics, metrics, config.steps - 1)  # final step metrics
+  metric_logger.close()  # writes the final step metrics
   max_utils.close_summary_writer(writer)
   record_goodput(recorder, config, recorder.record_job_end_time if recorder else None)
   with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
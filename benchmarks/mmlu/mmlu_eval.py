@@ -14,6 +14,11 @@
 
 """This is a simple script for MMLU benchmark for a trained checkpoint.
 
+By default the answer is the choice letter with the highest log probability after the prompt. Many
+prompts are packed in each prefill, the way prefill_concat packs them, and nothing is decoded. With
+scoring=generate, the model generates text for one question at a time and the answer is parsed from
+it, which is needed for Chain-of-Thought templates.
+
 To get optimal performance the prompt template needs to be adjusted (e.g. CoT or 5-shot prompt) per model.
 
 
@@ -28,26 +33,34 @@ python3 -m MaxText.benchmarks.mmlu.mmlu_eval MaxText/configs/base.yml \
   tokenizer_path=assets/tokenizer_llama3.tiktoken \
   load_parameters_path=check_point_path model_name=llama3.1-8b \
   max_prefill_predict_length=1024 max_target_length=2048 ici_tensor_parallelism=4 per_device_batch_size=1 \
+  --scoring=generate \
   prompt_template="The following are multiple choice questions (with answers) about {subject}.\n\n{question}\n{choices}\nAnswer: Let's think step by step."
 
-# Example of using the prompt_template flag for 5-shot prompting (replace with actual examples):
+# Example of using the prompt_template flag for 5-shot prompting (replace with actual examples).
+# With --share_prefix and use_chunked_prefill=true, the few-shot prefix before {question} is prefilled once
+# per subject and kept in the prefix cache, each question only prefills the rest of its prompt:
 python3 -m MaxText.benchmarks.mmlu.mmlu_eval MaxText/configs/base.yml \
   tokenizer_path=assets/tokenizer_llama3.tiktoken \
   load_parameters_path=check_point_path model_name=llama3.1-8b \
   max_prefill_predict_length=1024 max_target_length=2048 ici_tensor_parallelism=4 per_device_batch_size=1 \
+  use_chunked_prefill=true --share_prefix \
   prompt_template='Example 1:\nQuestion: What is the capital of France?\nChoices:\nA. London\nB. Paris\nC. Rome\nD. Berlin\nAnswer: B\n\nExample 2:\nQuestion: What is the highest mountain in the world?\nChoices:\nA. K2\nB. Kangchenjunga\nC. Mount Everest\nD. Lhotse\nAnswer: C\n\nExample 3:\nQuestion: What is the chemical symbol for water?\nChoices:\nA. H2O\nB. CO2\nC. O2\nD. NaCl\nAnswer: A\n\nExample 4:\nQuestion: Who painted the Mona Lisa?\nChoices:\nA. Michelangelo\nB. Leonardo da Vinci\nC. Raphael\nD. Donatello\nAnswer: B\n\nExample 5:\nQuestion: Which planet is known as the Red Planet?\nChoices:\nA. Venus\nB. Mars\nC. Jupiter\nD. Saturn\nAnswer: B\n\nThe following are multiple choice questions (with answers) about {subject}.\n\n{question}\n{choices}\nAnswer:'
 """
 
 import collections
+import dataclasses
 import re
 import sys
 
 from absl import flags
 import datasets
 import jax
+import jax.numpy as jnp
+import numpy as np
 from MaxText import max_logging
 from MaxText import max_utils
 from MaxText import maxengine
+from MaxText import prefix_cache
 from mmlu_categories import categories
 from mmlu_categories import subcategories
 from MaxText import pyconfig
@@ -55,6 +68,7 @@ from tqdm import tqdm
 
 
 ASCII_UPPERCASE_A = ord("A")  # ASCII value for uppercase 'A'
+NUM_CHOICES = 4
 
 DEFAULT_PROMPT_TEMPLATE = """The following are multiple choice questions (with answers) about {subject}.
 
@@ -68,6 +82,24 @@ _PROMPT_TEMPLATE = flags.DEFINE_string(
     default=DEFAULT_PROMPT_TEMPLATE,
     help="prompt template",
 )
+_SCORING = flags.DEFINE_enum(
+    "scoring",
+    default="logprobs",
+    enum_values=["logprobs", "generate"],
+    help="logprobs picks the choice letter with the highest log probability after the prompt, "
+    "generate decodes text and parses the answer from it.",
+)
+_PROMPTS_PER_PREFILL = flags.DEFINE_integer(
+    "prompts_per_prefill",
+    default=16,
+    help="Max number of prompts packed in one prefill sequence with scoring=logprobs.",
+)
+_SHARE_PREFIX = flags.DEFINE_bool(
+    "share_prefix",
+    default=False,
+    help="Prefill the part of the prompt before {question} once per subject and reuse its kv-cache from "
+    "the prefix cache. Needs use_chunked_prefill=true.",
+)
 
 
 def construct_prompt(subject, question, choices):
@@ -77,48 +109,231 @@ def construct_prompt(subject, question, choices):
   return prompt
 
 
-def parse_answer(output):
-  match = re.search(r"Answer:\s*([A-D])|(?:The answer is)\s*([A-D])", output, re.IGNORECASE)
-  predicted_answer = match.group(1) or match.group(2) if match else None
-  return predicted_answer
+def shared_prefix(subject):
+  """The part of the prompt before {question}, shared by all questions of the subject."""
+  return _PROMPT_TEMPLATE.value.split("{question}")[0].format(subject=subject.replace("_", " "))
 
 
-def main(config):
-  engine = maxengine.MaxEngine(config)
-  params = engine.load_params()
+def shared_prefix_length(tokens, prefix_tokens):
+  """Number of leading tokens of the prompt that are also the leading tokens of its tokenized shared prefix.
 
-  metadata = engine.get_tokenizer()
-  tokenizer = engine.build_tokenizer(metadata)
+  The prompt is tokenized whole, so a token merged across the end of the shared prefix is not
+  counted, and at least the last token of the prompt is left to prefill after the prefix.
+  """
+  limit = min(len(tokens) - 1, len(prefix_tokens))
+  mismatches = np.flatnonzero(tokens[:limit] != prefix_tokens[:limit])
+  return int(mismatches[0]) if mismatches.size else limit
 
-  max_prefill_predict_length = getattr(config, "max_prefill_predict_length", 1024)
-  max_target_length = getattr(config, "max_target_length", 2048)
 
-  # Initialize counters for overall and per-subject accuracies
-  correct_count = 0
-  total_count = 0
-  subject_correct = collections.defaultdict(int)
-  subject_total = collections.defaultdict(int)
-  subcat_correct = collections.defaultdict(int)
-  subcat_total = collections.defaultdict(int)
+def parse_answer(output):
+  match = re.search(r"Answer:\s*([A-D])|(?:The answer is)\s*([A-D])", output, re.IGNORECASE)
+  predicted_answer = match.group(1) or match.group(2) if match else None
+  return predicted_answer
 
-  mmlu_test_ds = datasets.load_dataset("lighteval/mmlu", "all", split="test")
-  for idx, example in enumerate(tqdm(mmlu_test_ds, desc="Evaluating MMLU dataset")):
-    subject = example["subject"]
-    question = example["question"]
-    choices = example["choices"]
-    label = example["answer"]
-    prompt = construct_prompt(subject, question, choices)
+
+def choice_token_ids(tokenizer):
+  """Token ids of the choice letters as they follow "Answer:".
+
+  " A" is a single token for BPE tokenizers, SentencePiece tokenizers add the leading space
+  themselves and encode "A" as the single token "▁A". A letter that is more than one token in
+  both forms can't be scored by the log probability of its token.
+  """
+  token_ids = []
+  for idx in range(NUM_CHOICES):
+    letter = chr(ASCII_UPPERCASE_A + idx)
+    for text in (f" {letter}", letter):
+      tokens, true_length = tokenizer.encode(text, is_bos=False, prefill_lengths=[8])
+      if true_length == 1:
+        token_ids.append(int(np.asarray(tokens)[0]))
+        break
+    else:
+      raise ValueError(f"Choice {letter!r} is not a single token, use --scoring=generate with this tokenizer.")
+  return np.asarray(token_ids, dtype=np.int32)
+
+
+@dataclasses.dataclass
+class PackedPrompts:
+  """Prompts packed in one prefill sequence, see MaxEngine.prefill_concat."""
+
+  tokens: np.ndarray
+  positions: np.ndarray
+  segment_ids: np.ndarray
+  last_positions: np.ndarray
+  example_indices: list[int]
+
+
+def pack_prompts(prompts_tokens, max_length, max_prompts):
+  """Packs tokenized prompts in order into sequences of max_length.
+
+  Each sequence holds at most max_prompts prompts, so that every prefill has the same shapes and
+  compiles once. Unused last_positions point to the padding and are not read back.
+
+  Args:
+    prompts_tokens: List of 1D arrays of prompt tokens, each at most max_length long.
+    max_length: Length of the packed sequences.
+    max_prompts: Max number of prompts in a packed sequence.
+  Yields:
+    PackedPrompts, example_indices are the indices of the prompts in prompts_tokens.
+  """
+
+  def new_packed():
+    return PackedPrompts(
+        tokens=np.zeros(max_length, dtype=np.int32),
+        positions=np.zeros(max_length, dtype=np.int32),
+        segment_ids=np.zeros(max_length, dtype=np.int32),
+        last_positions=np.zeros(max_prompts, dtype=np.int32),
+        example_indices=[],
+    )
+
+  packed = new_packed()
+  offset = 0
+  for idx, tokens in enumerate(prompts_tokens):
+    length = len(tokens)
+    if offset + length > max_length or len(packed.example_indices) == max_prompts:
+      yield packed
+      packed = new_packed()
+      offset = 0
+    packed.tokens[offset : offset + length] = tokens
+    packed.positions[offset : offset + length] = np.arange(length)
+    packed.segment_ids[offset : offset + length] = len(packed.example_indices) + 1
+    packed.last_positions[len(packed.example_indices)] = offset + length - 1
+    packed.example_indices.append(idx)
+    offset += length
+  if packed.example_indices:
+    yield packed
+
+
+def tokenize_prompts(tokenizer, prompts, max_prefill_length, is_bos=True):
+  """Tokenizes prompts without padding, keeping the end of the prompts longer than max_prefill_length."""
+  prompts_tokens = []
+  for idx, (tokens, true_length) in enumerate(
+      tokenizer.encode_batch(prompts, is_bos=is_bos, prefill_lengths=[max_prefill_length])
+  ):
+    tokens = np.asarray(tokens)[:true_length]
+    if true_length > max_prefill_length:
+      max_logging.log(
+          f"Warning: Prompt {idx} length {true_length} exceeds max prefill length {max_prefill_length}."
+          " Truncating the start of the prompt."
+      )
+      tokens = tokens[-max_prefill_length:]
+    prompts_tokens.append(tokens)
+  return prompts_tokens
+
+
+def predict_by_logprobs(engine, params, tokenizer, examples, max_prefill_length):
+  """Predicts the choice with the highest log probability, packing many prompts per prefill."""
+  prompts = [construct_prompt(ex["subject"], ex["question"], ex["choices"]) for ex in examples]
+  prompts_tokens = tokenize_prompts(tokenizer, prompts, max_prefill_length)
+  target_tokens = jnp.asarray(choice_token_ids(tokenizer))
+
+  # Prefills are dispatched without waiting on the results, which are only read back at the end.
+  all_packed, all_logprobs = [], []
+  for packed in tqdm(
+      pack_prompts(prompts_tokens, max_prefill_length, _PROMPTS_PER_PREFILL.value), desc="Scoring MMLU dataset"
+  ):
+    all_logprobs.append(
+        engine.prefill_concat_logprobs(
+            params=params,
+            padded_tokens=jnp.asarray(packed.tokens),
+            decoder_positions=jnp.asarray(packed.positions),
+            decoder_segment_ids=jnp.asarray(packed.segment_ids),
+            last_positions=jnp.asarray(packed.last_positions),
+            target_tokens=target_tokens,
+        )
+    )
+    all_packed.append(packed)
+
+  predictions = [None] * len(examples)
+  for packed, logprobs in zip(all_packed, jax.device_get(all_logprobs)):
+    for row, idx in enumerate(packed.example_indices):
+      num_choices = len(examples[idx]["choices"])
+      predictions[idx] = chr(ASCII_UPPERCASE_A + int(np.argmax(logprobs[row, :num_choices])))
+  return predictions
+
+
+@jax.jit
+def _next_token_logprobs(logits, target_tokens):
+  return jax.nn.log_softmax(logits[0, -1].astype(jnp.float32))[target_tokens]
+
+
+def _chunked_prefill(engine, params, tokens, existing_prefix=None):
+  """Prefills tokens in chunks of prefill_chunk_size after existing_prefix."""
+  chunk_size = engine.config.prefill_chunk_size
+  prefill_result = None
+  for start in range(0, len(tokens), chunk_size):
+    chunk = tokens[start : start + chunk_size]
+    padded_chunk = np.zeros(chunk_size, dtype=np.int32)
+    padded_chunk[: len(chunk)] = chunk
+    prefill_result, _ = engine.prefill(
+        params=params, existing_prefix=existing_prefix, padded_tokens=jnp.asarray(padded_chunk), true_length=len(chunk)
+    )
+    processed = chunk if existing_prefix is None else np.concatenate([existing_prefix.common_prefix_tokens, chunk])
+    existing_prefix = maxengine.ExistingPrefix(cache=prefill_result["cache"], common_prefix_tokens=jnp.asarray(processed))
+  return prefill_result, existing_prefix
+
+
+def predict_with_shared_prefix(engine, params, tokenizer, examples, max_prefill_length):
+  """Predicts the choice with the highest log probability, prefilling each subject prefix once."""
+  if not engine.use_chunked_prefill:
+    raise ValueError("share_prefix needs use_chunked_prefill=true.")
+  config = engine.config
+  target_tokens = jnp.asarray(choice_token_ids(tokenizer))
+  prompts = [construct_prompt(ex["subject"], ex["question"], ex["choices"]) for ex in examples]
+  prompts_tokens = tokenize_prompts(tokenizer, prompts, max_prefill_length)
+  prefixes_tokens = tokenize_prompts(tokenizer, [shared_prefix(ex["subject"]) for ex in examples], max_prefill_length)
+
+  all_logprobs = []
+  with prefix_cache.PrefixCache(
+      config.prefix_caching_hbm_byte,
+      config.prefix_caching_dram_byte,
+      eviction_policy=config.prefix_caching_eviction_policy,
+      ttl_seconds=config.prefix_caching_ttl_seconds,
+      disk_bytes=config.prefix_caching_disk_byte,
+      disk_dir=config.prefix_caching_disk_dir,
+  ) as cache:
+    for tokens, prefix_tokens in tqdm(
+        zip(prompts_tokens, prefixes_tokens), total=len(examples), desc="Scoring MMLU dataset"
+    ):
+      # split the whole prompt's tokens, so that the prefix and the rest are tokenized as in the prompt
+      prefix_length = shared_prefix_length(tokens, prefix_tokens)
+      existing_prefix = None
+      if prefix_length > 0:
+        key = tuple(tokens[:prefix_length].tolist())
+        value = cache.load(key) if cache.fetch_longest_common_prefix_key(key) == key else None
+        if value is not None:
+          existing_prefix = maxengine.ExistingPrefix(cache=value.prefix, common_prefix_tokens=jnp.asarray(key))
+        else:
+          # Use the computed prefix, the cache cannot hold it if save fails, e.g. larger than the HBM cache.
+          _, existing_prefix = _chunked_prefill(engine, params, tokens[:prefix_length])
+          saved = cache.save(
+              key,
+              prefix_cache.Value(prefix=existing_prefix.cache, true_length=len(key), padded_length=len(key), tokens=key),
+          )
+          if not saved:
+            max_logging.log(f"Warning: Cannot cache the prefix of {len(key)} tokens, prefill it for every prompt.")
+      prefill_result, _ = _chunked_prefill(engine, params, tokens[prefix_length:], existing_prefix)
+      all_logprobs.append(_next_token_logprobs(prefill_result["logits"], target_tokens))
+
+  predictions = []
+  for example, logprobs in zip(examples, jax.device_get(all_logprobs)):
+    predictions.append(chr(ASCII_UPPERCASE_A + int(np.argmax(logprobs[: len(example["choices"])]))))
+  return predictions
+
+
+def predict_by_generation(engine, params, tokenizer, examples, *, max_prefill_length, max_target_length):
+  """Generates text for one prompt at a time and parses the predicted answer from it."""
+  predictions = []
+  for example in tqdm(examples, desc="Evaluating MMLU dataset"):
+    prompt = construct_prompt(example["subject"], example["question"], example["choices"])
 
     # Tokenize the input
-    tokens, true_length = tokenizer.encode(prompt, is_bos=True, prefill_lengths=[max_prefill_predict_length])
-    if true_length > max_prefill_predict_length:
+    tokens, true_length = tokenizer.encode(prompt, is_bos=True, prefill_lengths=[max_prefill_length])
+    if true_length > max_prefill_length:
       max_logging.log(
-          f"Warning: Prompt length {true_length} exceeds max prefill length" f" {max_prefill_predict_length}. Truncating."
+          f"Warning: Prompt length {true_length} exceeds max prefill length" f" {max_prefill_length}. Truncating."
       )
-      tokens = tokens[:max_prefill_predict_length]
-      true_length = max_prefill_predict_length
-    assert config.quantization != "fp8", "fp8 on NVIDIA GPUs is not supported in decode.py yet"
-    assert config.quantization != "nanoo_fp8", "NANOO fp8 on AMD MI300/MI325 GPUs is not supported in decode.py yet"
+      tokens = tokens[:max_prefill_length]
+      true_length = max_prefill_length
 
     # Perform prefill
     prefill_result, first_token = engine.prefill(params=params, padded_tokens=tokens, true_length=true_length)
@@ -128,7 +343,7 @@ def main(config):
     decode_state = engine.init_decode_state()
     decode_state = engine.insert(prefill_result, decode_state, slot=slot)
 
-    steps = range(max_prefill_predict_length, max_target_length)
+    steps = range(max_prefill_length, max_target_length)
     sampled_tokens = [first_token.get_result_at_slot(slot).tokens.item()]
 
     predicted_answer = ""
@@ -147,12 +362,33 @@ def main(config):
         break
 
     if not predicted_answer:
-      max_logging.log("Could not extract an answer from the model's output for example" f" {total_count + 1}")
-    elif predicted_answer not in {chr(ASCII_UPPERCASE_A + idx) for idx in range(len(choices))}:
-      max_logging.log(f"Invalid or missing predicted answer for subject '{subject}' in example {total_count + 1}")
+      max_logging.log("Could not extract an answer from the model's output for example" f" {len(predictions) + 1}")
+    elif predicted_answer not in {chr(ASCII_UPPERCASE_A + idx) for idx in range(len(example["choices"]))}:
+      max_logging.log(
+          f"Invalid or missing predicted answer for subject '{example['subject']}' in example {len(predictions) + 1}"
+      )
+    predictions.append(predicted_answer)
 
+    if len(predictions) % 50 == 1:
+      correct_count = sum(pred == chr(ASCII_UPPERCASE_A + ex["answer"]) for pred, ex in zip(predictions, examples))
+      max_logging.log(f" Accuracy: {correct_count / len(predictions):.4f}")
+  return predictions
+
+
+def log_accuracies(examples, predictions):
+  """Logs the overall accuracy and the accuracies per subcategory and category."""
+  # Initialize counters for overall and per-subject accuracies
+  correct_count = 0
+  total_count = 0
+  subject_correct = collections.defaultdict(int)
+  subject_total = collections.defaultdict(int)
+  subcat_correct = collections.defaultdict(int)
+  subcat_total = collections.defaultdict(int)
+
+  for example, predicted_answer in zip(examples, predictions):
+    subject = example["subject"]
     # Convert the label index to the corresponding letter
-    correct_answer = chr(65 + label)
+    correct_answer = chr(ASCII_UPPERCASE_A + example["answer"])
 
     # Update accuracy for overall and per-subject
     if predicted_answer == correct_answer:
@@ -161,9 +397,6 @@ def main(config):
     total_count += 1
     subject_total[subject] += 1
 
-    if idx % 50 == 0:
-      max_logging.log(f" Accuracy: {correct_count / total_count:.4f}")
-
   # Final accuracy
   if total_count > 0:
     accuracy = correct_count / total_count
@@ -208,6 +441,36 @@ def main(config):
       max_logging.log(f"Accuracy for category '{category_name}': No data available.")
 
 
+def main(config):
+  assert config.quantization != "fp8", "fp8 on NVIDIA GPUs is not supported in decode.py yet"
+  assert config.quantization != "nanoo_fp8", "NANOO fp8 on AMD MI300/MI325 GPUs is not supported in decode.py yet"
+
+  engine = maxengine.MaxEngine(config)
+  params = engine.load_params()
+
+  metadata = engine.get_tokenizer()
+  tokenizer = engine.build_tokenizer(metadata)
+
+  max_prefill_predict_length = getattr(config, "max_prefill_predict_length", 1024)
+  max_target_length = getattr(config, "max_target_length", 2048)
+
+  examples = list(datasets.load_dataset("lighteval/mmlu", "all", split="test"))
+  if _SCORING.value == "generate":
+    predictions = predict_by_generation(
+        engine,
+        params,
+        tokenizer,
+        examples,
+        max_prefill_length=max_prefill_predict_length,
+        max_target_length=max_target_length,
+    )
+  elif _SHARE_PREFIX.value:
+    predictions = predict_with_shared_prefix(engine, params, tokenizer, examples, max_prefill_predict_length)
+  else:
+    predictions = predict_by_logprobs(engine, params, tokenizer, examples, max_prefill_predict_length)
+  log_accuracies(examples, predictions)
+
+
 def validate_config(config):
   assert not config.load_full_state_path, (
       "Decode doesn't operate on full states! Convert to parameter checkpoint"